@@ -0,0 +1,546 @@
+# License under the MIT License - see LICENSE
+
+'''
+asyncio engine for the Controller, for runs with many jobs. Staging the
+data, submitting jobs, collecting results, watching the workers and scaling
+the fleet all run at once on one event loop, while the blocking boto calls
+run in a bounded thread pool.
+
+Requires Python 3.7 or newer. This module is only used on the controlling
+machine; the workers do not import it.
+
+    async def main():
+        async with AsyncController(params, key=key, secret=secret) as ctrl:
+            await ctrl.run(image_id='ami-00000000', nworkers=10)
+
+    asyncio.run(main())
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from autoscale import Autoscaler
+from controller import Controller
+
+
+# Controller methods that do no I/O, so can be called from the event loop.
+LOCAL_METHODS = frozenset(["boot_latency", "measured_throughput",
+                           "take_job_durations"])
+
+
+class AsyncController(object):
+    '''
+    Run a `Controller` from an asyncio event loop. Each blocking method of
+    the Controller has a coroutine of the same name and arguments here (or
+    an asynchronous generator, for the `iter_*` methods), and its other
+    attributes (e.g., `finished_jobs`, `track_uploaded`) are available
+    directly. `run` drives a whole run concurrently.
+
+    Parameters
+    ----------
+    params : dict
+        Run parameters, as for `Controller`.
+    run_name : str, optional
+        Name of the run.
+    region : str, optional
+        AWS region name.
+    key : str, optional
+        AWS access key.
+    secret : str, optional
+        AWS secret key.
+    max_instances : int, optional
+        Largest number of workers to run.
+    result_store : ResultStore or str, optional
+        Store to add the results to.
+    max_workers : int, optional
+        Largest number of blocking calls to run at once.
+    controller : Controller, optional
+        Use an existing Controller instead of creating one. The other
+        Controller arguments are then ignored.
+    '''
+    def __init__(self, params=None, run_name='CASA_Timing',
+                 region='us-west-2', key=None, secret=None, max_instances=10,
+                 result_store=None, max_workers=16, controller=None):
+        super(AsyncController, self).__init__()
+
+        if controller is None:
+            controller = Controller(params, run_name=run_name, region=region,
+                                    key=key, secret=secret,
+                                    max_instances=max_instances,
+                                    result_store=result_store)
+        self.controller = controller
+
+        # Workers found to have stopped before the run finished.
+        self.lost_instances = []
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._tasks = set()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on this object.
+        if name == "controller":
+            raise AttributeError(name)
+        value = getattr(self.controller, name)
+        # Blocking calls would stall every activity on the loop.
+        if callable(value) and name not in LOCAL_METHODS:
+            raise AttributeError("Controller.{0} may block, so has no "
+                                 "blocking form here. Call it through "
+                                 "`controller` from another thread."
+                                 .format(name))
+        return value
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.shutdown()
+
+    async def _call(self, func, *args, **kwargs):
+        '''
+        Run a blocking function in the thread pool.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(func, *args,
+                                                            **kwargs))
+
+    async def _iterate(self, generator):
+        '''
+        Run a blocking generator in the thread pool, one item at a time.
+        '''
+
+        finished = object()
+        try:
+            while True:
+                item = await self._call(next, generator, finished)
+                if item is finished:
+                    break
+                yield item
+        finally:
+            try:
+                await self._call(generator.close)
+            except ValueError:
+                # Still running in the pool after a cancellation. It is
+                # closed once collected.
+                pass
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def shutdown(self):
+        '''
+        Cancel the running activities, wait for them to finish, and shut
+        down the thread pool. Blocking calls already running are allowed to
+        finish (e.g., a long poll for results, for up to 20 seconds).
+        '''
+
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None,
+                                   functools.partial(self._executor.shutdown,
+                                                     wait=True))
+
+    def check_finish(self):
+        return self.controller.check_finish()
+
+    async def upload_request(self, data, bucket_name=None, num_workers=1,
+                             ready=None, **upload_kwargs):
+        '''
+        Upload the given data to S3, with up to `num_workers` items at once.
+        As with `Controller.upload_request`, the outcome of each item is
+        kept in `track_uploaded`. All of the items are tried, even after one
+        fails.
+
+        Parameters
+        ----------
+        data : str or list
+            Files or folders to upload.
+        bucket_name : str, optional
+            Existing bucket to upload to. Otherwise, a bucket named after the
+            job is created.
+        num_workers : int, optional
+            Number of items to upload at once.
+        ready : asyncio.Queue, optional
+            Each item is put on this queue once it is uploaded.
+        upload_kwargs : passed to `upload_to_s3`.
+
+        Returns
+        -------
+        success : bool
+            Whether all items were uploaded.
+        '''
+
+        ctrl = self.controller
+
+        bucket_name = await self._call(ctrl._staging_bucket, bucket_name)
+
+        if not isinstance(data, list):
+            data = [data]
+
+        ctrl._start_tracking(data)
+
+        upload_kwargs["aws_access"] = ctrl.credentials
+
+        slots = asyncio.Semaphore(max(1, num_workers))
+
+        async def upload_item(dat):
+            async with slots:
+                await self._call(ctrl._upload_item, dat, bucket_name,
+                                 upload_kwargs)
+            if ready is not None and \
+                    ctrl.track_uploaded[dat]["status"] == "Success":
+                await ready.put(dat)
+
+        await _supervise([asyncio.ensure_future(upload_item(dat))
+                          for dat in data])
+
+        return all(record["status"] == "Success"
+                   for record in ctrl.track_uploaded.values())
+
+    async def new_sqs_message(self, *args, **kwargs):
+        '''
+        Submit jobs to the request queue. See `Controller.new_sqs_message`.
+        '''
+        return await self._call(self.controller.new_sqs_message, *args,
+                                **kwargs)
+
+    async def new_packed_message(self, *args, **kwargs):
+        '''
+        Submit jobs packed into work units. See
+        `Controller.new_packed_message`.
+        '''
+        return await self._call(self.controller.new_packed_message, *args,
+                                **kwargs)
+
+    async def boot_instances(self, *args, **kwargs):
+        '''
+        Launch workers. See `Controller.boot_instances`.
+        '''
+        return await self._call(self.controller.boot_instances, *args,
+                                **kwargs)
+
+    async def boot_spot_instances(self, *args, **kwargs):
+        '''
+        Request spot workers. See `Controller.boot_spot_instances`.
+        '''
+        return await self._call(self.controller.boot_spot_instances, *args,
+                                **kwargs)
+
+    async def iter_spot_ready(self, requests=None, timeout=600):
+        '''
+        Yield the instances of the spot requests as they are fulfilled. See
+        `Controller.iter_spot_ready`.
+        '''
+        generator = self.controller.iter_spot_ready(requests, timeout)
+        async for inst in self._iterate(generator):
+            yield inst
+
+    async def iter_ready_instances(self, instances=None, **kwargs):
+        '''
+        Yield each of the workers as soon as it is running. See
+        `Controller.iter_ready_instances`.
+        '''
+        generator = self.controller.iter_ready_instances(instances, **kwargs)
+        async for inst in self._iterate(generator):
+            yield inst
+
+    async def alive_instances(self, *args, **kwargs):
+        '''
+        Return the workers that are booting or running. See
+        `Controller.alive_instances`.
+        '''
+        return await self._call(self.controller.alive_instances, *args,
+                                **kwargs)
+
+    async def update_instances(self, *args, **kwargs):
+        '''
+        Stop tracking the workers that have stopped. See
+        `Controller.update_instances`.
+        '''
+        return await self._call(self.controller.update_instances, *args,
+                                **kwargs)
+
+    async def retire_instances(self, nretire, instances=None):
+        '''
+        Ask idle workers to drain. See `Controller.retire_instances`.
+        '''
+        return await self._call(self.controller.retire_instances, nretire,
+                                instances)
+
+    async def terminate_drained(self):
+        '''
+        Terminate the drained workers. See `Controller.terminate_drained`.
+        '''
+        return await self._call(self.controller.terminate_drained)
+
+    async def receive_result(self, queue=None, wait_time=20, timeout=None,
+                             buffer_size=1048576, until=None):
+        '''
+        Collect the result messages until all jobs have finished. See
+        `Controller.receive_result`.
+
+        Parameters
+        ----------
+        until : asyncio.Event, optional
+            Only stop once this is set as well (e.g., once all jobs have
+            been submitted).
+        '''
+
+        ctrl = self.controller
+
+        if queue is None:
+            queue = ctrl.result_queue
+
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+
+        with open(ctrl.result_log, "a", buffer_size) as log:
+            while not (ctrl.check_finish() and
+                       (until is None or until.is_set())):
+                if timeout is not None and loop.time() - t0 > timeout:
+                    break
+                await self._call(ctrl._collect_results, queue, log,
+                                 wait_time)
+
+        return len(ctrl.finished_jobs)
+
+    async def _scale_loop(self, image_id, autoscaler, interval, boot_kwargs):
+        '''
+        Launch or retire workers every `interval` seconds, as the
+        autoscaler decides from the request queue.
+        '''
+
+        ctrl = self.controller
+
+        while True:
+            # The queue is looked up in the worker thread, to use that
+            # thread's connection.
+            attrs = await self._call(
+                lambda: ctrl.request_queue.get_attributes('All'))
+            nvisible = int(attrs['ApproximateNumberOfMessages'])
+            ninflight = int(attrs['ApproximateNumberOfMessagesNotVisible'])
+
+            for duration in ctrl.take_job_durations():
+                autoscaler.record_job_duration(duration)
+
+            await self.terminate_drained()
+            await self._check_health()
+
+            # Draining workers take no new jobs, so no longer count.
+            nrunning = len([inst for inst in ctrl.instances
+                            if inst.id not in ctrl.draining])
+            change = autoscaler.decide(nvisible, ninflight, nrunning)
+            if change > 0:
+                await self.boot_instances(image_id, nworkers=change,
+                                          **boot_kwargs)
+            elif change < 0:
+                await self.retire_instances(-change, ctrl.instances)
+
+            await asyncio.sleep(interval)
+
+    async def _health_loop(self, image_id, interval, boot_kwargs):
+        '''
+        Check the workers every `interval` seconds, and replace any that
+        were lost while jobs are left. Workers that stopped on their own,
+        after running out of jobs or draining, are not replaced.
+        '''
+
+        while True:
+            await asyncio.sleep(interval)
+            lost = await self._check_health()
+            if len(lost) > 0 and not self.controller.check_finish():
+                await self.boot_instances(image_id, nworkers=len(lost),
+                                          **boot_kwargs)
+
+    async def _check_health(self):
+        '''
+        Drop the workers that have stopped, and return those that were
+        lost (e.g., crashed or interrupted) rather than stopping on their
+        own. New workers the EC2 API does not list yet are kept (see
+        `Controller.update_instances`).
+        '''
+
+        ctrl = self.controller
+
+        stopped = await self.update_instances()
+        lost = [inst for inst in stopped
+                if inst.id not in ctrl.stopped_instances]
+
+        self.lost_instances.extend(lost)
+
+        return lost
+
+    async def autoscale(self, image_id, autoscaler=None, interval=60,
+                        wait_time=20, **boot_kwargs):
+        '''
+        Collect results while scaling the fleet to the request queue, until
+        all jobs have finished. See `Controller.autoscale`. Unlike it, the
+        results are collected continuously rather than between scaling
+        rounds.
+
+        Returns
+        -------
+        nfinished : int
+            Number of jobs finished.
+        '''
+
+        if autoscaler is None:
+            autoscaler = Autoscaler(self.controller.max_instances)
+
+        collect = self._spawn(self.receive_result(wait_time=wait_time))
+        scale = self._spawn(self._scale_loop(image_id, autoscaler, interval,
+                                             boot_kwargs))
+
+        await _supervise([collect], [scale])
+
+        return collect.result()
+
+    async def run(self, data=None, image_id=None, commands=None,
+                  bucket_name=None, nworkers=None, autoscaler=None,
+                  upload_workers=4, interval=60, wait_time=20,
+                  upload_kwargs=None, submit_kwargs=None, boot_kwargs=None):
+        '''
+        Run all of the jobs. The data is staged to S3 and each job is
+        submitted as soon as its data is uploaded, while the workers are
+        launched, results are collected, and the fleet is watched and
+        scaled. Returns once every submitted job has a result.
+
+        If any activity fails (or the run is cancelled), the others are
+        cancelled before the error is raised.
+
+        Parameters
+        ----------
+        data : list, optional
+            Files or folders to make jobs for. Defaults to `params['files']`.
+        image_id : str, optional
+            Image to launch the workers from. Without it, no workers are
+            launched (e.g., they are already running).
+        commands : list, optional
+            Commands for each job. Defaults to `params['commands']`.
+        bucket_name : str, optional
+            Bucket to stage the data in. Defaults to one named after the
+            job.
+        nworkers : int, optional
+            Number of workers to launch up front, without an autoscaler.
+            Workers that stop while jobs are left are replaced. Defaults to
+            `max_instances`.
+        autoscaler : Autoscaler, optional
+            Scale the fleet with this policy instead.
+        upload_workers : int, optional
+            Number of items to upload at once.
+        interval : float, optional
+            Seconds between scaling decisions or health checks.
+        wait_time : int, optional
+            Seconds to long-poll for results (max. 20).
+        upload_kwargs : dict, optional
+            Passed to `upload_to_s3`.
+        submit_kwargs : dict, optional
+            Passed to `Controller.new_sqs_message`.
+        boot_kwargs : dict, optional
+            Passed to `Controller.boot_instances`.
+
+        Returns
+        -------
+        nfinished : int
+            Number of jobs finished.
+        '''
+
+        ctrl = self.controller
+
+        if data is None:
+            data = ctrl.data_files
+        if not isinstance(data, list):
+            data = [data]
+
+        bucket_name = await self._call(ctrl._staging_bucket, bucket_name)
+
+        upload_kwargs = dict(upload_kwargs or {})
+        submit_kwargs = dict(submit_kwargs or {})
+        boot_kwargs = dict(boot_kwargs or {})
+
+        ready = asyncio.Queue()
+        submitted = asyncio.Event()
+
+        # Jobs are numbered as they are submitted.
+        ctrl.message_ids = {}
+        ctrl.unsent_jobs = {}
+
+        async def stage():
+            try:
+                await self.upload_request(data, bucket_name=bucket_name,
+                                          num_workers=upload_workers,
+                                          ready=ready, **upload_kwargs)
+            finally:
+                await ready.put(None)
+
+        async def submit():
+            finished = False
+            while not finished:
+                batch = [await ready.get()]
+                # Submit everything staged since the last batch together.
+                while not ready.empty():
+                    batch.append(ready.get_nowait())
+                if None in batch:
+                    finished = True
+                    batch.remove(None)
+                if len(batch) > 0:
+                    await self.new_sqs_message(commands=commands,
+                                               files=batch,
+                                               bucket_name=bucket_name,
+                                               append=True, **submit_kwargs)
+            ctrl.njobs = len(ctrl.message_ids)
+            submitted.set()
+
+        main = [self._spawn(stage()), self._spawn(submit()),
+                self._spawn(self.receive_result(wait_time=wait_time,
+                                                until=submitted))]
+
+        background = []
+        if image_id is not None:
+            if autoscaler is not None:
+                background.append(
+                    self._spawn(self._scale_loop(image_id, autoscaler,
+                                                 interval, boot_kwargs)))
+            else:
+                await self.boot_instances(image_id, nworkers=nworkers,
+                                          **boot_kwargs)
+                background.append(
+                    self._spawn(self._health_loop(image_id, interval,
+                                                  boot_kwargs)))
+
+        await _supervise(main, background)
+
+        return main[-1].result()
+
+
+async def _supervise(main, background=()):
+    '''
+    Wait for the `main` tasks to finish, then cancel the `background` ones.
+    If any task fails, or this is cancelled, all of the tasks are cancelled
+    and waited on before the error is raised.
+    '''
+
+    tasks = list(main) + list(background)
+    try:
+        pending = set(tasks)
+        while not all(task.done() for task in main):
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    if task in main:
+                        raise asyncio.CancelledError()
+                elif task.exception() is not None:
+                    raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
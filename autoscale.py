@@ -0,0 +1,137 @@
+# License under the MIT License - see LICENSE
+
+'''
+Decide how many workers a run needs from the depth of the request queue.
+'''
+
+import math
+import time
+
+
+class Autoscaler(object):
+    '''
+    Size the worker fleet to drain the request queue within a target time.
+
+    The amount of work left is estimated from the number of jobs waiting
+    and running, times the average job duration. Enough workers are
+    launched to finish that work in `target_drain_time`, without exceeding
+    `max_instances` or the number of jobs left. Workers are only retired
+    once no jobs are waiting, and only as many as are idle. Cooldowns stop
+    the fleet size from flapping.
+
+    Parameters
+    ----------
+    max_instances : int
+        Largest number of workers to run.
+    target_drain_time : float, optional
+        Time, in seconds, to finish the queued jobs in.
+    job_duration : float, optional
+        Initial estimate of the time to run one job, in seconds. This is
+        updated from `record_job_duration`.
+    jobs_per_worker : int, optional
+        Number of jobs each worker runs at once (i.e., its job slots).
+    min_instances : int, optional
+        Smallest number of workers to keep.
+    scale_up_cooldown : float, optional
+        Seconds to wait after launching before launching more.
+    scale_down_cooldown : float, optional
+        Seconds to wait after any change before retiring workers.
+    smoothing : float, optional
+        Weight of each new duration in the moving average of job duration.
+    '''
+    def __init__(self, max_instances, target_drain_time=3600.,
+                 job_duration=600., jobs_per_worker=1, min_instances=0,
+                 scale_up_cooldown=120., scale_down_cooldown=600.,
+                 smoothing=0.2):
+        super(Autoscaler, self).__init__()
+
+        self.max_instances = max_instances
+        self.target_drain_time = target_drain_time
+        self.job_duration = job_duration
+        self.jobs_per_worker = jobs_per_worker
+        self.min_instances = min_instances
+        self.scale_up_cooldown = scale_up_cooldown
+        self.scale_down_cooldown = scale_down_cooldown
+        self.smoothing = smoothing
+
+        self._last_scale_up = None
+        self._last_scale_down = None
+
+    def record_job_duration(self, duration):
+        '''
+        Update the average job duration with a measured one.
+        '''
+        self.job_duration = (1 - self.smoothing) * self.job_duration + \
+            self.smoothing * duration
+
+    def desired_workers(self, nvisible, ninflight):
+        '''
+        Number of workers needed for the jobs waiting (`nvisible`) and
+        running (`ninflight`).
+        '''
+
+        njobs = nvisible + ninflight
+
+        work_time = njobs * self.job_duration
+        capacity = self.target_drain_time * self.jobs_per_worker
+
+        desired = int(math.ceil(work_time / float(capacity)))
+
+        # Extra workers past one per job would only sit idle.
+        desired = min(desired,
+                      int(math.ceil(njobs / float(self.jobs_per_worker))))
+
+        return max(self.min_instances, min(desired, self.max_instances))
+
+    def decide(self, nvisible, ninflight, nrunning, now=None):
+        '''
+        Return the change in the number of workers: positive to launch,
+        negative to retire, or zero.
+
+        Parameters
+        ----------
+        nvisible : int
+            Jobs waiting in the queue.
+        ninflight : int
+            Jobs received by a worker but not finished.
+        nrunning : int
+            Workers running or booting.
+        now : float, optional
+            Current time. Defaults to `time.time()`.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        desired = self.desired_workers(nvisible, ninflight)
+
+        if desired > nrunning:
+            if self._in_cooldown(self._last_scale_up, self.scale_up_cooldown,
+                                 now):
+                return 0
+            self._last_scale_up = now
+            return desired - nrunning
+
+        if desired < nrunning:
+            # Don't retire workers while there are jobs waiting for them.
+            if nvisible > 0:
+                return 0
+            if self._in_cooldown(self._last_scale_up,
+                                 self.scale_down_cooldown, now) or \
+                    self._in_cooldown(self._last_scale_down,
+                                      self.scale_down_cooldown, now):
+                return 0
+
+            busy = int(math.ceil(ninflight / float(self.jobs_per_worker)))
+            nretire = min(nrunning - desired, nrunning - busy)
+            if nretire <= 0:
+                return 0
+
+            self._last_scale_down = now
+            return -nretire
+
+        return 0
+
+    @staticmethod
+    def _in_cooldown(last_time, cooldown, now):
+        return last_time is not None and now - last_time < cooldown
@@ -0,0 +1,479 @@
+# License under the MIT License - see LICENSE
+
+'''
+Bake worker images with the code, CASA and Python packages already
+installed, so a new worker starts its first job without fetching or
+setting anything up. The images made are recorded locally, and
+`Controller.boot_instances` uses the newest one for the region by default.
+'''
+
+import json
+import os
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+
+from connections import get_ec2_connection
+from launch_instance import launch_many
+from utils import timestring
+
+
+DEFAULT_REGISTRY = os.path.expanduser("~/.aws_controller/images.json")
+
+# Base image to start from in each region. Ubuntu 14.04 in us-west-2, as
+# used by `launch_instance.launch`. Other regions need `base_image_id`.
+BASE_IMAGES = {'us-west-2': 'ami-5189a661'}
+
+CASA_URL = "https://casa.nrao.edu/download/distro/linux/release/el7/" \
+    "casa-release-{0}-el7.tar.gz"
+MINICONDA_URL = "https://repo.continuum.io/miniconda/" \
+    "Miniconda2-{0}-Linux-x86_64.sh"
+
+# Versions installed into the image. Pinning them means images baked at
+# different times run the same code.
+DEFAULT_VERSIONS = {"casa": "4.7.1",
+                    "miniconda": "4.5.4",
+                    "conda_packages": ["boto=2.48.0", "flask=1.0.2"],
+                    "pip_packages": ["filechunkio==1.8"],
+                    "casa_packages": ["astropy==1.3.3", "astroML==0.3",
+                                      "jdcal==1.3"]}
+
+# Marks the end of the bake in the builder's console output. The line after
+# BAKE_DONE is the JSON description of the image.
+BAKE_DONE = "AWS_CONTROLLER_BAKE_DONE"
+BAKE_FAILED = "AWS_CONTROLLER_BAKE_FAILED"
+
+# The worker scripts skip the `git pull` on images with this file.
+IMAGE_INFO_FILE = "aws_controller_image.json"
+
+
+BAKE_SCRIPT = """#!/bin/bash
+
+export HOME=/home/%(USER)s
+
+fail() {
+    echo "%(BAKE_FAILED)s line $1" | tee /dev/console
+    /sbin/shutdown now -h
+    exit 1
+}
+trap 'fail $LINENO' ERR
+set -e
+
+apt-get update
+apt-get install -y xorg openbox wget bzip2 ca-certificates git unzip
+
+sudo -u %(USER)s -H bash -e <<'END_OF_BAKE'
+cd $HOME
+
+# The code, at a fixed commit
+git clone %(REPO)s aws_controller
+git -C aws_controller checkout %(REF)s
+sed -i 's/git@github.com:/https:\\/\\/github.com\\//' \\
+    aws_controller/.gitmodules
+git -C aws_controller submodule update --init --recursive --force
+
+# CASA
+wget --quiet %(CASA_URL)s -O casa.tar.gz
+mkdir casa
+tar zxf casa.tar.gz -C casa --strip-components 1
+rm casa.tar.gz
+echo 'export PATH=$HOME/casa/bin:$PATH' >> $HOME/.profile
+export PATH=$HOME/casa/bin:$PATH
+
+# The first start of CASA sets up ~/.casa, so do it here rather than in
+# the first job.
+CASA="casa --nologger --nogui --log2term -c"
+echo | $CASA "import sys" > /dev/null
+$CASA "from setuptools.command import easy_install
+easy_install.main(['--user', 'pip'])" > /dev/null
+$CASA "import pip
+pip.main(['install', '--user'] + '%(CASA_PACKAGES)s'.split())" > /dev/null
+
+# Python for the worker
+wget --quiet %(MINICONDA_URL)s -O miniconda.sh
+bash miniconda.sh -b -p $HOME/miniconda2
+rm miniconda.sh
+echo 'export PATH=$HOME/miniconda2/bin:$PATH' >> $HOME/.profile
+$HOME/miniconda2/bin/conda install --yes %(CONDA_PACKAGES)s
+$HOME/miniconda2/bin/pip install %(PIP_PACKAGES)s
+
+# Warm the import caches: compile the code, and import the worker once so
+# the first job doesn't pay for it.
+$HOME/miniconda2/bin/python -m compileall -q $HOME/aws_controller
+$HOME/miniconda2/bin/python -c "import aws_controller.worker"
+
+mkdir -p data data_products
+
+# Describe the image, which also stops the worker scripts from updating
+# the code.
+cat > %(IMAGE_INFO_FILE)s <<'END_OF_INFO'
+%(INFO)s
+END_OF_INFO
+$HOME/miniconda2/bin/python -c "
+import json, subprocess
+info = json.load(open('%(IMAGE_INFO_FILE)s'))
+info['aws_controller_commit'] = subprocess.check_output(
+    ['git', '-C', 'aws_controller', 'rev-parse', 'HEAD']).strip().decode()
+info['conda_list'] = subprocess.check_output(
+    ['$HOME/miniconda2/bin/conda', 'list', '--export']).decode().split()
+json.dump(info, open('%(IMAGE_INFO_FILE)s', 'w'))
+"
+END_OF_BAKE
+
+apt-get clean
+rm -f /home/%(USER)s/.bash_history
+
+(echo "%(BAKE_DONE)s"; cat /home/%(USER)s/%(IMAGE_INFO_FILE)s; echo) \\
+    | tee /dev/console
+
+/sbin/shutdown now -h
+"""
+
+
+class ImageRegistry(object):
+    '''
+    Local record of the worker images baked in each region, stored as JSON,
+    along with the boot-to-first-message latency measured for each.
+
+    Parameters
+    ----------
+    filename : str, optional
+        File to keep the registry in. Defaults to
+        `~/.aws_controller/images.json`.
+    '''
+    def __init__(self, filename=None):
+        super(ImageRegistry, self).__init__()
+
+        self.filename = DEFAULT_REGISTRY if filename is None else filename
+
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def record(self, region, image_id, info):
+        '''
+        Record a new image for the region.
+        '''
+
+        entry = dict(info)
+        entry["image_id"] = image_id
+        entry.setdefault("boot_latencies", [])
+
+        with self._lock:
+            self.entries.setdefault(region, []).append(entry)
+
+    def latest(self, region):
+        '''
+        Return the ID of the newest image in the region, or None.
+        '''
+
+        with self._lock:
+            images = self.entries.get(region, [])
+            if len(images) == 0:
+                return None
+            return max(images, key=lambda entry: entry["created"])["image_id"]
+
+    def lookup(self, image_id):
+        '''
+        Return the entry for an image, or None if it is not recorded.
+        '''
+
+        with self._lock:
+            for images in self.entries.values():
+                for entry in images:
+                    if entry["image_id"] == image_id:
+                        return entry
+
+        return None
+
+    def record_boot_latency(self, image_id, latencies):
+        '''
+        Add measured boot-to-first-message latencies, in seconds, to a
+        recorded image. See `Controller.boot_latency`.
+        '''
+
+        entry = self.lookup(image_id)
+        if entry is None:
+            raise KeyError("{} is not a recorded image.".format(image_id))
+
+        with self._lock:
+            entry["boot_latencies"].extend(latencies)
+
+    def summary(self, region=None):
+        '''
+        Number of boots and mean boot-to-first-message latency of each
+        image, to compare images with.
+        '''
+
+        summary = {}
+        with self._lock:
+            for image_region, images in self.entries.items():
+                if region is not None and image_region != region:
+                    continue
+                for entry in images:
+                    latencies = entry.get("boot_latencies", [])
+                    summary[entry["image_id"]] = \
+                        {"name": entry.get("name"),
+                         "nboots": len(latencies),
+                         "mean_latency": sum(latencies) / len(latencies)
+                         if len(latencies) > 0 else None}
+
+        return summary
+
+    def save(self):
+        '''
+        Write the registry to disk. The file is replaced atomically.
+        '''
+
+        folder = os.path.dirname(self.filename)
+        if folder != "" and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        tmp_filename = self.filename + ".tmp"
+        with self._lock:
+            with open(tmp_filename, "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.rename(tmp_filename, self.filename)
+
+
+def bake_script(ref='master', versions=None, user='ubuntu',
+                repo="https://github.com/Astroua/aws_controller.git"):
+    '''
+    Fill in the user data script that sets up the builder instance.
+
+    Parameters
+    ----------
+    ref : str, optional
+        Commit, tag or branch of aws_controller to install. The commit it
+        resolves to is recorded with the image.
+    versions : dict, optional
+        Versions to install, updating `DEFAULT_VERSIONS`.
+    user : str, optional
+        User on the image to set up.
+    repo : str, optional
+        Repository to clone aws_controller from.
+    '''
+
+    pinned = dict(DEFAULT_VERSIONS)
+    if versions is not None:
+        pinned.update(versions)
+
+    info = {"aws_controller_ref": ref, "versions": pinned}
+
+    return BAKE_SCRIPT \
+        % {"USER": user,
+           "REPO": repo,
+           "REF": ref,
+           "CASA_URL": CASA_URL.format(pinned["casa"]),
+           "CASA_PACKAGES": " ".join(pinned["casa_packages"]),
+           "MINICONDA_URL": MINICONDA_URL.format(pinned["miniconda"]),
+           "CONDA_PACKAGES": " ".join(pinned["conda_packages"]),
+           "PIP_PACKAGES": " ".join(pinned["pip_packages"]),
+           "INFO": json.dumps(info),
+           "IMAGE_INFO_FILE": IMAGE_INFO_FILE,
+           "BAKE_DONE": BAKE_DONE,
+           "BAKE_FAILED": BAKE_FAILED}
+
+
+def parse_console(output):
+    '''
+    Find the result of the bake in the builder's console output. Returns
+    the image description, or raises an exception if the bake failed.
+    '''
+
+    if output is None:
+        output = ""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if BAKE_FAILED in line:
+            raise Exception("Baking the image failed:\n" +
+                            "\n".join(lines[max(0, i - 20):i + 1]))
+        if line.strip() == BAKE_DONE and i + 1 < len(lines):
+            try:
+                return json.loads(lines[i + 1])
+            except ValueError:
+                # The rest of the line isn't on the console yet.
+                return None
+
+    return None
+
+
+def wait_for_console(ec2, instance_id, timeout=900, poll_interval=30):
+    '''
+    Poll the builder's console output until the bake is reported done or
+    failed. Returns the image description, and raises an exception if the
+    bake failed or nothing is reported within `timeout` seconds.
+    '''
+
+    t0 = time.time()
+    while True:
+        try:
+            output = ec2.get_console_output(instance_id).output
+        except EC2ResponseError:
+            output = None
+
+        info = parse_console(output)
+        if info is not None:
+            return info
+
+        if time.time() - t0 > timeout:
+            raise Exception("The result of the bake did not show up in the "
+                            "console output of {}, so no image was made."
+                            .format(instance_id))
+        time.sleep(poll_interval)
+
+
+def bake_image(name, base_image_id=None, region='us-west-2',
+               ref='master', versions=None, user='ubuntu',
+               instance_type='t2.medium', key_name=None,
+               security_groups='launch-wizard-1', registry=None,
+               timeout=7200, console_timeout=900, poll_interval=30,
+               aws_access={}):
+    '''
+    Bake a worker image. A builder instance is launched from the base
+    image, installs everything as its user data and stops itself. The image
+    is then made from its root drive, and the builder is terminated.
+
+    The image is only made, and recorded, once the builder's console shows
+    that the bake finished. A failed bake, or one whose result never shows
+    up on the console, raises an exception instead.
+
+    Parameters
+    ----------
+    name : str
+        Name of the image. A timestamp is appended.
+    base_image_id : str, optional
+        Image to start from. Defaults to the entry for the region in
+        `BASE_IMAGES`.
+    region : str, optional
+        AWS region name.
+    ref : str, optional
+        Commit, tag or branch of aws_controller to install.
+    versions : dict, optional
+        Versions of CASA and the packages to install, updating
+        `DEFAULT_VERSIONS`.
+    user : str, optional
+        User on the base image.
+    instance_type : str, optional
+        EC2 instance type of the builder.
+    key_name : str, optional
+        Name of the key pair to allow ssh access to the builder with.
+    security_groups : str or list, optional
+        Security groups for the builder.
+    registry : ImageRegistry or str, optional
+        Registry to record the image in. Defaults to
+        `~/.aws_controller/images.json`.
+    timeout : float, optional
+        Seconds to wait for the builder, and then the image.
+    console_timeout : float, optional
+        Seconds to wait, once the builder has stopped, for the result of
+        the bake to show up in its console output, which can lag by
+        several minutes.
+    poll_interval : float, optional
+        Seconds between checks on the builder and the image.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Returns
+    -------
+    image_id : str
+        ID of the new image.
+    '''
+
+    if base_image_id is None:
+        if region not in BASE_IMAGES:
+            raise ValueError("No base image is known for {}. Give "
+                             "base_image_id.".format(region))
+        base_image_id = BASE_IMAGES[region]
+
+    if not isinstance(registry, ImageRegistry):
+        registry = ImageRegistry(registry)
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    t0 = time.time()
+
+    builder = launch_many(1, key_name=key_name, region=region,
+                          image_id=base_image_id,
+                          instance_type=instance_type,
+                          security_groups=security_groups,
+                          user_data=bake_script(ref, versions, user),
+                          aws_access=aws_access)[0]
+
+    try:
+        # The builder stops itself once it has finished.
+        while True:
+            try:
+                builder.update()
+            except EC2ResponseError:
+                # New instances may not be visible to the API straight away.
+                pass
+            if builder.state == "stopped":
+                break
+            if builder.state == "terminated":
+                raise Exception("The builder {} was terminated."
+                                .format(builder.id))
+            if time.time() - t0 > timeout:
+                raise Exception("Timed out waiting for the builder {}."
+                                .format(builder.id))
+            time.sleep(poll_interval)
+
+        info = wait_for_console(ec2, builder.id, timeout=console_timeout,
+                                poll_interval=poll_interval)
+
+        image_name = name + "_" + timestring()
+        image_id = ec2.create_image(builder.id, image_name,
+                                    description="aws_controller worker "
+                                    "with CASA " + info["versions"]["casa"])
+
+        while True:
+            try:
+                state = ec2.get_image(image_id).state
+            except EC2ResponseError:
+                state = "pending"
+            if state == "available":
+                break
+            if state == "failed":
+                raise Exception("Creating the image {} failed."
+                                .format(image_id))
+            if time.time() - t0 > timeout:
+                raise Exception("Timed out waiting for the image {}."
+                                .format(image_id))
+            time.sleep(poll_interval)
+
+        ec2.create_tags([image_id],
+                        {"aws_controller_ref":
+                         info.get("aws_controller_commit", ref),
+                         "casa_version": info["versions"]["casa"]})
+    finally:
+        builder.terminate()
+
+    info["name"] = image_name
+    info["base_image_id"] = base_image_id
+    info["created"] = time.time()
+    info["bake_time"] = info["created"] - t0
+
+    registry.record(region, image_id, info)
+    registry.save()
+
+    return image_id
+
+
+def latest_image(region='us-west-2', registry=None):
+    '''
+    Return the ID of the newest image baked for the region, or None.
+    '''
+
+    if not isinstance(registry, ImageRegistry):
+        registry = ImageRegistry(registry)
+
+    return registry.latest(region)
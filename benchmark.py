@@ -0,0 +1,541 @@
+# License under the MIT License - see LICENSE
+
+'''
+Throughput benchmarks for the S3 transfers and SQS messaging, run against a
+local S3 stand-in (e.g., `moto_server -p 5000`) rather than AWS. SQS uses a
+minimal in-process queue unless an endpoint (e.g., ElasticMQ) is given, in
+which case the rates measured include the network round trips.
+
+The results are written as JSON, and can be compared against a previous run
+to catch regressions:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json --tolerance 0.2
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import uuid
+
+import boto
+from boto.regioninfo import RegionInfo
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.sqs.connection import SQSConnection
+
+from connections import set_connection, new_bucket, get_queue, \
+    forget_queue, encode_message_body
+from controller import Controller
+from upload_download_s3 import upload_to_s3, auto_multipart_upload, \
+    download_from_s3, remove_s3_bucket
+from utils import monotonic, timestring
+
+
+MB = 1048576
+
+# Benchmarks of the SQS messaging. The others are of S3.
+SQS_BENCHMARKS = ["new_sqs_message", "receive_result"]
+
+CREDENTIALS = {"aws_access_key_id": "benchmark",
+               "aws_secret_access_key": "benchmark"}
+
+
+class LocalMessage(object):
+    '''
+    Message of a `LocalQueue`.
+    '''
+    def __init__(self, queue=None, body=""):
+        self.queue = queue
+        self.body = body
+        self.id = str(uuid.uuid4())
+        self.receipt_handle = self.id
+        self.visible_at = 0.
+
+    def get_body(self):
+        return self.body
+
+    def change_visibility(self, visibility_timeout):
+        self.visible_at = monotonic() + visibility_timeout
+
+
+class LocalBatchResults(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+
+class LocalQueue(object):
+    '''
+    In-process stand-in for the parts of a boto SQS queue used by the
+    Controller and Worker.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._messages = []
+        self._lock = threading.Lock()
+
+    def new_message(self, body=""):
+        return LocalMessage(self, body)
+
+    def write(self, message):
+        with self._lock:
+            message.queue = self
+            self._messages.append(message)
+        return message
+
+    def write_batch(self, entries):
+        response = LocalBatchResults()
+        with self._lock:
+            for entry_id, body, _ in entries:
+                message = LocalMessage(self, body)
+                self._messages.append(message)
+                response.results.append({"id": entry_id,
+                                         "message_id": message.id})
+        return response
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     wait_time_seconds=None, **kwargs):
+        messages = []
+        with self._lock:
+            now = monotonic()
+            for message in self._messages:
+                if len(messages) == num_messages:
+                    break
+                if message.visible_at <= now:
+                    message.visible_at = now + (visibility_timeout or 30)
+                    messages.append(message)
+        return messages
+
+    def read(self, visibility_timeout=None, wait_time_seconds=None):
+        messages = self.get_messages(1, visibility_timeout)
+        return messages[0] if len(messages) > 0 else None
+
+    def delete_message(self, message):
+        with self._lock:
+            if message in self._messages:
+                self._messages.remove(message)
+                return True
+        return False
+
+    def delete_message_batch(self, messages):
+        response = LocalBatchResults()
+        ids = set(message.id for message in messages)
+        with self._lock:
+            self._messages = [message for message in self._messages
+                              if message.id not in ids]
+        response.results = [{"id": message.id} for message in messages]
+        return response
+
+    def count(self):
+        return len(self._messages)
+
+    def purge(self):
+        with self._lock:
+            self._messages = []
+
+    def get_attributes(self, attributes="All"):
+        now = monotonic()
+        with self._lock:
+            visible = len([message for message in self._messages
+                           if message.visible_at <= now])
+            total = len(self._messages)
+        return {"ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(total - visible)}
+
+    def delete(self):
+        with self._lock:
+            self._messages = []
+
+
+class LocalSQSConnection(object):
+    '''
+    In-process stand-in for a boto SQS connection, holding `LocalQueue`s.
+    '''
+    def __init__(self):
+        self._queues = {}
+
+    def create_queue(self, queue_name, visibility_timeout=None):
+        return self._queues.setdefault(queue_name, LocalQueue(queue_name))
+
+    def get_queue(self, queue_name):
+        return self._queues.get(queue_name)
+
+    def close(self):
+        pass
+
+
+def time_call(func, repeat=3, setup=None):
+    '''
+    Run `func` `repeat` times, calling `setup` (untimed) before each run.
+    Return the times taken, in seconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = monotonic()
+        func()
+        times.append(monotonic() - t0)
+    return times
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return 0.5 * (values[mid - 1] + values[mid])
+
+
+def _result(benchmark, times, nbytes=None, count=None, **params):
+    '''
+    Summarize the times of one benchmark case. Rates use the median time.
+    '''
+    seconds = _median(times)
+    result = {"benchmark": benchmark, "params": params,
+              "seconds": seconds, "all_seconds": times}
+    if nbytes is not None:
+        result["bytes"] = nbytes
+        result["mb_per_s"] = nbytes / float(MB) / seconds if seconds > 0 \
+            else None
+    if count is not None:
+        result["count"] = count
+        result["per_s"] = count / seconds if seconds > 0 else None
+    return result
+
+
+def make_file(folder, size):
+    '''
+    Write a file of `size` random bytes.
+    '''
+    filename = os.path.join(folder, "bench_{}.bin".format(size))
+    with open(filename, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            block = min(remaining, MB)
+            f.write(os.urandom(block))
+            remaining -= block
+    return filename
+
+
+def benchmark_s3(conn, sizes, chunk_sizes, workers, repeat=3,
+                 work_dir=None, autotune=(False,)):
+    '''
+    Measure the throughput of `upload_to_s3`, `auto_multipart_upload` and
+    `download_from_s3` for each file size, part (or range) size and number
+    of workers.
+
+    Parameters
+    ----------
+    conn : boto.s3.connection.S3Connection
+        Connection to the S3 stand-in.
+    sizes : list
+        File sizes in bytes.
+    chunk_sizes : list
+        Part sizes of the multi-part uploads, and range sizes of the
+        downloads, in bytes. Must be at least 5 Mb.
+    workers : list
+        Numbers of workers.
+    repeat : int, optional
+        Number of times to run each case.
+    work_dir : str, optional
+        Folder to write the test files in. Defaults to a temporary folder.
+    autotune : tuple, optional
+        Run the multi-part upload and download cases with each of these
+        `autotune` settings.
+
+    Returns
+    -------
+    results : list
+        The result of each case.
+    '''
+
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    bucket_name = "aws-controller-benchmark-" + timestring()
+    bucket = new_bucket(conn, bucket_name)
+
+    results = []
+    try:
+        for size in sizes:
+            filename = make_file(tmp_dir, size)
+            key_name = os.path.basename(filename)
+
+            for num_workers in workers:
+                times = time_call(
+                    lambda: upload_to_s3(bucket_name, filename, conn=conn,
+                                         replace=True,
+                                         num_workers=num_workers),
+                    repeat=repeat)
+                results.append(_result("upload_to_s3", times, nbytes=size,
+                                       size=size, num_workers=num_workers))
+
+                for chunk_size in chunk_sizes:
+                    for tune in autotune:
+                        # A max_size of 0 always uses a multi-part upload.
+                        times = time_call(
+                            lambda: auto_multipart_upload(
+                                filename, bucket, key_name, max_size=0,
+                                chunk_size=chunk_size, replace=True,
+                                num_workers=num_workers, autotune=tune),
+                            repeat=repeat)
+                        results.append(_result("auto_multipart_upload",
+                                               times, nbytes=size, size=size,
+                                               chunk_size=chunk_size,
+                                               num_workers=num_workers,
+                                               autotune=tune))
+
+            out_dir = os.path.join(tmp_dir, "download")
+            os.mkdir(out_dir)
+            for num_workers in workers:
+                for chunk_size in chunk_sizes:
+                    for tune in autotune:
+                        times = time_call(
+                            lambda: download_from_s3(
+                                key_name, bucket_name, conn=conn,
+                                output_dir=out_dir, num_workers=num_workers,
+                                range_size=chunk_size,
+                                range_threshold=chunk_size, autotune=tune),
+                            repeat=repeat)
+                        results.append(_result("download_from_s3", times,
+                                               nbytes=size, size=size,
+                                               chunk_size=chunk_size,
+                                               num_workers=num_workers,
+                                               autotune=tune))
+            shutil.rmtree(out_dir)
+            os.remove(filename)
+    finally:
+        shutil.rmtree(tmp_dir)
+        remove_s3_bucket(bucket_name, conn)
+
+    return results
+
+
+def benchmark_sqs(nmessages, workers, repeat=3, region="us-west-2",
+                  work_dir=None):
+    '''
+    Measure the rate the Controller submits jobs (`new_sqs_message`) and
+    collects results (`receive_result`) at, using the SQS connection
+    registered for `region`.
+
+    Parameters
+    ----------
+    nmessages : int
+        Number of messages to send and receive in each run.
+    workers : list
+        Numbers of batches to send at once.
+    repeat : int, optional
+        Number of times to run each case.
+    region : str, optional
+        Region the SQS connection is registered for.
+    work_dir : str, optional
+        Folder to write the result log in. Defaults to a temporary folder.
+
+    Returns
+    -------
+    results : list
+        The result of each case.
+    '''
+
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+
+    files = ["bench_{}.ms".format(i) for i in range(nmessages)]
+    params = {"njobs": nmessages, "files": files,
+              "commands": ["echo benchmark"]}
+
+    controller = Controller(params, run_name="benchmark", region=region,
+                            key=CREDENTIALS["aws_access_key_id"],
+                            secret=CREDENTIALS["aws_secret_access_key"])
+    controller.result_log = os.path.join(tmp_dir, "results.jsonl")
+
+    nqueues = [0]
+
+    def new_request_queue():
+        # SQS allows one purge a minute, and a deleted queue's name can't
+        # be reused for a minute, so each run gets a new queue.
+        old_queue = controller.request_queue
+        nqueues[0] += 1
+        controller.request_queue = \
+            get_queue(controller.sqs_connection,
+                      "{0}_request_{1}".format(controller.job_name,
+                                               nqueues[0]))
+        old_queue.delete()
+        forget_queue(old_queue.name)
+
+    results = []
+    try:
+        for num_workers in workers:
+            times = time_call(
+                lambda: controller.new_sqs_message(num_workers=num_workers),
+                setup=new_request_queue,
+                repeat=repeat)
+            results.append(_result("new_sqs_message", times,
+                                   count=nmessages, num_workers=num_workers))
+
+        bodies = [json.dumps({"proc_name": "benchmark_{}".format(i),
+                              "success": True,
+                              "messages": {}}) for i in range(nmessages)]
+
+        def fill_results():
+            queue = controller.result_queue
+            controller.finished_jobs = set()
+            controller.njobs = nmessages
+            for start in range(0, nmessages, 10):
+                end = min(start + 10, nmessages)
+                entries = [(str(i), encode_message_body(queue, bodies[i]), 0)
+                           for i in range(start, end)]
+                queue.write_batch(entries)
+
+        times = time_call(lambda: controller.receive_result(wait_time=1),
+                          setup=fill_results, repeat=repeat)
+        results.append(_result("receive_result", times, count=nmessages))
+    finally:
+        controller.request_queue.delete()
+        controller.result_queue.delete()
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    '''
+    Compare the median times of matching cases against a baseline.
+
+    Cases are only compared when the baseline used the same stand-in for
+    their service. For example, rates through the in-process queue mostly
+    measure the Controller, and are far faster than through an SQS
+    endpoint, so the two are not compared.
+
+    Returns
+    -------
+    regressions : list
+        The cases that are slower than the baseline by more than
+        `tolerance` (as a fraction).
+    '''
+
+    def case_key(result):
+        return (result["benchmark"],
+                json.dumps(result["params"], sort_keys=True))
+
+    def endpoint(output, result):
+        service = "sqs" if result["benchmark"] in SQS_BENCHMARKS else "s3"
+        return output.get("meta", {}).get(service + "_endpoint")
+
+    base_times = dict((case_key(result), result["seconds"])
+                      for result in baseline["results"])
+
+    regressions = []
+    for result in results["results"]:
+        if endpoint(results, result) != endpoint(baseline, result):
+            continue
+        base = base_times.get(case_key(result))
+        if base is None or base <= 0:
+            continue
+        change = result["seconds"] / base - 1.
+        if change > tolerance:
+            regressions.append({"benchmark": result["benchmark"],
+                                "params": result["params"],
+                                "seconds": result["seconds"],
+                                "baseline_seconds": base,
+                                "change": change})
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--s3-host", default="localhost",
+                        help="Host of the S3 stand-in.")
+    parser.add_argument("--s3-port", type=int, default=5000,
+                        help="Port of the S3 stand-in.")
+    parser.add_argument("--sqs-endpoint", default=None,
+                        help="host:port of an SQS stand-in. Defaults to an "
+                        "in-process queue.")
+    parser.add_argument("--sizes", type=float, nargs="+",
+                        default=[1, 16, 64], help="File sizes in Mb.")
+    parser.add_argument("--chunk-sizes", type=float, nargs="+",
+                        default=[5, 16], help="Part and range sizes in Mb.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                        help="Numbers of workers.")
+    parser.add_argument("--messages", type=int, default=1000,
+                        help="Number of SQS messages per run.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each case.")
+    parser.add_argument("--autotune", action="store_true",
+                        help="Also run the multi-part upload and download "
+                        "cases with autotune.")
+    parser.add_argument("--skip-s3", action="store_true")
+    parser.add_argument("--skip-sqs", action="store_true")
+    parser.add_argument("--output", default=None,
+                        help="JSON file for the results. Defaults to "
+                        "stdout.")
+    parser.add_argument("--compare", default=None,
+                        help="JSON results of a previous run to compare to."
+                        " Exits with 1 if any case regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slow down when comparing, as a "
+                        "fraction.")
+    args = parser.parse_args(args)
+
+    region = "us-west-2"
+
+    output = {"meta": {"time": timestring(),
+                       "python": platform.python_version(),
+                       "boto": boto.__version__,
+                       "platform": platform.platform(),
+                       "s3_endpoint": "{0}:{1}".format(args.s3_host,
+                                                       args.s3_port),
+                       "sqs_endpoint": args.sqs_endpoint or "in-process",
+                       "repeat": args.repeat},
+              "results": []}
+
+    if not args.skip_s3:
+        conn = S3Connection(host=args.s3_host, port=args.s3_port,
+                            is_secure=False,
+                            calling_format=OrdinaryCallingFormat(),
+                            **CREDENTIALS)
+        output["results"].extend(
+            benchmark_s3(conn, [int(size * MB) for size in args.sizes],
+                         [int(size * MB) for size in args.chunk_sizes],
+                         args.workers, repeat=args.repeat,
+                         autotune=(False, True) if args.autotune
+                         else (False,)))
+
+    if not args.skip_sqs:
+        if args.sqs_endpoint is None:
+            sqs_conn = LocalSQSConnection()
+        else:
+            host, port = args.sqs_endpoint.rsplit(":", 1)
+            sqs_conn = SQSConnection(region=RegionInfo(name=region,
+                                                       endpoint=host),
+                                     port=int(port), is_secure=False,
+                                     **CREDENTIALS)
+        set_connection("sqs", sqs_conn, region=region,
+                       aws_access=CREDENTIALS)
+        output["results"].extend(
+            benchmark_sqs(args.messages, args.workers, repeat=args.repeat,
+                          region=region))
+
+    status = 0
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        output["regressions"] = compare_results(output, baseline,
+                                                tolerance=args.tolerance)
+        if len(output["regressions"]) > 0:
+            status = 1
+
+    if args.output is None:
+        print(json.dumps(output, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
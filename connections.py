@@ -0,0 +1,400 @@
+# License under the MIT License - see LICENSE
+
+'''
+Per-thread cache of connections to S3, SQS and EC2, along with the bucket
+and queue handles opened through them. Re-using these avoids a new TLS
+handshake and extra lookups (e.g., listing all buckets, or creating a queue
+that already exists) for every operation.
+
+boto connections are not safe to use from several threads at once, so each
+thread (e.g., each worker of a ThreadPool) opens its own. Handles opened in
+another thread are moved onto the current thread's connection with the
+`thread_*` functions. The connections of a thread are dropped along with
+it.
+'''
+
+import copy
+import threading
+import weakref
+
+from boto import sqs, ec2
+from boto.connection import AWSAuthConnection
+from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
+
+
+_lock = threading.RLock()
+# Connections given with `set_connection`, shared by all threads.
+_connections = {}
+# Every connection opened, to close them all in `clear_connections`.
+_opened = weakref.WeakSet()
+# Bumped to make every thread drop its cached connections and handles.
+_generations = {"connections": 0}
+# Buckets and queues forgotten, in order, as ("buckets", name) or
+# ("queues", name). Each thread drops its handles to those added since it
+# last looked.
+_forgotten = []
+_local = threading.local()
+
+
+def _cache(name):
+    '''
+    Return the current thread's cache of connections, buckets or queues.
+    '''
+
+    generations = dict(_generations)
+    if getattr(_local, "generations", None) != generations:
+        _local.connections = {}
+        _local.copies = {}
+        _local.buckets = {}
+        _local.queues = {}
+        _local.generations = generations
+        _local.nforgotten = len(_forgotten)
+
+    if _local.nforgotten < len(_forgotten):
+        with _lock:
+            forgotten = _forgotten[_local.nforgotten:]
+            _local.nforgotten = len(_forgotten)
+        for cache_name, handle_name in forgotten:
+            cache = getattr(_local, cache_name)
+            for key in list(cache.keys()):
+                # Queues are cached by name, or by URL when moved from
+                # another thread.
+                if key[1] == handle_name or \
+                        (cache_name == "queues" and
+                         key[1].endswith("/" + handle_name)):
+                    del cache[key]
+
+    return getattr(_local, name)
+
+
+def _get_connection(cache_key, connect):
+    '''
+    Return the connection for `cache_key` given with `set_connection`, or
+    this thread's own, opened with `connect()` if needed.
+    '''
+
+    with _lock:
+        if cache_key in _connections:
+            return _connections[cache_key]
+
+    connections = _cache("connections")
+    if cache_key not in connections:
+        conn = connect()
+        connections[cache_key] = conn
+        _cache("copies")[id(conn)] = (conn, conn)
+        with _lock:
+            _opened.add(conn)
+    return connections[cache_key]
+
+
+def thread_connection(conn):
+    '''
+    Return the current thread's copy of a boto connection, with its own
+    HTTP connections, so a connection opened in one thread can be used
+    from the workers of a ThreadPool. Other objects (e.g., stand-ins for
+    testing) are returned as they are.
+    '''
+
+    if not isinstance(conn, AWSAuthConnection):
+        return conn
+
+    copies = _cache("copies")
+    entry = copies.get(id(conn))
+    if entry is None or entry[0] is not conn:
+        own = copy.copy(conn)
+        # The pool holds the HTTP connections, and the last response is
+        # per request.
+        own._pool = conn._pool.__class__()
+        own._last_rs = None
+        entry = (conn, own)
+        copies[id(conn)] = entry
+        copies[id(own)] = (own, own)
+        with _lock:
+            _opened.add(own)
+    return entry[1]
+
+
+def thread_bucket(bucket):
+    '''
+    Return a handle to a bucket that uses the current thread's connection.
+    See `thread_connection`.
+    '''
+
+    conn = thread_connection(bucket.connection)
+    if conn is bucket.connection:
+        return bucket
+
+    buckets = _cache("buckets")
+    if (conn, bucket.name) not in buckets:
+        # The bucket is known to exist, so it isn't looked up again.
+        buckets[(conn, bucket.name)] = conn.bucket_class(conn, bucket.name)
+    return buckets[(conn, bucket.name)]
+
+
+def thread_multipart(mp):
+    '''
+    Return a handle to a multi-part upload that uses the current thread's
+    connection. See `thread_connection`.
+    '''
+
+    bucket = thread_bucket(mp.bucket)
+    if bucket is mp.bucket:
+        return mp
+
+    own = MultiPartUpload(bucket)
+    own.key_name = mp.key_name
+    own.id = mp.id
+    return own
+
+
+def thread_queue(queue):
+    '''
+    Return a handle to a queue that uses the current thread's connection.
+    See `thread_connection`.
+    '''
+
+    conn = thread_connection(getattr(queue, "connection", None))
+    if conn is None or conn is queue.connection:
+        return queue
+
+    queues = _cache("queues")
+    if (conn, queue.url) not in queues:
+        queues[(conn, queue.url)] = queue.__class__(conn, queue.url,
+                                                    queue.message_class)
+    return queues[(conn, queue.url)]
+
+
+def _access_key(aws_access):
+    '''
+    Check the credentials given and return a hashable version of them to key
+    the cache on.
+    '''
+
+    if len(aws_access.keys()) > 0:
+        if "aws_access_key_id" not in aws_access.keys() or \
+                "aws_secret_access_key" not in aws_access.keys():
+            raise KeyError("aws_access must contain 'aws_access_key_id'"
+                           " and 'aws_secret_access_key'. All other"
+                           " entries are ignored.")
+
+    return tuple(sorted(aws_access.items()))
+
+
+def get_s3_connection(aws_access={}):
+    '''
+    Return this thread's S3 connection, optionally given the key and
+    secret.
+
+    Parameters
+    ----------
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'. Any other entries (e.g., `host` and `port`
+        for a local S3 stand-in) are passed to the connection. The AWS keys
+        saved on your machine are used when empty.
+
+    Returns
+    -------
+    conn : boto.s3.connection.S3Connection
+        Connection to S3.
+    '''
+
+    return _get_connection(("s3", None, _access_key(aws_access)),
+                           lambda: S3Connection(**aws_access))
+
+
+def get_sqs_connection(region, aws_access={}):
+    '''
+    Return this thread's SQS connection to the given region.
+
+    Parameters
+    ----------
+    region : str
+        AWS region name.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Returns
+    -------
+    conn : boto.sqs.connection.SQSConnection
+        Connection to SQS.
+    '''
+
+    return _get_connection(("sqs", region, _access_key(aws_access)),
+                           lambda: sqs.connect_to_region(region,
+                                                         **aws_access))
+
+
+def get_ec2_connection(region, aws_access={}):
+    '''
+    Return this thread's EC2 connection to the given region.
+
+    Parameters
+    ----------
+    region : str
+        AWS region name.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Returns
+    -------
+    conn : boto.ec2.connection.EC2Connection
+        Connection to EC2.
+    '''
+
+    return _get_connection(("ec2", region, _access_key(aws_access)),
+                           lambda: ec2.connect_to_region(region,
+                                                         **aws_access))
+
+
+def set_connection(service, conn, region=None, aws_access={}):
+    '''
+    Use an existing connection for a service (e.g., one to a local S3 or
+    SQS stand-in), in place of the one `get_*_connection` would open. It
+    is shared by all threads.
+
+    Parameters
+    ----------
+    service : {'s3', 'sqs', 'ec2'}
+        Service the connection is for.
+    conn : boto connection
+        The connection to use.
+    region : str, optional
+        AWS region name. Not used for S3.
+    aws_access : dict, optional
+        Credentials the connection is looked up with.
+    '''
+
+    if service == "s3":
+        region = None
+
+    with _lock:
+        _connections[(service, region, _access_key(aws_access))] = conn
+
+
+def thread_message(message):
+    '''
+    Return a handle to a received message that uses the current thread's
+    connection. See `thread_connection`.
+    '''
+
+    queue = thread_queue(message.queue)
+    if queue is message.queue:
+        return message
+
+    own = copy.copy(message)
+    own.queue = queue
+    return own
+
+
+def encode_message_body(queue, body):
+    '''
+    Return a message body as the queue's message class writes it, e.g.
+    base64-encoded for boto's default `Message`. Bodies sent with
+    `Queue.write_batch` are not encoded by boto, so they are encoded here
+    to be read back like those sent with `Queue.write`. Stand-ins whose
+    messages have no encoding are given the body as it is.
+    '''
+
+    message = queue.new_message(body=body)
+    if hasattr(message, "get_body_encoded"):
+        return message.get_body_encoded()
+    return body
+
+
+def get_bucket(conn, bucket_name):
+    '''
+    Return this thread's cached handle to an existing bucket.
+
+    Parameters
+    ----------
+    conn : boto.s3.connection.S3Connection
+        Connection to S3.
+    bucket_name : str
+        Name of the bucket.
+
+    Returns
+    -------
+    bucket : boto.s3.bucket.Bucket
+        The bucket.
+    '''
+
+    buckets = _cache("buckets")
+    if (conn, bucket_name) not in buckets:
+        buckets[(conn, bucket_name)] = conn.get_bucket(bucket_name)
+    return buckets[(conn, bucket_name)]
+
+
+def new_bucket(conn, bucket_name):
+    '''
+    Create a new bucket and cache the handle to it.
+    '''
+
+    bucket = conn.create_bucket(bucket_name)
+    _cache("buckets")[(conn, bucket_name)] = bucket
+    return bucket
+
+
+def get_queue(conn, queue_name):
+    '''
+    Return this thread's cached handle to a queue. The queue is created if
+    it does not exist.
+
+    Parameters
+    ----------
+    conn : boto.sqs.connection.SQSConnection
+        Connection to SQS.
+    queue_name : str
+        Name of the queue.
+
+    Returns
+    -------
+    queue : boto.sqs.queue.Queue
+        The queue.
+    '''
+
+    queues = _cache("queues")
+    if (conn, queue_name) not in queues:
+        queues[(conn, queue_name)] = conn.create_queue(queue_name)
+    return queues[(conn, queue_name)]
+
+
+def forget_bucket(bucket_name):
+    '''
+    Drop the cached handles to a bucket (e.g., after deleting it). Each
+    thread drops its own the next time it uses the cache. Handles to other
+    buckets and queues are kept.
+    '''
+
+    with _lock:
+        _forgotten.append(("buckets", bucket_name))
+
+
+def forget_queue(queue_name):
+    '''
+    Drop the cached handles to a queue (e.g., after deleting it). Each
+    thread drops its own the next time it uses the cache. Handles to other
+    buckets and queues are kept.
+    '''
+
+    with _lock:
+        _forgotten.append(("queues", queue_name))
+
+
+def clear_connections():
+    '''
+    Close and drop all of the cached connections and handles.
+    '''
+
+    with _lock:
+        for conn in list(_opened) + list(_connections.values()):
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _opened.clear()
+        _connections.clear()
+        _generations["connections"] += 1
@@ -4,21 +4,59 @@ Control the whole thing.
 '''
 
 import boto
+from boto.exception import EC2ResponseError
 import json
+import os
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import traceback as tr
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
-from utils import timestring
-from upload_download_s3 import download_from_s3, upload_to_s3
+from utils import timestring, path_size
+from upload_download_s3 import download_from_s3, upload_to_s3, \
+    return_s3_connection
+from connections import get_sqs_connection, get_queue, new_bucket, \
+    get_ec2_connection, get_bucket, thread_queue, encode_message_body
+from launch_instance import launch_many, iter_ready_instances
+from autoscale import Autoscaler
+from result_store import ResultStore
+from bake_image import latest_image
+from spot import get_spot_prices, select_instance_type, \
+    request_spot_workers, iter_spot_instances
+from worker import DRAIN_TAG
 
 
+# SQS limits a message to 256 Kb. Messages are base64-encoded when sent,
+# which adds a third to their size, so work units are kept below 3/4 of the
+# limit, allowing for the fields of the unit itself.
+MAX_MESSAGE_SIZE = 262144
+MAX_UNIT_SIZE = MAX_MESSAGE_SIZE * 3 // 4
+UNIT_OVERHEAD = 1024
+# A batch of messages is limited to 10 messages and 256 Kb in total.
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_SIZE = 262144
+
+# New instances may not be listed by the EC2 API straight away. Until this
+# many seconds after launch, they are kept as booting.
+LAUNCH_GRACE_PERIOD = 300
+
+# States of instances that have stopped, or are stopping.
+STOPPED_STATES = ["shutting-down", "terminated", "stopping", "stopped"]
+
 WORKER_SCRIPT = """#!/bin/bash
 
 export HOME=/home/%(USER)s
 
 cd $HOME
 
-cd aws_controller
-/usr/bin/git pull
-cd ..
+# Baked images (see bake_image.py) keep the code they were made with.
+if [ ! -e aws_controller_image.json ]; then
+    /usr/bin/git -C aws_controller pull
+fi
 
 %(CUSTOM_LINES)s
 
@@ -41,10 +79,106 @@ work.send_result_message('%(RESP_QUEUE_NAME)s')
 """
 
 
+WORKER_LOOP_SCRIPT = """#!/bin/bash
+
+export HOME=/home/%(USER)s
+
+cd $HOME
+
+# Baked images (see bake_image.py) keep the code they were made with.
+if [ ! -e aws_controller_image.json ]; then
+    /usr/bin/git -C aws_controller pull
+fi
+
+%(CUSTOM_LINES)s
+
+$HOME/miniconda2/bin/python -c "from aws_controller.worker import Worker
+
+work = Worker('%(QUEUE_NAME)s', '%(KEY)s', '%(SECRET)s', '%(REGION)s')
+
+work.run('%(RESP_QUEUE_NAME)s', idle_time=%(IDLE_TIME)s,
+         watch_interruptions=%(WATCH)s)
+"
+
+/sbin/shutdown now -h
+"""
+
+
+WORKER_SLOTS_SCRIPT = """#!/bin/bash
+
+export HOME=/home/%(USER)s
+
+cd $HOME
+
+# Baked images (see bake_image.py) keep the code they were made with.
+if [ ! -e aws_controller_image.json ]; then
+    /usr/bin/git -C aws_controller pull
+fi
+
+%(CUSTOM_LINES)s
+
+$HOME/miniconda2/bin/python -c "from aws_controller.worker import run_job_slots
+
+run_job_slots('%(QUEUE_NAME)s', '%(KEY)s', '%(SECRET)s',
+              '%(RESP_QUEUE_NAME)s', region='%(REGION)s',
+              nslots=%(NSLOTS)s, idle_time=%(IDLE_TIME)s,
+              watch_interruptions=%(WATCH)s)
+"
+
+/sbin/shutdown now -h
+"""
+
+
+def _instance_states(ec2, instance_ids):
+    '''
+    Return the state of each of the instances listed by the EC2 API, or
+    None if any of them is not found.
+    '''
+
+    if len(instance_ids) == 0:
+        return {}
+
+    try:
+        statuses = ec2.get_all_instance_status(instance_ids=instance_ids,
+                                               include_all_instances=True)
+    except EC2ResponseError as exc:
+        if exc.error_code != "InvalidInstanceID.NotFound":
+            raise
+        return None
+
+    return dict((status.id, status.state_name) for status in statuses)
+
+
+def _batches(entry_ids, bodies):
+    '''
+    Split the entries into batches SQS accepts: each batch holds at most
+    `MAX_BATCH_ENTRIES` messages, and at most `MAX_BATCH_SIZE` bytes of
+    them in total.
+    '''
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for entry_id in entry_ids:
+        size = len(bodies[entry_id])
+        if len(batch) == MAX_BATCH_ENTRIES or \
+                (len(batch) > 0 and batch_size + size > MAX_BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(entry_id)
+        batch_size += size
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
 class Controller(object):
     """docstring for Controller"""
     def __init__(self, params, run_name='CASA_Timing', region='us-west-2',
-                 key=None, secret=None, max_instances=10):
+                 key=None, secret=None, max_instances=10, result_store=None):
         super(Controller, self).__init__()
         self.params = params
 
@@ -57,67 +191,1204 @@ class Controller(object):
         self.credentials = {"aws_access_key_id": self.key,
                             "aws_secret_access_key": self.secret}
 
+        self.region = region
+
         self.job_name = run_name + "_" + timestring()
 
+        # Both queues are opened through the same connection. Each thread
+        # using them gets its own copy (see `request_queue`).
+        self.sqs_connection = get_sqs_connection(region, self.credentials)
+
         self.request_queue_name = self.job_name + "_request"
-        self.request_queue = \
-            boto.sqs.connect_to_region(region,
-                                       aws_access_key_id=self.key,
-                                       aws_secret_access_key=self.secret).create_queue(self.request_queue_name)
+        self._request_queue = get_queue(self.sqs_connection,
+                                        self.request_queue_name)
 
         self.result_queue_name = self.job_name + "_result"
-        self.result_queue = \
-            boto.sqs.connect_to_region(region,
-                                       aws_access_key_id=self.key,
-                                       aws_secret_access_key=self.secret).create_queue(self.result_queue_name)
+        self._result_queue = get_queue(self.sqs_connection,
+                                       self.result_queue_name)
+
+        self.instances = []
+        # When each worker was launched, to allow new ones time to show up
+        # in the EC2 API (see `update_instances`).
+        self.launch_times = {}
+
+        # The message ID of each submitted job, and the jobs in each work
+        # unit (see `new_packed_message`). Jobs whose messages could not be
+        # sent are kept with the error instead.
+        self.message_ids = {}
+        self.units = {}
+        self.unsent_jobs = {}
+
+        # Results collected so far. The proc_names guard against messages
+        # that SQS delivers more than once.
+        self.finished_jobs = set()
+        self.nfailed = 0
+        self.result_log = self.job_name + "_results.jsonl"
+        # Result messages that could not be read are kept here, since they
+        # are deleted from the queue.
+        self.rejected_log = self.job_name + "_rejected.jsonl"
+        self.nrejected = 0
 
+        # Optional indexed store the collected results are also added to.
+        if result_store is not None and \
+                not isinstance(result_store, ResultStore):
+            result_store = ResultStore(result_store)
+        self.result_store = result_store
 
-    def upload_request(self, data, bucket_name=None):
+        # When each worker last reported a result, and the durations of the
+        # recent jobs.
+        self.last_result_time = {}
+        self.job_durations = []
+        self.type_durations = {}
+
+        # The image and boot-to-first-message time of each worker.
+        self.boot_latencies = {}
+
+        # The type and number of job slots of each worker.
+        self.instance_slots = {}
+
+        # Spot requests placed but not yet fulfilled.
+        self.spot_requests = []
+
+        # Workers asked to drain before being retired, and those that have
+        # finished their jobs and can be terminated.
+        self.draining = set()
+        self.drained = set()
+        # Workers that reported stopping on their own (idle or drained),
+        # rather than being lost.
+        self.stopped_instances = set()
+
+        # Guards job_durations, which results are added to while the
+        # autoscaler takes them.
+        self._durations_lock = threading.Lock()
+
+
+    def upload_request(self, data, bucket_name=None, num_workers=1,
+                       block=True, **upload_kwargs):
         '''
         Upload any given data to S3.
+
+        With `num_workers` > 1, the items are uploaded concurrently and the
+        remaining items are still uploaded when one fails. The status, size,
+        duration and throughput of each item are kept in `track_uploaded`.
+
+        Parameters
+        ----------
+        data : str or list
+            Files or folders to upload.
+        bucket_name : str, optional
+            Existing bucket to upload to. Otherwise, a bucket named after the
+            job is created.
+        num_workers : int, optional
+            Number of items to upload at once.
+        block : bool, optional
+            Wait for all of the uploads to finish. Otherwise, an
+            `UploadHandle` is returned immediately.
+        upload_kwargs : passed to `upload_to_s3`.
+
+        Returns
+        -------
+        success : bool or UploadHandle
+            Whether all items were uploaded, or a handle to the running
+            uploads when `block` is False.
         '''
 
-        if bucket_name is not None:
-            create_bucket = False
-        else:
-            bucket_name = self.job_name
-            create_bucket = True
+        bucket_name = self._staging_bucket(bucket_name)
 
         if not isinstance(data, list):
             data = [data]
 
-        self._track_uploaded = dict.fromkeys(data)
+        self._start_tracking(data)
+
+        upload_kwargs["aws_access"] = self.credentials
+
+        if num_workers == 1 and block:
+            for dat in data:
+                self._upload_item(dat, bucket_name, upload_kwargs)
+                if self._track_uploaded[dat]["status"] != "Success":
+                    return False
+            return True
+
+        handle = UploadHandle(data, self._track_uploaded, num_workers,
+                              self._upload_item, (bucket_name, upload_kwargs))
+
+        if block:
+            return handle.wait()
+
+        return handle
+
+    def _staging_bucket(self, bucket_name=None):
+        '''
+        Return the bucket to upload to. With no name given, a bucket named
+        after the job is created if it does not exist.
+        '''
+
+        if bucket_name is None:
+            bucket_name = self.job_name
+            # Create the bucket once, rather than for each item.
+            conn = return_s3_connection(self.credentials)
+            if conn.lookup(bucket_name) is None:
+                new_bucket(conn, bucket_name)
+
+        return bucket_name
 
+    def _start_tracking(self, data):
+        self._track_uploaded = {}
         for dat in data:
-            try:
-                upload_to_s3(bucket_name, dat, create_bucket=create_bucket,
-                             aws_access=self.credentials)
-                self._track_uploaded[dat] = "Success"
-            except Exception as e:
-                self._track_uploaded[dat] = "Failed with: " + e
-                return False
+            self._track_uploaded[dat] = {"status": "Pending", "bytes": None,
+                                         "duration": None,
+                                         "throughput": None}
+
+    def _upload_item(self, dat, bucket_name, upload_kwargs):
+        '''
+        Upload a single item and record how it went in `track_uploaded`.
+        '''
+
+        record = self._track_uploaded[dat]
+        record["status"] = "Uploading"
+
+        t0 = time.time()
+        try:
+            record["bytes"] = path_size(dat)
+            upload_to_s3(bucket_name, dat, create_bucket=False,
+                         **upload_kwargs)
+            record["status"] = "Success"
+        except Exception:
+            record["status"] = "Failed"
+            record["error"] = tr.format_exc()
+
+        record["duration"] = time.time() - t0
+        if record["status"] == "Success" and record["duration"] > 0:
+            record["throughput"] = record["bytes"] / record["duration"]
 
-        return True
+        return dat
 
     @property
     def track_uploaded(self):
         return self._track_uploaded
 
+    @property
+    def request_queue(self):
+        return thread_queue(self._request_queue)
 
-    def new_sqs_message(self):
-        pass
+    @request_queue.setter
+    def request_queue(self, queue):
+        self._request_queue = queue
+        self.request_queue_name = queue.name
 
-    def boot_instances(self, **kwargs):
-        pass
+    @property
+    def result_queue(self):
+        return thread_queue(self._result_queue)
+
+    @result_queue.setter
+    def result_queue(self, queue):
+        self._result_queue = queue
+        self.result_queue_name = queue.name
+
+    def new_sqs_message(self, commands=None, files=None, bucket_name=None,
+                        parameters="", num_workers=4, max_retries=3,
+                        append=False):
+        '''
+        Submit one job per data file to the request queue. Messages are sent
+        in batches of 10, with several batches sent at once. Messages that
+        fail within a batch are retried. Jobs that still could not be sent
+        are kept in `unsent_jobs` with the error, and the other jobs are
+        still submitted.
+
+        Each job's results are uploaded under `data_products/<proc_name>/`
+        in the bucket. `njobs` is set to the number of jobs submitted.
+        With `append`, the jobs are added to those already submitted, so
+        jobs can be submitted as their data is staged.
+
+        Parameters
+        ----------
+        commands : list, optional
+            Commands to run for each job. Defaults to `params['commands']`.
+        files : list, optional
+            Data files to make jobs for. Defaults to `params['files']`. The
+            key names are the file or folder names, as given by
+            `upload_request`.
+        bucket_name : str, optional
+            Bucket holding the data. Defaults to the job name.
+        parameters : str, optional
+            Parameters to include in each message.
+        num_workers : int, optional
+            Number of batches to send at once.
+        max_retries : int, optional
+            Number of times to retry messages that failed to send.
+        append : bool, optional
+            Add to the jobs already submitted. The job numbers continue on
+            from theirs.
+
+        Returns
+        -------
+        message_ids : dict
+            The message ID of each job, keyed by the job's proc_name.
+        '''
+
+        if commands is None:
+            commands = self.params['commands']
+        if files is None:
+            files = self.data_files
+        if bucket_name is None:
+            bucket_name = self.job_name
+
+        if not isinstance(files, list):
+            files = [files]
+
+        if not append:
+            self.message_ids = {}
+            self.unsent_jobs = {}
+        first_index = len(self.message_ids) + len(self.unsent_jobs)
+
+        bodies = {}
+        proc_names = {}
+        for i, filename in enumerate(files, first_index):
+            job = self._job_entry(i, filename, commands, bucket_name,
+                                  parameters)
+            proc_names[str(i)] = job["proc_name"]
+            bodies[str(i)] = json.dumps(job)
+
+        # The entry IDs only need to be unique within a batch, so the job
+        # index is used.
+        message_ids, failed = self._send_bodies(bodies, num_workers,
+                                                max_retries)
+        for entry_id, message_id in message_ids.items():
+            self.message_ids[proc_names[entry_id]] = message_id
+        for entry_id, error in failed.items():
+            self.unsent_jobs[proc_names[entry_id]] = error
+
+        self.njobs = len(self.message_ids)
+
+        return self.message_ids
+
+    def new_packed_message(self, commands=None, files=None,
+                           bucket_name=None, parameters="",
+                           target_runtime=600., durations=None,
+                           default_duration=60., max_jobs_per_unit=100,
+                           num_workers=4, max_retries=3, append=False):
+        '''
+        Submit the jobs packed into work units, each sent as one message.
+        A worker runs the jobs of a unit back to back and returns all of
+        their results in one message, so many short jobs do not each pay
+        for a message, a download of the worker's state and an upload.
+
+        Jobs are packed largest first into the first unit with room, so the
+        expected runtime of each unit is at most `target_runtime`. A job
+        expected to take longer is given a unit of its own.
+
+        The jobs keep the proc_names and output prefixes they would have
+        had with `new_sqs_message`, and `finished_jobs` and `njobs` still
+        count jobs. The result of the unit, and its output when uploaded
+        as a tar file, are under `data_products/<job name>_unit_<n>/`.
+
+        Parameters
+        ----------
+        commands : list, optional
+            Commands to run for each job. Defaults to `params['commands']`.
+        files : list, optional
+            Data files to make jobs for. Defaults to `params['files']`.
+        bucket_name : str, optional
+            Bucket holding the data. Defaults to the job name.
+        parameters : str, optional
+            Parameters to include in each job.
+        target_runtime : float, optional
+            Expected runtime of each unit, in seconds.
+        durations : dict, optional
+            Expected duration of the job for each file, in seconds.
+        default_duration : float, optional
+            Expected duration of jobs missing from `durations`.
+        max_jobs_per_unit : int, optional
+            Largest number of jobs in a unit.
+        num_workers : int, optional
+            Number of batches of messages to send at once.
+        max_retries : int, optional
+            Number of times to retry messages that failed to send.
+        append : bool, optional
+            Add to the jobs already submitted.
+
+        Returns
+        -------
+        units : dict
+            The proc_names of the jobs in each unit, keyed by the unit's
+            proc_name.
+        '''
+
+        if commands is None:
+            commands = self.params['commands']
+        if files is None:
+            files = self.data_files
+        if bucket_name is None:
+            bucket_name = self.job_name
+        if durations is None:
+            durations = {}
+
+        if not isinstance(files, list):
+            files = [files]
+
+        if not append:
+            self.message_ids = {}
+            self.units = {}
+            self.unsent_jobs = {}
+        first_index = len(self.message_ids) + len(self.unsent_jobs)
+        first_unit = len(self.units)
+
+        jobs = []
+        for i, filename in enumerate(files, first_index):
+            job = self._job_entry(i, filename, commands, bucket_name,
+                                  parameters)
+            jobs.append((durations.get(filename, default_duration),
+                         len(json.dumps(job)), job))
+
+        # First-fit decreasing: [runtime, size, jobs] of each unit.
+        packed = []
+        for duration, size, job in sorted(jobs, key=lambda job: -job[0]):
+            for unit in packed:
+                if unit[0] + duration <= target_runtime and \
+                        unit[1] + size <= MAX_UNIT_SIZE and \
+                        len(unit[2]) < max_jobs_per_unit:
+                    break
+            else:
+                unit = [0., UNIT_OVERHEAD, []]
+                packed.append(unit)
+            unit[0] += duration
+            unit[1] += size
+            unit[2].append(job)
+
+        bodies = {}
+        unit_names = {}
+        for n, unit in enumerate(packed, first_unit):
+            unit_jobs = sorted(unit[2], key=lambda job: job["proc_name"])
+            proc_name = "{0}_unit_{1}".format(self.job_name, n)
+            unit_names[str(n)] = proc_name
+            self.units[proc_name] = [job["proc_name"] for job in unit_jobs]
+            bodies[str(n)] = \
+                json.dumps({"proc_name": proc_name,
+                            "bucket": bucket_name,
+                            "output_prefix":
+                                "data_products/{}/".format(proc_name),
+                            "jobs": unit_jobs})
+
+        message_ids, failed = self._send_bodies(bodies, num_workers,
+                                                max_retries)
+        for entry_id, message_id in message_ids.items():
+            for job_name in self.units[unit_names[entry_id]]:
+                self.message_ids[job_name] = message_id
+        for entry_id, error in failed.items():
+            for job_name in self.units[unit_names[entry_id]]:
+                self.unsent_jobs[job_name] = error
+
+        self.njobs = len(self.message_ids)
+
+        return dict((unit_names[entry_id], self.units[unit_names[entry_id]])
+                    for entry_id in message_ids)
+
+    def _job_entry(self, index, filename, commands, bucket_name, parameters):
+        '''
+        Contents of the message for one job.
+        '''
+
+        key_name = filename.rstrip("/").split("/")[-1]
+        if os.path.isdir(filename):
+            key_name += "/*"
+
+        proc_name = "{0}_{1}".format(self.job_name, index)
+        return {"proc_name": proc_name,
+                "bucket": bucket_name,
+                "key_name": key_name,
+                "command": commands,
+                "parameters": parameters,
+                "output_prefix": "data_products/{}/".format(proc_name)}
+
+    def _send_bodies(self, bodies, num_workers, max_retries):
+        '''
+        Send the message bodies, keyed by entry ID, in batches of up to 10
+        (see `_batches`) with `num_workers` batches sent at once. Returns
+        the message ID of each entry sent, and the error for each entry
+        that could not be. A batch failing does not stop the others.
+        '''
+
+        # Encoded as the queue's messages are read (base64 for boto's).
+        queue = self.request_queue
+        bodies = dict((entry_id, encode_message_body(queue, body))
+                      for entry_id, body in bodies.items())
+
+        batches = _batches(sorted(bodies.keys(), key=int), bodies)
+
+        pool = ThreadPool(max(1, min(num_workers, len(batches))))
+        try:
+            results = pool.map(lambda batch: self._write_batch(batch, bodies,
+                                                               max_retries),
+                               batches)
+        finally:
+            pool.close()
+            pool.join()
+
+        message_ids = {}
+        failed = {}
+        for batch_ids, batch_failed in results:
+            message_ids.update(batch_ids)
+            failed.update(batch_failed)
+
+        if len(failed) > 0:
+            print("Failed to send {0} of {1} messages. The first error:\n"
+                  "{2}".format(len(failed), len(bodies),
+                               failed[sorted(failed, key=int)[0]]))
+
+        return message_ids, failed
+
+    def _write_batch(self, entry_ids, bodies, max_retries):
+        '''
+        Send a batch of messages, retrying any that fail. Returns the
+        message ID of each entry sent, and the error for each that was not.
+        '''
+
+        message_ids = {}
+        failed = {}
+
+        for attempt in range(max_retries + 1):
+            entries = [(entry_id, bodies[entry_id], 0)
+                       for entry_id in entry_ids]
+            try:
+                response = self.request_queue.write_batch(entries)
+            except Exception:
+                failed = dict((entry_id, tr.format_exc())
+                              for entry_id in entry_ids)
+                if attempt < max_retries:
+                    time.sleep(2 ** attempt)
+                continue
+
+            for result in response.results:
+                message_ids[result['id']] = result['message_id']
+
+            failed = dict((error['id'], "{0}: {1}".format(error['code'],
+                                                         error['message']))
+                          for error in response.errors)
+            entry_ids = list(failed.keys())
+            if len(entry_ids) == 0:
+                break
+
+            if attempt < max_retries:
+                time.sleep(2 ** attempt)
+
+        return message_ids, failed
+
+    def boot_instances(self, image_id=None, nworkers=None,
+                       instance_type='t2.micro', key_name=None,
+                       security_groups='launch-wizard-1',
+                       worker_script=WORKER_LOOP_SCRIPT, user='ubuntu',
+                       custom_lines='', idle_time=600, nslots=None):
+        '''
+        Launch the workers with as few requests as possible. All of the
+        instances are requested at once, and the worker script is given as
+        the user data. The instances are returned without waiting for them
+        to start; use `iter_ready_instances` to act on each as it becomes
+        ready.
+
+        Parameters
+        ----------
+        image_id : str, optional
+            Image to launch the workers from. Defaults to the newest image
+            baked for the region with `bake_image.bake_image`.
+        nworkers : int, optional
+            Number of workers to launch. Defaults to `max_instances`. No
+            more are launched than keep the fleet within `max_instances`.
+        instance_type : str, optional
+            EC2 instance type.
+        key_name : str, optional
+            Name of the key pair to allow ssh access with.
+        security_groups : str or list, optional
+            Security groups for the instances.
+        worker_script : str, optional
+            Template of the user data script. One of `WORKER_SCRIPT`,
+            `WORKER_LOOP_SCRIPT` or `WORKER_SLOTS_SCRIPT`.
+        user : str, optional
+            User on the image to run as.
+        custom_lines : str, optional
+            Extra lines for the script to run before starting the worker.
+        idle_time : int, optional
+            Seconds a looping worker waits without a message before it
+            shuts down.
+        nslots : int, optional
+            Number of job slots on each worker for `WORKER_SLOTS_SCRIPT`.
+            Defaults to the number of CPUs.
+
+        Returns
+        -------
+        instances : list
+            The instances launched.
+        '''
+
+        if nworkers is None:
+            nworkers = self.max_instances
+
+        nworkers = min(nworkers, self.max_instances - len(self.instances))
+        if nworkers <= 0:
+            return []
+
+        image_id = self._image_id(image_id)
+
+        user_data = self._worker_user_data(worker_script, user, custom_lines,
+                                           idle_time, nslots)
+
+        instances = launch_many(nworkers, key_name=key_name,
+                                region=self.region, image_id=image_id,
+                                instance_type=instance_type,
+                                security_groups=security_groups,
+                                user_data=user_data,
+                                aws_access=self.credentials)
+
+        self.instances.extend(instances)
+        self._record_launch(instances)
+
+        return instances
+
+    def boot_spot_instances(self, image_id, candidate_types, nworkers=None,
+                            prices=None, throughput=None, max_price=None,
+                            bid_factor=1.2, key_name=None,
+                            security_groups='launch-wizard-1',
+                            worker_script=WORKER_LOOP_SCRIPT, user='ubuntu',
+                            custom_lines='', idle_time=600, nslots=None):
+        '''
+        Request the workers as spot instances, using the candidate instance
+        type with the lowest cost per job. The requests are placed right
+        away; use `iter_spot_ready` to wait for them to be fulfilled.
+
+        The looping worker scripts are told to watch for interruption
+        notices, so the jobs on an interrupted instance return to the queue
+        straight away.
+
+        Parameters
+        ----------
+        image_id : str
+            Image to launch the workers from. If None, the newest image
+            baked for the region is used.
+        candidate_types : list
+            Instance types to choose from.
+        nworkers : int, optional
+            Number of workers to launch. Defaults to `max_instances`.
+        prices : dict, optional
+            Spot price per hour of each type. Defaults to the current spot
+            prices.
+        throughput : dict, optional
+            Jobs finished per hour on each type. Defaults to the throughput
+            measured from the results collected so far.
+        max_price : float, optional
+            Highest price per hour to bid. Defaults to `bid_factor` times the
+            current price of the chosen type.
+        bid_factor : float, optional
+            Bid relative to the current price when `max_price` is not given.
+
+        See `boot_instances` for the other parameters.
+
+        Returns
+        -------
+        requests : list
+            The spot instance requests placed.
+        '''
+
+        if nworkers is None:
+            nworkers = self.max_instances
+
+        nworkers = min(nworkers, self.max_instances - len(self.instances) -
+                       len(self.spot_requests))
+        if nworkers <= 0:
+            return []
+
+        image_id = self._image_id(image_id)
+
+        if prices is None:
+            prices = get_spot_prices(candidate_types, region=self.region,
+                                     aws_access=self.credentials)
+        if throughput is None:
+            throughput = self.measured_throughput()
+
+        ranking = select_instance_type(candidate_types, prices,
+                                       throughput=throughput)
+        if len(ranking) == 0:
+            raise ValueError("No prices found for the candidate types.")
+
+        instance_type = ranking[0][1]
+        if max_price is None:
+            max_price = bid_factor * prices[instance_type]
+
+        user_data = self._worker_user_data(worker_script, user, custom_lines,
+                                           idle_time, nslots,
+                                           watch_interruptions=True)
+
+        requests = request_spot_workers(nworkers, max_price, image_id,
+                                        instance_type, region=self.region,
+                                        key_name=key_name,
+                                        security_groups=security_groups,
+                                        user_data=user_data,
+                                        aws_access=self.credentials)
+
+        self.spot_requests.extend(requests)
+
+        return requests
+
+    def iter_spot_ready(self, requests=None, timeout=600):
+        '''
+        Yield the instances of the spot requests as they are fulfilled, and
+        add them to `instances`.
+
+        Parameters
+        ----------
+        requests : list, optional
+            Requests to wait on. Defaults to all of the pending requests.
+        timeout : float, optional
+            Cancel the requests not fulfilled after this many seconds.
+        '''
+
+        if requests is None:
+            requests = list(self.spot_requests)
+
+        try:
+            for inst in iter_spot_instances(requests, region=self.region,
+                                            timeout=timeout,
+                                            aws_access=self.credentials):
+                self.instances.append(inst)
+                self._record_launch([inst])
+                yield inst
+        finally:
+            # Fulfilled or cancelled, the requests are no longer pending.
+            for request in requests:
+                if request in self.spot_requests:
+                    self.spot_requests.remove(request)
+
+    def _record_launch(self, instances):
+        now = time.time()
+        for inst in instances:
+            self.launch_times[inst.id] = now
+
+    def _image_id(self, image_id=None):
+        '''
+        Return the image to launch, defaulting to the newest baked image.
+        '''
+
+        if image_id is None:
+            image_id = latest_image(self.region)
+            if image_id is None:
+                raise ValueError("No image given, and none has been baked "
+                                 "for {}.".format(self.region))
+
+        return image_id
+
+    def boot_latency(self):
+        '''
+        Time from boot to the first message on each worker so far, grouped
+        by the image the workers were launched from.
+
+        Returns
+        -------
+        latencies : dict
+            The latencies, in seconds, of each image. These can be added to
+            the `bake_image.ImageRegistry` to compare images.
+        '''
+
+        latencies = {}
+        for image_id, latency in self.boot_latencies.values():
+            latencies.setdefault(image_id, []).append(latency)
+
+        return latencies
+
+    def measured_throughput(self, nslots=1):
+        '''
+        Jobs finished per hour on each instance type, from the durations in
+        the results collected so far and the number of job slots the
+        workers of each type reported.
+
+        Parameters
+        ----------
+        nslots : int, optional
+            Slots per instance for types whose workers have not reported it.
+        '''
+
+        type_slots = {}
+        for instance_type, slots in self.instance_slots.values():
+            type_slots.setdefault(instance_type, []).append(slots)
+
+        throughput = {}
+        for instance_type, durations in self.type_durations.items():
+            mean_duration = sum(durations) / float(len(durations))
+            slots = type_slots.get(instance_type)
+            mean_slots = sum(slots) / float(len(slots)) if slots else nslots
+            if mean_duration > 0:
+                throughput[instance_type] = mean_slots * 3600. / mean_duration
+
+        return throughput
+
+    def _worker_user_data(self, worker_script, user, custom_lines, idle_time,
+                          nslots, watch_interruptions=False):
+        '''
+        Fill in the worker script template.
+        '''
+
+        return worker_script \
+            % {"USER": user,
+               "QUEUE_NAME": self.request_queue_name,
+               "REGION": self.region,
+               "KEY": self.key,
+               "SECRET": self.secret,
+               "RESP_QUEUE_NAME": self.result_queue_name,
+               "CUSTOM_LINES": custom_lines,
+               "IDLE_TIME": idle_time,
+               "NSLOTS": nslots,
+               "WATCH": watch_interruptions}
+
+    def iter_ready_instances(self, instances=None, **kwargs):
+        '''
+        Yield each of the workers as soon as it is running. See
+        `launch_instance.iter_ready_instances` for the keyword arguments.
+        '''
+
+        if instances is None:
+            instances = self.instances
+
+        for inst in iter_ready_instances(instances, region=self.region,
+                                         aws_access=self.credentials,
+                                         **kwargs):
+            yield inst
 
     def check_workers(self, queue):
         pass
 
-    def receive_result(self, queue):
-        pass
+    def receive_result(self, queue=None, wait_time=20, timeout=None,
+                       buffer_size=1048576):
+        '''
+        Collect the result messages until all jobs have finished. The queue
+        is long-polled for up to 10 messages at a time, and each batch is
+        appended to the JSON lines file `result_log` before being deleted
+        from the queue in a single request.
+
+        Parameters
+        ----------
+        queue : boto.sqs.queue.Queue, optional
+            Queue to read results from. Defaults to the result queue.
+        wait_time : int, optional
+            Seconds to wait for messages in each poll (max. 20).
+        timeout : float, optional
+            Stop collecting after this many seconds.
+        buffer_size : int, optional
+            Size of the write buffer for the result log.
+
+        Returns
+        -------
+        nfinished : int
+            Number of jobs finished.
+        '''
+
+        if queue is None:
+            queue = self.result_queue
+
+        t0 = time.time()
+
+        with open(self.result_log, "a", buffer_size) as log:
+            while not self.check_finish():
+                if timeout is not None and time.time() - t0 > timeout:
+                    break
+                self._collect_results(queue, log, wait_time)
+
+        return len(self.finished_jobs)
+
+    def _collect_results(self, queue, log, wait_time=20):
+        '''
+        Read, log and delete one batch of result messages.
+        '''
+
+        # May run in a worker thread (see async_controller).
+        queue = thread_queue(queue)
+
+        messages = queue.get_messages(num_messages=10,
+                                      wait_time_seconds=wait_time)
+        if len(messages) == 0:
+            return []
+
+        records = []
+        for mess in messages:
+            try:
+                record = json.loads(mess.get_body())
+                if 'status' in record:
+                    self.stopped_instances.add(record['instance_id'])
+                    if record['status'] == 'drained':
+                        self.drained.add(record['instance_id'])
+                    continue
+                if 'result_key' in record:
+                    record = self._fetch_result(record)
+
+                # The result of a work unit holds one record per job.
+                job_records = unpack_result(record)
+                job_records = [job for job in job_records
+                               if job['proc_name'] not in self.finished_jobs]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                # A malformed message would otherwise return to the queue
+                # and stop every batch it's read in.
+                self._reject_result(mess.get_body())
+                continue
+            if len(job_records) == 0:
+                continue
+
+            if record.get('instance_id') is not None:
+                self.last_result_time[record['instance_id']] = time.time()
+                if record.get('nslots') is not None:
+                    self.instance_slots[record['instance_id']] = \
+                        (record.get('instance_type'), record['nslots'])
+                boot = record.get('timings', {}).get('boot')
+                if boot is not None:
+                    self._record_boot(record['instance_id'], boot)
+            # The autoscaler counts messages, so is given the time of the
+            # whole unit.
+            if record.get('duration') is not None:
+                with self._durations_lock:
+                    self.job_durations.append(record['duration'])
+
+            for job in job_records:
+                records.append(job)
+
+                self.finished_jobs.add(job['proc_name'])
+                if not job.get('success', False):
+                    self.nfailed += 1
+
+                instance_type = job.get('instance_type')
+                if job.get('duration') is not None and \
+                        instance_type is not None:
+                    self.type_durations.setdefault(instance_type, [])
+                    self.type_durations[instance_type].append(
+                        job['duration'])
+
+                log.write(json.dumps(job) + "\n")
+
+        # Make sure the batch is on disk before removing it from the queue.
+        log.flush()
+        if self.result_store is not None and len(records) > 0:
+            self.result_store.add_many(records, run_name=self.job_name)
+        queue.delete_message_batch(messages)
+
+        return records
+
+    def _reject_result(self, body):
+        '''
+        Keep a result message that could not be read in `rejected_log`,
+        along with the error, so it can be deleted from the queue.
+        '''
+
+        error = tr.format_exc()
+        print("Rejected a result message:\n" + error)
+
+        with open(self.rejected_log, "a") as log:
+            log.write(json.dumps({"body": body, "error": error}) + "\n")
+        self.nrejected += 1
+
+    def take_job_durations(self):
+        '''
+        Return the durations of the jobs finished since the last call, and
+        clear them.
+        '''
+
+        with self._durations_lock:
+            durations = self.job_durations
+            self.job_durations = []
+        return durations
+
+    def _fetch_result(self, record):
+        '''
+        Fetch a result the worker uploaded to S3 for being too large to
+        send. If it can't be read, the summary in the message is used.
+        '''
+
+        try:
+            bucket = get_bucket(return_s3_connection(self.credentials),
+                                record['bucket'])
+            return json.loads(
+                bucket.get_key(record['result_key'])
+                .get_contents_as_string().decode("utf-8"))
+        except Exception:
+            record['messages'] = {'receive_result': tr.format_exc()}
+            record['success'] = False
+            if record['proc_name'] in self.units:
+                record['jobs'] = [{'proc_name': job_name, 'success': False}
+                                  for job_name in
+                                  self.units[record['proc_name']]]
+            return record
+
+    def _record_boot(self, instance_id, boot):
+        '''
+        Record the boot-to-first-message time reported by an instance. If
+        a restarted worker reports it again, the earliest is kept.
+        '''
+
+        latency = (boot.get('image_id'), boot['duration'])
+        if instance_id not in self.boot_latencies or \
+                latency[1] < self.boot_latencies[instance_id][1]:
+            self.boot_latencies[instance_id] = latency
 
     def check_finish(self):
-        pass
+        '''
+        Check whether a result has been received for every job.
+        '''
+        return len(self.finished_jobs) >= self.njobs
 
     def mass_shutdown(self):
         pass
+
+    def alive_instances(self, grace_period=LAUNCH_GRACE_PERIOD):
+        '''
+        Return the launched workers that are booting or running, checked
+        with a single request. Workers launched within `grace_period`
+        seconds that the EC2 API does not list yet count as booting.
+        '''
+
+        stopped_ids = self._stopped_ids(list(self.instances), grace_period)
+        return [inst for inst in self.instances if inst.id not in stopped_ids]
+
+    def update_instances(self, grace_period=LAUNCH_GRACE_PERIOD):
+        '''
+        Stop tracking the workers that have stopped or terminated (see
+        `alive_instances`). Workers launched while the check runs are kept.
+
+        Returns
+        -------
+        stopped : list
+            The workers no longer tracked.
+        '''
+
+        stopped_ids = self._stopped_ids(list(self.instances), grace_period)
+
+        stopped = [inst for inst in self.instances if inst.id in stopped_ids]
+        self.instances = [inst for inst in self.instances
+                          if inst.id not in stopped_ids]
+
+        return stopped
+
+    def _stopped_ids(self, instances, grace_period):
+        '''
+        Return the IDs of the workers that are stopping or stopped, or that
+        are still not listed by the EC2 API `grace_period` seconds after
+        launch.
+        '''
+
+        if len(instances) == 0:
+            return set()
+
+        now = time.time()
+        new_ids = set(inst.id for inst in instances
+                      if now - self.launch_times.get(inst.id, 0) <=
+                      grace_period)
+
+        ec2 = get_ec2_connection(self.region, self.credentials)
+        states = _instance_states(ec2, [inst.id for inst in instances])
+        if states is None:
+            # Some of the new instances are not visible to the API yet, so
+            # only the others are checked.
+            instances = [inst for inst in instances
+                         if inst.id not in new_ids]
+            states = _instance_states(ec2, [inst.id for inst in instances])
+            if states is None:
+                # Which are missing isn't known, so none are dropped.
+                return set()
+
+        return set(inst.id for inst in instances
+                   if states.get(inst.id) in STOPPED_STATES or
+                   (inst.id not in states and inst.id not in new_ids))
+
+    def retire_instances(self, nretire, instances=None):
+        '''
+        Ask `nretire` workers to drain. A draining worker finishes its
+        current job, takes no more, and reports back once done; it is only
+        terminated then (see `terminate_drained`). The workers that
+        reported a result most recently are picked first, since they
+        finished their last job and found the queue empty. Workers that
+        have not reported yet may still be booting, and are left alone.
+
+        Returns
+        -------
+        drain_ids : list
+            IDs of the workers asked to drain.
+        '''
+
+        if instances is None:
+            instances = self.alive_instances()
+
+        reported = [inst for inst in instances
+                    if inst.id in self.last_result_time and
+                    inst.id not in self.draining]
+        reported.sort(key=lambda inst: self.last_result_time[inst.id],
+                      reverse=True)
+
+        drain_ids = [inst.id for inst in reported[:nretire]]
+        if len(drain_ids) == 0:
+            return []
+
+        ec2 = get_ec2_connection(self.region, self.credentials)
+        ec2.create_tags(drain_ids, {DRAIN_TAG: "true"})
+        self.draining.update(drain_ids)
+
+        return drain_ids
+
+    def terminate_drained(self):
+        '''
+        Terminate the workers that have reported they finished draining.
+
+        Returns
+        -------
+        retire_ids : list
+            IDs of the terminated workers.
+        '''
+
+        retire_ids = [inst.id for inst in self.instances
+                      if inst.id in self.drained]
+        if len(retire_ids) == 0:
+            return []
+
+        ec2 = get_ec2_connection(self.region, self.credentials)
+        ec2.terminate_instances(instance_ids=retire_ids)
+
+        self.instances = [inst for inst in self.instances
+                          if inst.id not in retire_ids]
+        self.draining.difference_update(retire_ids)
+        self.drained.difference_update(retire_ids)
+
+        return retire_ids
+
+    def autoscale(self, image_id, autoscaler=None, interval=60,
+                  **boot_kwargs):
+        '''
+        Collect results while scaling the fleet to the request queue, until
+        all jobs have finished.
+
+        Each round reads the approximate number of waiting and in-flight
+        messages, updates the job duration from the collected results, and
+        launches or retires workers as the autoscaler decides.
+
+        Parameters
+        ----------
+        image_id : str
+            Image to launch the workers from.
+        autoscaler : Autoscaler, optional
+            Scaling policy. Defaults to `Autoscaler(max_instances)`.
+        interval : float, optional
+            Seconds between scaling decisions.
+        boot_kwargs : passed to `boot_instances`.
+
+        Returns
+        -------
+        nfinished : int
+            Number of jobs finished.
+        '''
+
+        if autoscaler is None:
+            autoscaler = Autoscaler(self.max_instances)
+
+        while not self.check_finish():
+            attrs = self.request_queue.get_attributes('All')
+            nvisible = int(attrs['ApproximateNumberOfMessages'])
+            ninflight = int(attrs['ApproximateNumberOfMessagesNotVisible'])
+
+            for duration in self.take_job_durations():
+                autoscaler.record_job_duration(duration)
+
+            self.terminate_drained()
+            self.update_instances()
+
+            # Draining workers take no new jobs, so no longer count.
+            nrunning = len([inst for inst in self.instances
+                            if inst.id not in self.draining])
+            change = autoscaler.decide(nvisible, ninflight, nrunning)
+            if change > 0:
+                self.boot_instances(image_id, nworkers=change,
+                                    **boot_kwargs)
+            elif change < 0:
+                self.retire_instances(-change, self.instances)
+
+            self.receive_result(wait_time=min(20, interval),
+                                timeout=interval)
+
+        return len(self.finished_jobs)
+
+
+class UploadHandle(object):
+    '''
+    Handle to uploads running in the background. Items can be used as soon
+    as they are returned by `as_completed`, without waiting on the others.
+    '''
+    def __init__(self, data, track_uploaded, num_workers, upload_func,
+                 upload_args):
+        super(UploadHandle, self).__init__()
+
+        self.data = data
+        self.track_uploaded = track_uploaded
+
+        self._finished = Queue()
+        self._nreturned = 0
+
+        self._pool = ThreadPool(max(1, min(num_workers, len(data))))
+        self._results = \
+            [self._pool.apply_async(upload_func, (dat,) + upload_args,
+                                    callback=self._finished.put)
+             for dat in data]
+        self._pool.close()
+
+    def ready(self):
+        '''
+        Check whether all of the uploads have finished.
+        '''
+        return all(result.ready() for result in self._results)
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the uploads to finish. Returns True if all items were
+        uploaded, and False if any failed or the timeout was reached.
+        '''
+        t0 = time.time()
+        for result in self._results:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, timeout - (time.time() - t0))
+            result.wait(remaining)
+            if not result.ready():
+                return False
+
+        self._pool.join()
+
+        return self.successful()
+
+    def successful(self):
+        '''
+        Check whether all of the items have been uploaded.
+        '''
+        return all(record["status"] == "Success"
+                   for record in self.track_uploaded.values())
+
+    def as_completed(self, timeout=None):
+        '''
+        Yield each item as its upload finishes, successful or not. Check
+        `track_uploaded` for the outcome.
+        '''
+        while self._nreturned < len(self.data):
+            try:
+                dat = self._finished.get(timeout=timeout)
+            except Empty:
+                return
+            self._nreturned += 1
+            yield dat
+
+
+def unpack_result(record):
+    '''
+    Split the result of a work unit into a record for each of its jobs,
+    which give the unit's proc_name as `unit`. Other results are returned
+    as they are.
+    '''
+
+    if 'jobs' not in record:
+        return [record]
+
+    job_records = []
+    for job in record['jobs']:
+        job = dict(job)
+        job['unit'] = record['proc_name']
+        for field in ['instance_id', 'instance_type']:
+            job.setdefault(field, record.get(field))
+        job_records.append(job)
+
+    return job_records
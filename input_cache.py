@@ -0,0 +1,272 @@
+# License under the MIT License - see LICENSE
+
+'''
+On-disk cache of downloaded inputs for long-lived workers. Entries are keyed
+by the bucket, key name and ETag, so a changed key is never served stale.
+'''
+
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+from subprocess import call
+import threading
+
+
+class InputCache(object):
+    '''
+    Cache of downloaded S3 keys, limited to `max_bytes` with the least
+    recently used entries evicted first.
+
+    Entries are filled by downloading to a temporary file and renaming it
+    into place, while holding a lock on the entry, so several job slots (or
+    processes) can share the cache. Entries are read-only. By default, each
+    job gets its own writable copy of an entry, made copy-on-write where
+    the file system allows.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to keep the cache in.
+    max_bytes : int, optional
+        Largest total size of the cache. Defaults to 50 Gb.
+    link : {'reflink', 'hard', 'copy'}, optional
+        How to place entries into a job folder. Reflinks (copy-on-write)
+        are used by default, and need a file system supporting them (e.g.,
+        XFS or btrfs), falling back to a copy. Hard links avoid the copy on
+        any file system, but the job's inputs are then the read-only cache
+        entries themselves: jobs must not edit their inputs in place. Hard
+        links fall back to a copy across file systems.
+    '''
+    def __init__(self, cache_dir, max_bytes=53687091200, link='reflink'):
+        super(InputCache, self).__init__()
+
+        if link not in ['hard', 'reflink', 'copy']:
+            raise ValueError("link must be 'hard', 'reflink' or 'copy'.")
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bytes_hit": 0,
+                      "bytes_downloaded": 0}
+
+    def entry_path(self, bucket_name, key_name, etag):
+        '''
+        Path of the cache entry for a version of a key.
+        '''
+        name = "\n".join([bucket_name, key_name, etag.strip('"')])
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(name.encode("utf-8")).hexdigest())
+
+    def fetch(self, key, out_file, download_func, stats=None):
+        '''
+        Place a key at `out_file`, from the cache if possible. Otherwise the
+        key is downloaded with `download_func(filename)` into the cache
+        first.
+
+        Parameters
+        ----------
+        key : boto.s3.key.Key
+            Key to fetch. Its ETag must be known.
+        out_file : str
+            Where to place the key.
+        download_func : function
+            Called with a file name to download the key to.
+        stats : dict, optional
+            Hits and misses are also counted in this dictionary.
+
+        Returns
+        -------
+        hit : bool
+            Whether the key was in the cache.
+        '''
+
+        path = self.entry_path(key.bucket.name, key.name, key.etag)
+
+        lock_file = self._lock_entry(path)
+        try:
+            hit = os.path.exists(path)
+            if hit:
+                # The modification time marks when it was last used.
+                os.utime(path, None)
+            else:
+                tmp_path = "{0}.tmp.{1}".format(path, os.getpid())
+                try:
+                    download_func(tmp_path)
+                    os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP |
+                             stat.S_IROTH)
+                    os.rename(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+
+            self._place(path, out_file)
+        finally:
+            if not os.path.exists(path):
+                # The download failed, so nothing is left to lock.
+                self._remove_lock(path)
+            lock_file.close()
+
+        size = os.stat(path).st_size
+        with self._lock:
+            for counts in [self.stats, stats]:
+                if counts is None:
+                    continue
+                if hit:
+                    counts["hits"] = counts.get("hits", 0) + 1
+                    counts["bytes_hit"] = counts.get("bytes_hit", 0) + size
+                else:
+                    counts["misses"] = counts.get("misses", 0) + 1
+                    counts["bytes_downloaded"] = \
+                        counts.get("bytes_downloaded", 0) + size
+
+        if not hit:
+            self.evict(keep=path)
+
+        return hit
+
+    def _lock_entry(self, path, blocking=True):
+        '''
+        Open and lock the lock file of an entry. Closing the file releases
+        the lock. Returns None if `blocking` is False and another job holds
+        the lock.
+        '''
+
+        lock_path = path + ".lock"
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                fcntl.flock(lock_file, flags)
+            except (IOError, OSError):
+                lock_file.close()
+                return None
+
+            # The lock file is removed along with its entry. If that
+            # happened while waiting, the lock taken is on the removed
+            # file, so it is taken again on a new one.
+            try:
+                current = os.stat(lock_path).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+            lock_file.close()
+
+    def _remove_lock(self, path):
+        '''
+        Remove the lock file of an entry. The lock must be held.
+        '''
+        try:
+            os.remove(path + ".lock")
+        except OSError:
+            pass
+
+    def _place(self, path, out_file):
+        '''
+        Link (or copy) a cache entry to the output file.
+        '''
+
+        if os.path.exists(out_file):
+            os.remove(out_file)
+
+        if self.link == 'hard':
+            try:
+                os.link(path, out_file)
+                return
+            except OSError:
+                # e.g., the job folder is on another file system.
+                pass
+        elif self.link == 'reflink':
+            with open(os.devnull, "w") as devnull:
+                cloned = call(["cp", "--reflink=always", path, out_file],
+                              stderr=devnull) == 0
+            if cloned:
+                # The copy keeps the entry's read-only mode.
+                os.chmod(out_file, os.stat(out_file).st_mode | stat.S_IWUSR)
+                return
+
+        shutil.copyfile(path, out_file)
+
+    def entries(self):
+        '''
+        Return the (last used time, size, path) of each cache entry.
+        '''
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if "." in name:
+                # Lock and temporary files.
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        return entries
+
+    def size(self):
+        '''
+        Total size of the cache entries in bytes.
+        '''
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used entries until the cache is within
+        `max_bytes`. Files already placed into a job folder are unaffected.
+        Entries locked by `fetch` (being filled or placed) are skipped.
+        '''
+
+        with open(os.path.join(self.cache_dir, ".evict.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = sorted(self.entries())
+                total = sum(entry[1] for entry in entries)
+                for _, size, path in entries:
+                    if total <= self.max_bytes:
+                        break
+                    if path == keep:
+                        continue
+                    if self._remove_entry(path):
+                        total -= size
+
+                # Lock files left without an entry (e.g., by a failed
+                # download in a job that was killed).
+                for name in os.listdir(self.cache_dir):
+                    path = os.path.join(self.cache_dir, name[:-5])
+                    if name.endswith(".lock") and \
+                            not name.startswith(".") and \
+                            not os.path.exists(path):
+                        self._remove_entry(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _remove_entry(self, path):
+        '''
+        Remove a cache entry and its lock file, unless another job holds
+        its lock.
+        '''
+
+        lock_file = self._lock_entry(path, blocking=False)
+        if lock_file is None:
+            return False
+
+        try:
+            os.remove(path)
+            removed = True
+        except OSError:
+            removed = False
+
+        self._remove_lock(path)
+        lock_file.close()
+
+        return removed
@@ -1,9 +1,11 @@
 # License under the MIT License - see LICENSE
 
-import boto.ec2
+from boto.exception import EC2ResponseError
 import os
 import time
 
+from connections import get_ec2_connection
+
 
 def launch(key_name=None, region='us-west-2', image_id='ami-5189a661',
            instance_type='t2.micro', security_groups='launch-wizard-1',
@@ -14,7 +16,7 @@ def launch(key_name=None, region='us-west-2', image_id='ami-5189a661',
     if not isinstance(security_groups, list):
         security_groups = [security_groups]
 
-    ec2 = boto.ec2.connect_to_region(region)
+    ec2 = get_ec2_connection(region)
 
     reserve = ec2.run_instances(image_id, key_name=key_name,
                                 instance_type=instance_type,
@@ -40,3 +42,121 @@ def launch(key_name=None, region='us-west-2', image_id='ami-5189a661',
     return inst
 
     # ec2.get_instance_attribute('i-336b69f6', 'instanceType')
+
+
+def launch_many(count, min_count=1, key_name=None, region='us-west-2',
+                image_id='ami-5189a661', instance_type='t2.micro',
+                security_groups='launch-wizard-1', user_data=None,
+                aws_access={}):
+    '''
+    Request many instances in a single call. The instances are returned
+    right away, without waiting for them to start. Use
+    `iter_ready_instances` to wait for them.
+
+    Parameters
+    ----------
+    count : int
+        Number of instances to launch.
+    min_count : int, optional
+        Smallest number of instances to accept when there is not enough
+        capacity for `count`.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Returns
+    -------
+    instances : list
+        The boto.ec2.instance.Instance objects launched.
+    '''
+
+    if not isinstance(security_groups, list):
+        security_groups = [security_groups]
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    reserve = ec2.run_instances(image_id, min_count=min(min_count, count),
+                                max_count=count, key_name=key_name,
+                                instance_type=instance_type,
+                                security_groups=security_groups,
+                                user_data=user_data)
+
+    return reserve.instances
+
+
+def iter_ready_instances(instances, region='us-west-2', initial_check=False,
+                         min_wait=2, max_wait=30, timeout=None,
+                         aws_access={}):
+    '''
+    Yield each instance as soon as it is running (and, with
+    `initial_check`, has passed its status checks). The status of all of the
+    waiting instances is checked with one request per poll, and the time
+    between polls backs off from `min_wait` to `max_wait` seconds.
+
+    Instances that are stopped or terminated before becoming ready are
+    dropped.
+
+    Parameters
+    ----------
+    instances : list
+        The boto.ec2.instance.Instance objects to wait on.
+    region : str, optional
+        AWS region name.
+    initial_check : bool, optional
+        Wait for the system and instance status checks to pass.
+    min_wait : float, optional
+        Initial time between polls in seconds.
+    max_wait : float, optional
+        Longest time between polls in seconds.
+    timeout : float, optional
+        Stop waiting after this many seconds.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Yields
+    ------
+    inst : boto.ec2.instance.Instance
+        An instance that is ready, with its attributes updated.
+    '''
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    waiting = dict((inst.id, inst) for inst in instances)
+
+    t0 = time.time()
+    wait = min_wait
+
+    while len(waiting) > 0:
+        try:
+            statuses = \
+                ec2.get_all_instance_status(instance_ids=list(waiting.keys()),
+                                            include_all_instances=True)
+        except EC2ResponseError:
+            # New instances may not be visible to the API straight away.
+            statuses = []
+
+        ready_ids = []
+        for status in statuses:
+            if status.state_name in ["shutting-down", "terminated",
+                                     "stopping", "stopped"]:
+                del waiting[status.id]
+            elif status.state_name == "running":
+                if not initial_check or \
+                        (status.system_status.status == "ok" and
+                         status.instance_status.status == "ok"):
+                    ready_ids.append(status.id)
+
+        if len(ready_ids) > 0:
+            # Update the ready instances (e.g., their IPs) all at once.
+            for inst in ec2.get_only_instances(instance_ids=ready_ids):
+                del waiting[inst.id]
+                yield inst
+            # Others may be close behind, so check again quickly.
+            wait = min_wait
+
+        if len(waiting) > 0:
+            if timeout is not None and time.time() - t0 > timeout:
+                break
+            time.sleep(wait)
+            wait = min(2 * wait, max_wait)
@@ -0,0 +1,170 @@
+# License under the MIT License - see LICENSE
+
+'''
+Stream the logs of a running job to S3 as it runs, so they can be followed
+and are kept if the instance dies.
+'''
+
+import os
+import threading
+import time
+
+from boto.s3.key import Key
+
+from utils import monotonic
+
+
+class LogStreamer(threading.Thread):
+    '''
+    Follow log files on disk and upload what is appended to them as a series
+    of chunk objects, `<key_prefix><file name>.<n>` with n = 000000,
+    000001, ...
+
+    The child process writes to the files as usual, so streaming adds no
+    overhead to it. New data is uploaded once `chunk_size` bytes are
+    waiting, or `interval` seconds after the last upload, so no more than
+    `interval` seconds of logs are lost if the instance dies. A failed
+    upload is retried with the next flush.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket to upload to.
+    key_prefix : str
+        Prefix of the chunk keys.
+    filenames : list
+        Log files to follow. Files that do not exist yet are picked up once
+        they appear.
+    interval : float, optional
+        Longest time, in seconds, between uploads of new data.
+    chunk_size : int, optional
+        Upload once this many bytes are waiting, and upload at most this
+        much in one chunk.
+    poll_interval : float, optional
+        Seconds between checking the file sizes.
+    '''
+    def __init__(self, bucket, key_prefix, filenames, interval=5.,
+                 chunk_size=1048576, poll_interval=0.5):
+        super(LogStreamer, self).__init__()
+        self.daemon = True
+
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+        self.filenames = filenames
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+
+        self.offsets = dict((name, 0) for name in filenames)
+        self.nchunks = dict((name, 0) for name in filenames)
+        self.bytes_sent = 0
+        self.errors = 0
+
+        self._last_flush = dict((name, monotonic()) for name in filenames)
+        self._stop_event = threading.Event()
+
+    def chunk_key_name(self, filename, number):
+        return "{0}{1}.{2:06d}".format(self.key_prefix,
+                                       os.path.basename(filename), number)
+
+    def run(self):
+        while not self._stop_event.wait(self.poll_interval):
+            for name in self.filenames:
+                self._flush(name, force=False)
+
+    def _pending(self, filename):
+        try:
+            return os.stat(filename).st_size - self.offsets[filename]
+        except OSError:
+            return 0
+
+    def _flush(self, filename, force=False):
+        '''
+        Upload the new data of a file, if enough has built up or enough time
+        has passed. With `force`, everything left is uploaded.
+        '''
+
+        while True:
+            pending = self._pending(filename)
+            if pending <= 0:
+                return
+
+            due = force or pending >= self.chunk_size or \
+                monotonic() - self._last_flush[filename] >= self.interval
+            if not due:
+                return
+
+            with open(filename, "rb") as f:
+                f.seek(self.offsets[filename])
+                data = f.read(min(pending, self.chunk_size))
+
+            key = Key(self.bucket)
+            key.key = self.chunk_key_name(filename, self.nchunks[filename])
+            try:
+                key.set_contents_from_string(data)
+            except Exception:
+                # Keep the data for the next attempt.
+                self.errors += 1
+                self._last_flush[filename] = monotonic()
+                if force:
+                    raise
+                return
+
+            self.offsets[filename] += len(data)
+            self.nchunks[filename] += 1
+            self.bytes_sent += len(data)
+            self._last_flush[filename] = monotonic()
+
+            # Without force, a large backlog is sent one chunk per poll.
+            if not force:
+                return
+
+    def stop(self, max_retries=3):
+        '''
+        Stop following the files, and upload whatever is left.
+
+        Returns
+        -------
+        stats : dict
+            The key prefix, and the number of chunks and bytes uploaded.
+        '''
+
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        for name in self.filenames:
+            for attempt in range(max_retries + 1):
+                try:
+                    self._flush(name, force=True)
+                    break
+                except Exception:
+                    if attempt == max_retries:
+                        break
+                    time.sleep(2 ** attempt)
+
+        return {"key_prefix": self.key_prefix,
+                "chunks": sum(self.nchunks.values()),
+                "bytes": self.bytes_sent,
+                "errors": self.errors}
+
+
+def read_streamed_log(bucket, key_prefix, filename):
+    '''
+    Return the contents of a streamed log so far, joining its chunks in
+    order.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket holding the log.
+    key_prefix : str
+        Prefix the log was streamed to.
+    filename : str
+        Name of the log file (e.g., 'stdout.txt').
+    '''
+
+    prefix = key_prefix + os.path.basename(filename) + "."
+    # The zero-padded chunk numbers list in order.
+    keys = sorted(bucket.list(prefix), key=lambda key: key.name)
+    return b"".join(key.get_contents_as_string() for key in keys)
@@ -1,3 +1,6 @@
+# Manual version of the setup in bake_image.py, which pins the versions
+# installed and records the image made.
+
 
 # A few necessary packages
 sudo apt-get update
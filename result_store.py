@@ -0,0 +1,262 @@
+# License under the MIT License - see LICENSE
+
+'''
+SQLite-backed store of the job results, indexed for fast queries on large
+runs.
+'''
+
+import json
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    proc_name TEXT PRIMARY KEY,
+    run_name TEXT,
+    success INTEGER,
+    duration REAL,
+    instance_id TEXT,
+    instance_type TEXT,
+    record TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_run_name ON jobs (run_name);
+CREATE INDEX IF NOT EXISTS jobs_success ON jobs (success);
+CREATE INDEX IF NOT EXISTS jobs_duration ON jobs (duration);
+
+CREATE TABLE IF NOT EXISTS messages (
+    proc_name TEXT,
+    phase TEXT,
+    message TEXT,
+    PRIMARY KEY (proc_name, phase)
+);
+CREATE INDEX IF NOT EXISTS messages_phase ON messages (phase);
+
+CREATE TABLE IF NOT EXISTS timings (
+    proc_name TEXT,
+    phase TEXT,
+    seconds REAL,
+    PRIMARY KEY (proc_name, phase)
+);
+CREATE INDEX IF NOT EXISTS timings_phase ON timings (phase, seconds);
+"""
+
+
+def run_name_from_proc_name(proc_name):
+    '''
+    The Controller names jobs as `<run name>_<index>`. Return the run name,
+    or the proc_name itself if it does not follow this pattern.
+    '''
+    parts = proc_name.rsplit("_", 1)
+    if len(parts) == 2 and parts[1].isdigit():
+        return parts[0]
+    return proc_name
+
+
+class ResultStore(object):
+    '''
+    Store of job results (as sent by `Worker.send_result_message`), indexed
+    by proc_name, run, success, duration, and the message and timing of
+    each phase.
+
+    Parameters
+    ----------
+    filename : str, optional
+        SQLite database file. Defaults to an in-memory database.
+    '''
+    def __init__(self, filename=":memory:"):
+        super(ResultStore, self).__init__()
+
+        self.filename = filename
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+
+    def add(self, record, run_name=None):
+        '''
+        Add a single result record.
+        '''
+        self.add_many([record], run_name=run_name)
+
+    def add_many(self, records, run_name=None):
+        '''
+        Add result records in a single transaction. A record for a proc_name
+        already in the store replaces it, along with the messages and
+        timings of its phases.
+
+        Parameters
+        ----------
+        records : list
+            Result records.
+        run_name : str, optional
+            Run the records belong to. Otherwise, it is taken from each
+            proc_name.
+        '''
+
+        jobs = []
+        messages = []
+        timings = []
+
+        # Only the last record of a job in the batch is kept.
+        latest = dict((record['proc_name'], record) for record in records)
+
+        for proc_name, record in latest.items():
+
+            jobs.append((proc_name,
+                         run_name if run_name is not None else
+                         run_name_from_proc_name(proc_name),
+                         int(bool(record.get('success'))),
+                         record.get('duration'),
+                         record.get('instance_id'),
+                         record.get('instance_type'),
+                         json.dumps(record)))
+
+            for phase, message in record.get('messages', {}).items():
+                if isinstance(message, (dict, list)):
+                    message = json.dumps(message)
+                messages.append((proc_name, phase, message))
+
+            for phase, timing in record.get('timings', {}).items():
+                if isinstance(timing, dict):
+                    timing = timing.get('duration')
+                if timing is not None:
+                    timings.append((proc_name, phase, timing))
+
+        # Phases of an earlier attempt at a job may not be in the new one.
+        proc_names = [(job[0],) for job in jobs]
+
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("DELETE FROM messages "
+                                       "WHERE proc_name = ?", proc_names)
+                self._conn.executemany("DELETE FROM timings "
+                                       "WHERE proc_name = ?", proc_names)
+                self._conn.executemany("INSERT OR REPLACE INTO jobs VALUES "
+                                       "(?, ?, ?, ?, ?, ?, ?)", jobs)
+                self._conn.executemany("INSERT OR REPLACE INTO messages "
+                                       "VALUES (?, ?, ?)", messages)
+                self._conn.executemany("INSERT OR REPLACE INTO timings "
+                                       "VALUES (?, ?, ?)", timings)
+
+    def import_jsonl(self, filename, run_name=None, batch_size=10000):
+        '''
+        Import a JSON lines file of result records (e.g., the Controller's
+        result log), in batches of `batch_size` per transaction.
+
+        Returns
+        -------
+        nrecords : int
+            Number of records imported.
+        '''
+
+        nrecords = 0
+        batch = []
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                batch.append(json.loads(line))
+                if len(batch) >= batch_size:
+                    self.add_many(batch, run_name=run_name)
+                    nrecords += len(batch)
+                    batch = []
+
+        if len(batch) > 0:
+            self.add_many(batch, run_name=run_name)
+            nrecords += len(batch)
+
+        return nrecords
+
+    def _query(self, query, args=()):
+        with self._lock:
+            return [dict(row) for row in
+                    self._conn.execute(query, args).fetchall()]
+
+    def failed_jobs(self, run_name=None):
+        '''
+        Return the proc_name and messages of each failed job.
+        '''
+
+        query = "SELECT proc_name, run_name, record FROM jobs " \
+            "WHERE success = 0"
+        args = ()
+        if run_name is not None:
+            query += " AND run_name = ?"
+            args = (run_name,)
+
+        rows = self._query(query + " ORDER BY proc_name", args)
+        for row in rows:
+            row['messages'] = json.loads(row.pop('record')).get('messages')
+        return rows
+
+    def slowest_jobs(self, n=10, run_name=None, phase=None):
+        '''
+        Return the `n` longest jobs, or the jobs with the longest time in
+        one `phase`.
+        '''
+
+        if phase is None:
+            query = "SELECT proc_name, run_name, duration FROM jobs " \
+                "WHERE duration IS NOT NULL"
+            args = []
+            if run_name is not None:
+                query += " AND run_name = ?"
+                args.append(run_name)
+            query += " ORDER BY duration DESC LIMIT ?"
+        else:
+            query = "SELECT jobs.proc_name, jobs.run_name, " \
+                "timings.seconds AS duration FROM timings " \
+                "JOIN jobs ON jobs.proc_name = timings.proc_name " \
+                "WHERE timings.phase = ?"
+            args = [phase]
+            if run_name is not None:
+                query += " AND jobs.run_name = ?"
+                args.append(run_name)
+            query += " ORDER BY timings.seconds DESC LIMIT ?"
+
+        args.append(n)
+
+        return self._query(query, tuple(args))
+
+    def find_messages(self, phase, pattern):
+        '''
+        Return the jobs whose message for `phase` matches the SQL LIKE
+        `pattern` (e.g., '%MemoryError%').
+        '''
+        return self._query("SELECT proc_name, message FROM messages "
+                           "WHERE phase = ? AND message LIKE ? "
+                           "ORDER BY proc_name", (phase, pattern))
+
+    def summary(self):
+        '''
+        Return the number of jobs, failures and the mean and longest
+        duration of each run.
+        '''
+        return self._query("SELECT run_name, COUNT(*) AS njobs, "
+                           "SUM(success) AS nsuccess, "
+                           "COUNT(*) - SUM(success) AS nfailed, "
+                           "AVG(duration) AS mean_duration, "
+                           "MAX(duration) AS max_duration "
+                           "FROM jobs GROUP BY run_name ORDER BY run_name")
+
+    def phase_summary(self, run_name=None):
+        '''
+        Return the mean and longest time spent in each phase.
+        '''
+
+        query = "SELECT timings.phase, COUNT(*) AS njobs, " \
+            "AVG(timings.seconds) AS mean_seconds, " \
+            "MAX(timings.seconds) AS max_seconds FROM timings"
+        args = ()
+        if run_name is not None:
+            query += " JOIN jobs ON jobs.proc_name = timings.proc_name " \
+                "WHERE jobs.run_name = ?"
+            args = (run_name,)
+
+        return self._query(query + " GROUP BY timings.phase", args)
+
+    def close(self):
+        self._conn.close()
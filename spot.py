@@ -0,0 +1,215 @@
+# License under the MIT License - see LICENSE
+
+'''
+Launch workers as spot instances, choosing the instance type with the
+lowest cost per job, and detect when a spot instance is being interrupted.
+'''
+
+from datetime import datetime
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+import boto.utils
+
+from connections import get_ec2_connection
+
+
+SPOT_ACTION_URL = \
+    "http://169.254.169.254/latest/meta-data/spot/instance-action"
+
+
+def get_spot_prices(instance_types, region='us-west-2',
+                    availability_zone=None,
+                    product_description='Linux/UNIX', aws_access={}):
+    '''
+    Return the current spot price of each instance type.
+
+    Parameters
+    ----------
+    instance_types : list
+        EC2 instance types.
+    region : str, optional
+        AWS region name.
+    availability_zone : str, optional
+        Only use prices from this zone. Otherwise the lowest price across
+        the region's zones is used.
+    product_description : str, optional
+        Operating system of the instances.
+    aws_access : dict, optional
+        Dictionary containing 'aws_access_key_id' and
+        'aws_secret_access_key'.
+
+    Returns
+    -------
+    prices : dict
+        Price per hour of each instance type with a price available.
+    '''
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    # Asking for the history from now only gives the current prices.
+    now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    prices = {}
+    for instance_type in instance_types:
+        history = \
+            ec2.get_spot_price_history(start_time=now, end_time=now,
+                                       instance_type=instance_type,
+                                       product_description=product_description,
+                                       availability_zone=availability_zone)
+        if len(history) > 0:
+            prices[instance_type] = min(entry.price for entry in history)
+
+    return prices
+
+
+def select_instance_type(candidates, prices, throughput=None,
+                         default_throughput=1.):
+    '''
+    Rank instance types by their cost per job, i.e. the hourly price over
+    the number of jobs finished per hour.
+
+    Parameters
+    ----------
+    candidates : list
+        Instance types to choose from.
+    prices : dict
+        Price per hour of each instance type. Types without a price are
+        skipped.
+    throughput : dict, optional
+        Measured number of jobs finished per hour on each instance type.
+    default_throughput : float, optional
+        Throughput assumed for types that have not been measured. When no
+        type has been measured, the cheapest is chosen.
+
+    Returns
+    -------
+    ranking : list
+        Tuples of (cost per job, instance type), cheapest first.
+    '''
+
+    if throughput is None:
+        throughput = {}
+
+    ranking = []
+    for instance_type in candidates:
+        if instance_type not in prices:
+            continue
+        jobs_per_hour = throughput.get(instance_type, default_throughput)
+        if jobs_per_hour <= 0:
+            continue
+        ranking.append((prices[instance_type] / float(jobs_per_hour),
+                        instance_type))
+
+    ranking.sort()
+
+    return ranking
+
+
+def request_spot_workers(count, price, image_id, instance_type,
+                         region='us-west-2', key_name=None,
+                         security_groups='launch-wizard-1', user_data=None,
+                         aws_access={}):
+    '''
+    Place one-time spot requests for `count` instances at up to `price` per
+    hour.
+
+    Returns
+    -------
+    requests : list
+        The boto.ec2.spotinstancerequest.SpotInstanceRequest objects.
+    '''
+
+    if not isinstance(security_groups, list):
+        security_groups = [security_groups]
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    return ec2.request_spot_instances(str(price), image_id, count=count,
+                                      type='one-time', key_name=key_name,
+                                      security_groups=security_groups,
+                                      instance_type=instance_type,
+                                      user_data=user_data)
+
+
+def iter_spot_instances(requests, region='us-west-2', min_wait=2,
+                        max_wait=30, timeout=None, aws_access={}):
+    '''
+    Yield the instances of the spot requests as they are fulfilled. All of
+    the open requests are checked with one call per poll, backing off from
+    `min_wait` to `max_wait` seconds. Requests that are cancelled, closed or
+    fail are dropped. Open requests are cancelled after `timeout` seconds.
+    '''
+
+    ec2 = get_ec2_connection(region, aws_access)
+
+    waiting = set(req.id for req in requests)
+
+    t0 = time.time()
+    wait = min_wait
+
+    while len(waiting) > 0:
+        try:
+            current = \
+                ec2.get_all_spot_instance_requests(request_ids=list(waiting))
+        except EC2ResponseError:
+            # New requests may not be visible to the API straight away.
+            current = []
+
+        instance_ids = []
+        for req in current:
+            if req.instance_id is not None:
+                instance_ids.append(req.instance_id)
+                waiting.discard(req.id)
+            elif req.state in ["cancelled", "closed", "failed"]:
+                waiting.discard(req.id)
+
+        if len(instance_ids) > 0:
+            for inst in ec2.get_only_instances(instance_ids=instance_ids):
+                yield inst
+            wait = min_wait
+
+        if len(waiting) > 0:
+            if timeout is not None and time.time() - t0 > timeout:
+                ec2.cancel_spot_instance_requests(list(waiting))
+                break
+            time.sleep(wait)
+            wait = min(2 * wait, max_wait)
+
+
+def spot_interruption_notice():
+    '''
+    Return the interruption notice of the spot instance this runs on, or an
+    empty string when no interruption is scheduled (or not on EC2).
+    '''
+    try:
+        return boto.utils.retry_url(SPOT_ACTION_URL, retry_on_404=False,
+                                    num_retries=1, timeout=1)
+    except Exception:
+        return ""
+
+
+class InterruptionWatcher(threading.Thread):
+    '''
+    Poll for a spot interruption notice every `interval` seconds, and call
+    `callback` once when one is found.
+    '''
+    def __init__(self, callback, interval=5, check=spot_interruption_notice):
+        super(InterruptionWatcher, self).__init__()
+        self.daemon = True
+
+        self.callback = callback
+        self.interval = interval
+        self.check = check
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if self.check():
+                self.callback()
+                break
+
+    def stop(self):
+        self._stop_event.set()
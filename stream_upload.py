@@ -0,0 +1,289 @@
+# License under the MIT License - see LICENSE
+
+'''
+Stream data straight into an S3 multi-part upload, without first writing it
+to local disk. Used to upload a (compressed) tar of the data products as it
+is generated.
+'''
+
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import tarfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+    NO_ZSTD_FLAG = False
+except ImportError:
+    NO_ZSTD_FLAG = True
+
+from transfer_tuner import MIN_PART_SIZE, MAX_PART_SIZE, MAX_PARTS
+from connections import thread_multipart
+
+# The part size is doubled after each of this many parts, since the total
+# size isn't known up front and S3 allows at most 10,000 parts.
+PARTS_PER_DOUBLING = 1000
+
+TAR_EXTENSIONS = {None: ".tar", "gz": ".tar.gz", "zst": ".tar.zst"}
+
+
+class MultipartWriter(object):
+    '''
+    File-like object that uploads everything written to it as the parts of
+    a multi-part upload.
+
+    Full parts are uploaded in the background by `num_workers` threads.
+    Writing blocks once `num_workers` parts are waiting to be sent, so no
+    more than `num_workers + 1` parts are held in memory. The part size
+    is capped so those parts fit within `max_memory`.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket to upload to.
+    key_name : str
+        Name of the key to create.
+    part_size : int, optional
+        Size of each part. Must be at least 5 Mb. It is doubled after every
+        1000 parts to stay within the 10,000 part limit, up to the cap set
+        by `max_memory` (which also reduces it if needed).
+    num_workers : int, optional
+        Number of parts to upload at once.
+    max_retries : int, optional
+        Number of times to retry a failed part.
+    max_memory : int, optional
+        Most memory to hold parts in. Defaults to 1 Gb. This limits the
+        size of the upload to a little over 10,000 parts of
+        `max_memory / (num_workers + 1)`.
+    '''
+    def __init__(self, bucket, key_name, part_size=52428800, num_workers=2,
+                 max_retries=3, max_memory=1073741824):
+        super(MultipartWriter, self).__init__()
+
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part_size must be at least 5 Mb.")
+
+        self.max_part_size = min(max_memory // (num_workers + 1),
+                                 MAX_PART_SIZE)
+        if self.max_part_size < MIN_PART_SIZE:
+            raise ValueError("max_memory must hold num_workers + 1 parts of "
+                             "at least 5 Mb.")
+
+        self.part_size = min(part_size, self.max_part_size)
+        self.max_retries = max_retries
+        self.bytes_written = 0
+
+        self._buffer = []
+        self._buffered = 0
+        self._part_num = 0
+        self._results = []
+        self._slots = threading.BoundedSemaphore(num_workers)
+        self._pool = ThreadPool(num_workers)
+
+        self.mp = bucket.initiate_multipart_upload(key_name)
+        self.closed = False
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes_written += len(data)
+
+        if self._buffered >= self.part_size:
+            data = b"".join(self._buffer)
+            start = 0
+            while len(data) - start >= self.part_size:
+                part_size = self.part_size
+                self._send_part(data[start:start + part_size])
+                start += part_size
+            # Keep the remainder for the next part.
+            self._buffer = [data[start:]]
+            self._buffered = len(data) - start
+
+    def _send_part(self, data):
+        self._check_errors()
+
+        if self._part_num == MAX_PARTS:
+            raise ValueError("Upload is over the {0} part limit. Increase "
+                             "part_size or max_memory.".format(MAX_PARTS))
+
+        # Wait for a free worker so the buffered parts stay bounded.
+        self._slots.acquire()
+
+        self._part_num += 1
+        self._results.append(
+            self._pool.apply_async(self._upload_part,
+                                   (data, self._part_num)))
+
+        if self._part_num % PARTS_PER_DOUBLING == 0:
+            self.part_size = min(2 * self.part_size, self.max_part_size)
+
+    def _upload_part(self, data, part_num):
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    thread_multipart(self.mp).upload_part_from_file(
+                        BytesIO(data), part_num=part_num)
+                    return part_num
+                except Exception:
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(2 ** attempt)
+        finally:
+            self._slots.release()
+
+    def _check_errors(self):
+        for result in self._results:
+            if result.ready() and not result.successful():
+                # Re-raises the exception from the worker.
+                result.get()
+
+    def close(self):
+        '''
+        Upload the last part and complete the upload. The upload is
+        cancelled if any part failed, or if it could not be completed.
+        '''
+        if self.closed:
+            return
+
+        self.closed = True
+        try:
+            # The last part may be smaller than 5 Mb. At least one part is
+            # always needed to complete the upload.
+            if self._buffered > 0 or self._part_num == 0:
+                self._send_part(b"".join(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+
+            self._pool.close()
+            for result in self._results:
+                result.get()
+            self._pool.join()
+
+            self.mp.complete_upload()
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        '''
+        Cancel the upload and remove any parts already sent.
+        '''
+        self.closed = True
+        self._pool.terminate()
+        self._pool.join()
+        self.mp.cancel_upload()
+
+
+class CompressingWriter(object):
+    '''
+    File-like object that compresses what is written to it before passing
+    it on, counting the bytes before and after compression.
+
+    Parameters
+    ----------
+    fileobj : file-like
+        Object to write the compressed data to.
+    compression : {None, 'gz', 'zst'}, optional
+        Compression algorithm. With None, data is passed on unchanged.
+    compression_level : int, optional
+        Compression level of the algorithm.
+    '''
+    def __init__(self, fileobj, compression=None, compression_level=6):
+        super(CompressingWriter, self).__init__()
+
+        self.fileobj = fileobj
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+        if compression is None:
+            self._compressor = None
+        elif compression == "gz":
+            # The window bits give a gzip header and trailer.
+            self._compressor = zlib.compressobj(compression_level,
+                                                zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        elif compression == "zst":
+            if NO_ZSTD_FLAG:
+                raise ImportError("zstd compression requires the zstandard"
+                                  " package.")
+            self._compressor = \
+                zstandard.ZstdCompressor(level=compression_level).compressobj()
+        else:
+            raise ValueError("compression must be None, 'gz' or 'zst'.")
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data):
+        if len(data) > 0:
+            self.compressed_bytes += len(data)
+            self.fileobj.write(data)
+
+    def close(self):
+        if self._compressor is not None:
+            self._write(self._compressor.flush())
+
+
+def stream_tar_to_s3(filenames, bucket, key_name, compression=None,
+                     compression_level=6, part_size=52428800, num_workers=2,
+                     max_retries=3, max_memory=1073741824):
+    '''
+    Write a tar of the given files directly into a multi-part upload. The
+    tar is never written to local disk.
+
+    Parameters
+    ----------
+    filenames : list
+        Files or folders to add to the tar.
+    bucket : boto.s3.bucket.Bucket
+        Bucket to upload to.
+    key_name : str
+        Name of the key to create.
+    compression : {None, 'gz', 'zst'}, optional
+        Compression algorithm for the tar. zstd requires the zstandard
+        package.
+    compression_level : int, optional
+        Compression level of the algorithm.
+    part_size : int, optional
+        Size of each part of the multi-part upload.
+    num_workers : int, optional
+        Number of parts to upload at once.
+    max_retries : int, optional
+        Number of times to retry a failed part.
+    max_memory : int, optional
+        Most memory to hold parts in. See `MultipartWriter`.
+
+    Returns
+    -------
+    stats : dict
+        The key name, and the raw (tar) and compressed byte counts.
+    '''
+
+    writer = MultipartWriter(bucket, key_name, part_size=part_size,
+                             num_workers=num_workers, max_retries=max_retries,
+                             max_memory=max_memory)
+    try:
+        compressor = CompressingWriter(writer, compression=compression,
+                                       compression_level=compression_level)
+        tar = tarfile.open(fileobj=compressor, mode="w|")
+        for name in filenames:
+            tar.add(name)
+        tar.close()
+        compressor.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    writer.close()
+
+    return {"key_name": key_name,
+            "raw_bytes": compressor.raw_bytes,
+            "compressed_bytes": compressor.compressed_bytes}
@@ -68,7 +68,7 @@ try:
     t0 = time()
     while time() < t0 + 60:
         update = inst.update()
-        print update
+        print(update)
         if update in [u"stopping", u"stopped"]:
             print("Instance shutting down.")
             break
@@ -0,0 +1,61 @@
+# License under the MIT License - see LICENSE
+
+import os
+import socket
+import sys
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+import pytest
+
+# The modules import each other by their flat names.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+@pytest.fixture(scope="session")
+def s3_server():
+    '''
+    Local S3 stand-in (moto), on a free port.
+    '''
+
+    server_mod = pytest.importorskip("moto.server")
+    app_mod = pytest.importorskip("moto.moto_server.werkzeug_app")
+
+    # boto signs S3 requests with SigV2 ("AWS <key>:<signature>"). moto
+    # reads the service from a SigV4 credential scope, and a signature
+    # holding four slashes is taken for one, sending the request to an
+    # unknown service. Any SigV2 request is for S3.
+    dispatcher = app_mod.DomainDispatcherApplication
+    infer = dispatcher.infer_service_region_host
+
+    def infer_sigv2(self, environ, path):
+        if environ.get("HTTP_AUTHORIZATION", "").startswith("AWS "):
+            return None
+        return infer(self, environ, path)
+
+    dispatcher.infer_service_region_host = infer_sigv2
+
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = server_mod.ThreadedMotoServer(ip_address="localhost", port=port,
+                                           verbose=False)
+    server.start()
+    yield port
+    server.stop()
+    dispatcher.infer_service_region_host = infer
+
+
+@pytest.fixture
+def s3_bucket(s3_server, request):
+    '''
+    New bucket on the local S3 stand-in, named after the test.
+    '''
+
+    conn = S3Connection("testing", "testing", host="localhost",
+                        port=s3_server, is_secure=False,
+                        calling_format=OrdinaryCallingFormat())
+    name = request.node.name.replace("_", "-").lower()[:50]
+    return conn.create_bucket(name)
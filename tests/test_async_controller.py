@@ -0,0 +1,59 @@
+# License under the MIT License - see LICENSE
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from async_controller import AsyncController
+from test_instances import make_controller
+
+
+def test_blocking_methods_not_forwarded(monkeypatch):
+    ctrl = AsyncController(controller=make_controller(monkeypatch, {}, {}))
+
+    with pytest.raises(AttributeError):
+        ctrl.mass_shutdown
+    # Plain attributes, and methods without I/O, still are.
+    assert ctrl.region == "us-west-2"
+    assert ctrl.take_job_durations is not None
+
+
+def test_iter_spot_ready_off_loop(monkeypatch):
+    threads = []
+
+    def iter_spot_ready(requests=None, timeout=600):
+        for inst_id in ["i-1", "i-2"]:
+            threads.append(threading.current_thread())
+            yield inst_id
+
+    ctrl = make_controller(monkeypatch, {}, {})
+    ctrl.iter_spot_ready = iter_spot_ready
+
+    async def collect():
+        async with AsyncController(controller=ctrl) as actrl:
+            return [inst async for inst in actrl.iter_spot_ready()]
+
+    assert asyncio.run(collect()) == ["i-1", "i-2"]
+    assert threading.main_thread() not in threads
+
+
+def test_check_health_grace_period(monkeypatch):
+    now = time.time()
+    states = {"i-run": "running", "i-crash": "terminated",
+              "i-idle": "stopped"}
+    launch_times = {"i-run": now - 3600, "i-crash": now - 3600,
+                    "i-idle": now - 3600, "i-new": now - 10}
+    ctrl = make_controller(monkeypatch, states, launch_times)
+    ctrl.stopped_instances = set(["i-idle"])
+
+    async def check():
+        async with AsyncController(controller=ctrl) as actrl:
+            return await actrl._check_health()
+
+    # The new instance is not listed yet, and the idle one stopped on its
+    # own, so only the crashed one is lost.
+    lost = asyncio.run(check())
+    assert [inst.id for inst in lost] == ["i-crash"]
+    assert sorted(inst.id for inst in ctrl.instances) == ["i-new", "i-run"]
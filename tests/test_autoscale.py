@@ -0,0 +1,89 @@
+# License under the MIT License - see LICENSE
+
+from autoscale import Autoscaler
+
+
+def make_autoscaler(**kwargs):
+    kwargs.setdefault("max_instances", 10)
+    kwargs.setdefault("target_drain_time", 600.)
+    kwargs.setdefault("job_duration", 600.)
+    return Autoscaler(**kwargs)
+
+
+def test_desired_workers_bounds():
+    scaler = make_autoscaler(min_instances=2)
+
+    # One worker per job, up to the maximum.
+    assert scaler.desired_workers(5, 0) == 5
+    assert scaler.desired_workers(50, 10) == 10
+    # The minimum is kept with nothing to do.
+    assert scaler.desired_workers(0, 0) == 2
+
+
+def test_desired_workers_job_slots():
+    scaler = make_autoscaler(jobs_per_worker=4)
+
+    assert scaler.desired_workers(8, 0) == 2
+    assert scaler.desired_workers(9, 0) == 3
+
+
+def test_scale_up():
+    scaler = make_autoscaler()
+
+    assert scaler.decide(6, 0, 2, now=0.) == 4
+
+
+def test_scale_up_cooldown():
+    scaler = make_autoscaler(scale_up_cooldown=120.)
+
+    assert scaler.decide(4, 0, 0, now=0.) == 4
+    # More jobs arrive, but the last launch is too recent.
+    assert scaler.decide(8, 0, 4, now=60.) == 0
+    assert scaler.decide(8, 0, 4, now=121.) == 4
+
+
+def test_no_change_at_desired_size():
+    scaler = make_autoscaler()
+
+    assert scaler.decide(2, 3, 5, now=0.) == 0
+
+
+def test_no_retire_while_jobs_wait():
+    scaler = make_autoscaler(target_drain_time=6000.)
+
+    # Fewer workers are needed, but some jobs have not been picked up.
+    assert scaler.decide(1, 0, 5, now=0.) == 0
+
+
+def test_retire_only_idle_workers():
+    scaler = make_autoscaler(scale_down_cooldown=0.)
+
+    # Two jobs left on five workers: three are idle.
+    assert scaler.decide(0, 2, 5, now=0.) == -3
+
+
+def test_retire_limited_by_busy_workers():
+    scaler = make_autoscaler(target_drain_time=6000.,
+                             scale_down_cooldown=0.)
+
+    # One worker would do, but four are still running jobs.
+    assert scaler.desired_workers(0, 4) == 1
+    assert scaler.decide(0, 4, 5, now=0.) == -1
+
+
+def test_retire_keeps_min_instances():
+    scaler = make_autoscaler(min_instances=2, scale_down_cooldown=0.)
+
+    assert scaler.decide(0, 0, 5, now=0.) == -3
+
+
+def test_scale_down_cooldown():
+    scaler = make_autoscaler(scale_up_cooldown=0., scale_down_cooldown=600.)
+
+    assert scaler.decide(5, 0, 0, now=0.) == 5
+    # Too soon after launching.
+    assert scaler.decide(0, 0, 5, now=300.) == 0
+    assert scaler.decide(0, 1, 5, now=601.) == -4
+    # Too soon after the last retirement.
+    assert scaler.decide(0, 0, 1, now=900.) == 0
+    assert scaler.decide(0, 0, 1, now=1202.) == -1
@@ -0,0 +1,173 @@
+# License under the MIT License - see LICENSE
+
+import json
+
+import pytest
+
+import bake_image
+from bake_image import BAKE_DONE, BAKE_FAILED, ImageRegistry, \
+    parse_console
+from controller import Controller
+
+
+class FakeBuilder(object):
+    def __init__(self):
+        self.id = "i-builder"
+        self.state = "pending"
+        self.terminated = False
+
+    def update(self):
+        # Stops itself once the bake has run.
+        self.state = "stopped"
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeConsole(object):
+    def __init__(self, output):
+        self.output = output
+
+
+class FakeImage(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeEC2(object):
+    def __init__(self, console):
+        self.console = console
+        self.images = []
+        self.tags = {}
+
+    def get_console_output(self, instance_id):
+        return FakeConsole(self.console)
+
+    def create_image(self, instance_id, name, description=None):
+        self.images.append(name)
+        return "ami-new"
+
+    def get_image(self, image_id):
+        return FakeImage("available")
+
+    def create_tags(self, resource_ids, tags):
+        for resource_id in resource_ids:
+            self.tags[resource_id] = tags
+
+
+def console(info):
+    return "\n".join(["Cloud-init running", BAKE_DONE, json.dumps(info),
+                      "Shutting down"])
+
+
+@pytest.fixture
+def builder(monkeypatch):
+    builder = FakeBuilder()
+    monkeypatch.setattr(bake_image, "launch_many",
+                        lambda count, **kwargs: [builder])
+    return builder
+
+
+def bake(monkeypatch, ec2, registry):
+    monkeypatch.setattr(bake_image, "get_ec2_connection",
+                        lambda region, aws_access: ec2)
+    return bake_image.bake_image("worker", registry=registry,
+                                 poll_interval=0, console_timeout=0)
+
+
+def test_registry_latest_and_saved(tmpdir):
+    filename = str(tmpdir.join("images", "images.json"))
+    registry = ImageRegistry(filename)
+    assert registry.latest("us-west-2") is None
+
+    registry.record("us-west-2", "ami-old", {"created": 1})
+    registry.record("us-west-2", "ami-new", {"created": 2})
+    registry.record("us-east-1", "ami-east", {"created": 3})
+    registry.record_boot_latency("ami-new", [30., 50.])
+    registry.save()
+
+    registry = ImageRegistry(filename)
+    assert registry.latest("us-west-2") == "ami-new"
+    summary = registry.summary("us-west-2")
+    assert summary["ami-new"]["nboots"] == 2
+    assert summary["ami-new"]["mean_latency"] == 40.
+    assert summary["ami-old"]["mean_latency"] is None
+    assert "ami-east" not in summary
+
+    with pytest.raises(KeyError):
+        registry.record_boot_latency("ami-unknown", [10.])
+
+
+def test_parse_console():
+    assert parse_console(None) is None
+    # The description isn't on the console yet.
+    assert parse_console("booting\n" + BAKE_DONE) is None
+    assert parse_console(console({"versions": {}}).encode("utf-8")) == \
+        {"versions": {}}
+
+    with pytest.raises(Exception) as err:
+        parse_console("apt-get update\n{} line 12".format(BAKE_FAILED))
+    assert "line 12" in str(err.value)
+
+
+def test_bake_recorded(tmpdir, monkeypatch, builder):
+    info = {"versions": {"casa": "4.7.1"},
+            "aws_controller_commit": "abc123"}
+    ec2 = FakeEC2(console(info))
+    registry = ImageRegistry(str(tmpdir.join("images.json")))
+
+    assert bake(monkeypatch, ec2, registry) == "ami-new"
+
+    assert builder.terminated
+    assert ec2.tags["ami-new"]["aws_controller_ref"] == "abc123"
+    entry = ImageRegistry(registry.filename).lookup("ami-new")
+    assert entry["name"] == ec2.images[0]
+    assert entry["base_image_id"] == bake_image.BASE_IMAGES["us-west-2"]
+    assert entry["boot_latencies"] == []
+
+
+@pytest.mark.parametrize("output",
+                         ["booting", "{} line 40".format(BAKE_FAILED)])
+def test_unfinished_bake_not_imaged(tmpdir, monkeypatch, builder, output):
+    ec2 = FakeEC2(output)
+    registry = ImageRegistry(str(tmpdir.join("images.json")))
+
+    with pytest.raises(Exception):
+        bake(monkeypatch, ec2, registry)
+
+    # The builder is still cleaned up, but no image is made or recorded.
+    assert builder.terminated
+    assert ec2.images == []
+    assert registry.latest("us-west-2") is None
+
+
+def test_controller_uses_latest_image(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("images.json"))
+    monkeypatch.setattr(bake_image, "DEFAULT_REGISTRY", filename)
+
+    ctrl = Controller.__new__(Controller)
+    ctrl.region = "us-west-2"
+    with pytest.raises(ValueError):
+        ctrl._image_id()
+
+    registry = ImageRegistry()
+    registry.record("us-west-2", "ami-baked", {"created": 1})
+    registry.save()
+
+    assert ctrl._image_id() == "ami-baked"
+    assert ctrl._image_id("ami-given") == "ami-given"
+
+
+def test_boot_latency_by_image():
+    ctrl = Controller.__new__(Controller)
+    ctrl.boot_latencies = {}
+
+    ctrl._record_boot("i-1", {"image_id": "ami-a", "duration": 40.})
+    # A restarted worker reports a later first message.
+    ctrl._record_boot("i-1", {"image_id": "ami-a", "duration": 400.})
+    ctrl._record_boot("i-2", {"image_id": "ami-a", "duration": 60.})
+    ctrl._record_boot("i-3", {"image_id": "ami-b", "duration": 30.})
+
+    latencies = ctrl.boot_latency()
+    assert sorted(latencies["ami-a"]) == [40., 60.]
+    assert latencies["ami-b"] == [30.]
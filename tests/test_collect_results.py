@@ -0,0 +1,131 @@
+# License under the MIT License - see LICENSE
+
+import io
+import json
+import os
+import threading
+
+from controller import Controller
+
+
+class FakeMessage(object):
+    def __init__(self, body):
+        self.body = body
+
+    def get_body(self):
+        return self.body
+
+
+class FakeQueue(object):
+    '''
+    Serves one batch of messages, and records the ones deleted.
+    '''
+    def __init__(self, bodies):
+        self.messages = [FakeMessage(body) for body in bodies]
+        self.deleted = []
+
+    def get_messages(self, num_messages=1, wait_time_seconds=None):
+        messages = self.messages[:num_messages]
+        self.messages = self.messages[num_messages:]
+        return messages
+
+    def delete_message_batch(self, messages):
+        self.deleted.extend(messages)
+
+
+def make_controller(tmpdir):
+    ctrl = Controller.__new__(Controller)
+    ctrl.job_name = "test"
+    ctrl.finished_jobs = set()
+    ctrl.nfailed = 0
+    ctrl.units = {}
+    ctrl.result_store = None
+    ctrl.last_result_time = {}
+    ctrl.instance_slots = {}
+    ctrl.boot_latencies = {}
+    ctrl.job_durations = []
+    ctrl.type_durations = {}
+    ctrl.stopped_instances = set()
+    ctrl.drained = set()
+    ctrl._durations_lock = threading.Lock()
+    ctrl.rejected_log = os.path.join(str(tmpdir), "rejected.jsonl")
+    ctrl.nrejected = 0
+    return ctrl
+
+
+def result(proc_name, success=True, **fields):
+    fields.update({"proc_name": proc_name, "success": success})
+    return json.dumps(fields)
+
+
+def test_collect_results(tmpdir):
+    ctrl = make_controller(tmpdir)
+    queue = FakeQueue([result("job_0", duration=10., instance_id="i-1",
+                              instance_type="c5.large", nslots=2),
+                       result("job_1", success=False)])
+    log = io.StringIO()
+
+    records = ctrl._collect_results(queue, log)
+
+    assert [rec["proc_name"] for rec in records] == ["job_0", "job_1"]
+    assert ctrl.finished_jobs == set(["job_0", "job_1"])
+    assert ctrl.nfailed == 1
+    assert ctrl.take_job_durations() == [10.]
+    assert ctrl.instance_slots == {"i-1": ("c5.large", 2)}
+    assert len(log.getvalue().splitlines()) == 2
+    assert len(queue.deleted) == 2
+
+
+def test_duplicate_results(tmpdir):
+    ctrl = make_controller(tmpdir)
+    queue = FakeQueue([result("job_0"), result("job_0")])
+    log = io.StringIO()
+
+    records = ctrl._collect_results(queue, log)
+
+    assert len(records) == 1
+    assert len(queue.deleted) == 2
+
+
+def test_work_unit_result(tmpdir):
+    ctrl = make_controller(tmpdir)
+    jobs = [{"proc_name": "job_0", "success": True},
+            {"proc_name": "job_1", "success": False}]
+    queue = FakeQueue([result("unit_0", jobs=jobs, instance_id="i-1")])
+
+    records = ctrl._collect_results(queue, io.StringIO())
+
+    assert [rec["unit"] for rec in records] == ["unit_0", "unit_0"]
+    assert ctrl.finished_jobs == set(["job_0", "job_1"])
+    assert ctrl.nfailed == 1
+
+
+def test_status_messages(tmpdir):
+    ctrl = make_controller(tmpdir)
+    queue = FakeQueue([json.dumps({"status": "idle", "instance_id": "i-1"}),
+                       json.dumps({"status": "drained",
+                                   "instance_id": "i-2"})])
+
+    assert ctrl._collect_results(queue, io.StringIO()) == []
+    assert ctrl.stopped_instances == set(["i-1", "i-2"])
+    assert ctrl.drained == set(["i-2"])
+    assert len(queue.deleted) == 2
+
+
+def test_malformed_results_rejected(tmpdir):
+    ctrl = make_controller(tmpdir)
+    bodies = ["not json", json.dumps({"success": True}),
+              json.dumps(["job_0"]), result("job_1")]
+    queue = FakeQueue(bodies)
+
+    records = ctrl._collect_results(queue, io.StringIO())
+
+    # The valid result is still collected, and all are deleted.
+    assert [rec["proc_name"] for rec in records] == ["job_1"]
+    assert len(queue.deleted) == 4
+
+    assert ctrl.nrejected == 3
+    with open(ctrl.rejected_log) as f:
+        rejected = [json.loads(line) for line in f]
+    assert [entry["body"] for entry in rejected] == bodies[:3]
+    assert all("Traceback" in entry["error"] for entry in rejected)
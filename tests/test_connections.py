@@ -0,0 +1,61 @@
+# License under the MIT License - see LICENSE
+
+import threading
+
+from connections import forget_bucket, forget_queue, get_bucket, get_queue
+
+
+class FakeConnection(object):
+    '''
+    Counts the lookups that a cached handle saves.
+    '''
+    def __init__(self):
+        self.lookups = []
+
+    def get_bucket(self, bucket_name):
+        self.lookups.append(bucket_name)
+        return object()
+
+    def create_queue(self, queue_name):
+        self.lookups.append(queue_name)
+        return object()
+
+
+def in_thread(func):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_forget_only_named_handles():
+    conn = FakeConnection()
+    kept_bucket = get_bucket(conn, "kept")
+    get_bucket(conn, "deleted")
+    kept_queue = get_queue(conn, "requests")
+    get_queue(conn, "results")
+
+    # Forgotten from another thread, e.g., a ThreadPool worker.
+    in_thread(lambda: forget_bucket("deleted"))
+    forget_queue("results")
+
+    assert get_bucket(conn, "kept") is kept_bucket
+    assert get_queue(conn, "requests") is kept_queue
+    get_bucket(conn, "deleted")
+    get_queue(conn, "results")
+    assert conn.lookups == ["kept", "deleted", "requests", "results",
+                            "deleted", "results"]
+
+
+def test_threads_forget_their_own_handles():
+    conn = FakeConnection()
+    # Each thread has its own handles.
+    other = in_thread(lambda: get_bucket(conn, "bucket"))
+    get_bucket(conn, "bucket")
+    assert get_bucket(conn, "bucket") is not other
+
+    forget_bucket("bucket")
+    get_bucket(conn, "bucket")
+    in_thread(lambda: get_bucket(conn, "bucket"))
+    assert conn.lookups == ["bucket"] * 4
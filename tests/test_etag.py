@@ -0,0 +1,102 @@
+# License under the MIT License - see LICENSE
+
+import hashlib
+import os
+
+from upload_download_s3 import auto_multipart_upload, compute_etag, \
+    infer_part_size, sync_upload
+from upload_manifest import UploadManifest
+
+MB = 1048576
+
+
+def make_file(folder, size):
+    filename = os.path.join(str(folder), "data.dat")
+    with open(filename, "wb") as f:
+        f.write(os.urandom(size))
+    return filename
+
+
+def test_single_part_etag(tmpdir):
+    filename = make_file(tmpdir, 1000)
+    with open(filename, "rb") as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+
+    assert compute_etag(filename) == md5
+    # Read in several blocks.
+    assert compute_etag(filename, block_size=64) == md5
+
+
+def test_multipart_etag(tmpdir):
+    filename = make_file(tmpdir, 2500)
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    digests = [hashlib.md5(data[i:i + 1000]).digest()
+               for i in range(0, 2500, 1000)]
+    expected = hashlib.md5(b"".join(digests)).hexdigest() + "-3"
+
+    assert compute_etag(filename, part_size=1000) == expected
+    # Blocks that don't line up with the parts.
+    assert compute_etag(filename, part_size=1000, block_size=300) == \
+        expected
+
+
+def test_multipart_etag_exact_parts(tmpdir):
+    filename = make_file(tmpdir, 2000)
+
+    assert compute_etag(filename, part_size=1000).endswith("-2")
+
+
+def test_multipart_etag_matches_s3(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, 11 * MB + 5)
+
+    auto_multipart_upload(filename, s3_bucket, "data.dat", max_size=5 * MB,
+                          chunk_size=5 * MB, num_workers=2)
+
+    etag = s3_bucket.get_key("data.dat").etag.strip('"')
+    assert compute_etag(filename, part_size=5 * MB) == etag
+
+
+def test_infer_part_size(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, 11 * MB + 5)
+
+    auto_multipart_upload(filename, s3_bucket, "data.dat", max_size=5 * MB,
+                          chunk_size=5 * MB, num_workers=2)
+
+    etag = s3_bucket.get_key("data.dat").etag
+    assert infer_part_size(filename, etag) == 5 * MB
+
+
+def test_infer_part_size_defaults(tmpdir):
+    # The AWS CLI's 8 Mb parts, where a smaller size also gives as many
+    # parts.
+    for size in [16 * MB + 1, 40 * MB + 1]:
+        filename = make_file(tmpdir, size)
+        etag = compute_etag(filename, part_size=8 * MB)
+        assert infer_part_size(filename, etag) == 8 * MB
+
+
+def test_infer_part_size_any_mb(tmpdir):
+    filename = make_file(tmpdir, 20 * MB)
+
+    etag = compute_etag(filename, part_size=9 * MB)
+    assert infer_part_size(filename, etag) == 9 * MB
+
+    # Not a whole number of megabytes.
+    etag = compute_etag(filename, part_size=9 * MB + 1)
+    assert infer_part_size(filename, etag) is None
+    # Single-part ETag.
+    assert infer_part_size(filename, compute_etag(filename)) is None
+
+
+def test_sync_other_part_size(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, 16 * MB + 1)
+    manifest = UploadManifest(os.path.join(str(tmpdir), "manifest.json"))
+
+    auto_multipart_upload(filename, s3_bucket, "data.dat", max_size=5 * MB,
+                          part_size=8 * MB)
+
+    # The contents are unchanged, so the key isn't uploaded again.
+    assert not sync_upload(filename, s3_bucket, "data.dat", manifest,
+                           max_size=5 * MB, chunk_size=5 * MB)
@@ -0,0 +1,51 @@
+# License under the MIT License - see LICENSE
+
+from upload_download_s3 import glob_prefix, has_wildcard, \
+    iter_matching_keys
+
+
+def test_has_wildcard():
+    assert has_wildcard("data/*.fits")
+    assert has_wildcard("data/file_?.fits")
+    assert has_wildcard("data/file_[0-9].fits")
+    assert not has_wildcard("data/file.fits")
+
+
+def test_glob_prefix():
+    assert glob_prefix("data_products/*.fits") == "data_products/"
+    assert glob_prefix("data/run_?/out.txt") == "data/run_"
+    assert glob_prefix("data/[ab]/*") == "data/"
+    assert glob_prefix("*") == ""
+    # No wildcards: the whole name.
+    assert glob_prefix("data/file.fits") == "data/file.fits"
+
+
+def test_iter_matching_keys(s3_bucket):
+    names = ["data/a.fits", "data/b.txt", "data/sub/c.fits", "other/d.fits",
+             "dat.fits"]
+    for name in names:
+        s3_bucket.new_key(name).set_contents_from_string(name)
+
+    def matches(pattern=None, prefix=None):
+        return sorted(key.name for key in
+                      iter_matching_keys(s3_bucket, pattern, prefix=prefix))
+
+    # fnmatch's * also matches across slashes.
+    assert matches("data/*.fits") == ["data/a.fits", "data/sub/c.fits"]
+    assert matches("data/?.txt") == ["data/b.txt"]
+    assert matches() == sorted(names)
+    assert matches("*.fits", prefix="other/") == ["other/d.fits"]
+
+
+def test_iter_matching_keys_scoped_listing(s3_bucket):
+    listed = []
+    list_keys = s3_bucket.list
+
+    def record_list(prefix=""):
+        listed.append(prefix)
+        return list_keys(prefix=prefix)
+
+    s3_bucket.list = record_list
+
+    list(iter_matching_keys(s3_bucket, "data/run_*/out.txt"))
+    assert listed == ["data/run_"]
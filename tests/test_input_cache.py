@@ -0,0 +1,149 @@
+# License under the MIT License - see LICENSE
+
+import os
+
+import pytest
+
+from input_cache import InputCache
+
+
+class FakeBucket(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeKey(object):
+    def __init__(self, name, etag, bucket_name="bucket"):
+        self.bucket = FakeBucket(bucket_name)
+        self.name = name
+        self.etag = etag
+
+
+class Downloads(object):
+    '''
+    Stand-in for a key download, writing `size` bytes named after the key.
+    '''
+    def __init__(self, size=100):
+        self.size = size
+        self.names = []
+
+    def func(self, key):
+        def download(filename):
+            self.names.append(key.name)
+            with open(filename, "wb") as f:
+                f.write(key.name.encode("utf-8")[:1] * self.size)
+        return download
+
+
+def read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def fetch(cache, key, folder, downloads):
+    out_file = os.path.join(str(folder), key.name)
+    hit = cache.fetch(key, out_file, downloads.func(key))
+    return hit, out_file
+
+
+def test_miss_then_hit(tmpdir):
+    cache = InputCache(str(tmpdir.join("cache")))
+    downloads = Downloads()
+    key = FakeKey("a.fits", '"etag1"')
+
+    assert fetch(cache, key, tmpdir.mkdir("job1"), downloads)[0] is False
+    hit, out_file = fetch(cache, key, tmpdir.mkdir("job2"), downloads)
+
+    assert hit
+    assert downloads.names == ["a.fits"]
+    assert read(out_file) == b"a" * 100
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+    assert cache.stats["bytes_hit"] == 100
+
+    # Each job has its own writable copy of the read-only entry.
+    with open(out_file, "ab") as f:
+        f.write(b"more")
+    assert read(cache.entry_path("bucket", "a.fits", "etag1")) == \
+        b"a" * 100
+
+
+def test_changed_etag_is_a_miss(tmpdir):
+    cache = InputCache(str(tmpdir.join("cache")))
+    downloads = Downloads()
+
+    fetch(cache, FakeKey("a.fits", "etag1"), tmpdir, downloads)
+    hit, _ = fetch(cache, FakeKey("a.fits", "etag2"), tmpdir, downloads)
+
+    assert not hit
+    assert downloads.names == ["a.fits", "a.fits"]
+
+
+def test_failed_download_leaves_no_entry(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    cache = InputCache(cache_dir)
+    key = FakeKey("a.fits", "etag1")
+    path = cache.entry_path("bucket", "a.fits", "etag1")
+
+    def fail(filename):
+        # The entry only appears once it is complete.
+        assert not os.path.exists(path)
+        with open(filename, "wb") as f:
+            f.write(b"partial")
+        raise IOError("Connection reset.")
+
+    with pytest.raises(IOError):
+        cache.fetch(key, str(tmpdir.join("a.fits")), fail)
+
+    assert os.listdir(cache_dir) == []
+
+    # The next fetch downloads it again.
+    downloads = Downloads()
+    assert fetch(cache, key, tmpdir, downloads)[0] is False
+    assert read(path) == b"a" * 100
+
+
+def test_lru_eviction(tmpdir):
+    cache_dir = str(tmpdir.join("cache"))
+    cache = InputCache(cache_dir, max_bytes=250)
+    downloads = Downloads()
+    keys = [FakeKey(name, "etag") for name in ["a", "b", "c"]]
+
+    for i, key in enumerate(keys[:2]):
+        fetch(cache, key, tmpdir, downloads)
+        # Used at distinct times, a at 1000 and b at 2000.
+        path = cache.entry_path("bucket", key.name, "etag")
+        os.utime(path, (1000 * (i + 1), 1000 * (i + 1)))
+
+    # Using a again makes b the least recently used.
+    assert fetch(cache, keys[0], tmpdir, downloads)[0]
+    fetch(cache, keys[2], tmpdir, downloads)
+
+    assert cache.size() == 200
+    assert not os.path.exists(cache.entry_path("bucket", "b", "etag"))
+    assert os.path.exists(cache.entry_path("bucket", "a", "etag"))
+    # The lock files go with their entries.
+    locks = [name for name in os.listdir(cache_dir)
+             if name.endswith(".lock") and not name.startswith(".")]
+    assert len(locks) == 2
+
+
+def test_locked_entry_not_evicted(tmpdir):
+    cache = InputCache(str(tmpdir.join("cache")), max_bytes=150)
+    downloads = Downloads()
+
+    fetch(cache, FakeKey("a", "etag"), tmpdir, downloads)
+    path = cache.entry_path("bucket", "a", "etag")
+    os.utime(path, (1000, 1000))
+
+    # Another job is placing the entry.
+    lock_file = cache._lock_entry(path)
+    try:
+        fetch(cache, FakeKey("b", "etag"), tmpdir, downloads)
+        assert os.path.exists(path)
+    finally:
+        lock_file.close()
+
+    cache.evict()
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".lock")
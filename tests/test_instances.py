@@ -0,0 +1,93 @@
+# License under the MIT License - see LICENSE
+
+import time
+
+from boto.exception import EC2ResponseError
+
+import controller
+from controller import Controller
+
+NOT_FOUND = ("<Response><Errors><Error>"
+             "<Code>InvalidInstanceID.NotFound</Code>"
+             "<Message>The instance ID does not exist</Message>"
+             "</Error></Errors></Response>")
+
+
+class FakeInstance(object):
+    def __init__(self, instance_id):
+        self.id = instance_id
+
+
+class FakeStatus(object):
+    def __init__(self, instance_id, state_name):
+        self.id = instance_id
+        self.state_name = state_name
+
+
+class FakeEC2(object):
+    '''
+    Lists the instances in `states`. Asking for any other raises NotFound,
+    as EC2 does for instances it does not know of (yet).
+    '''
+    def __init__(self, states):
+        self.states = states
+
+    def get_all_instance_status(self, instance_ids=None,
+                                include_all_instances=False):
+        if any(inst_id not in self.states for inst_id in instance_ids):
+            raise EC2ResponseError(400, "Bad Request", NOT_FOUND)
+        return [FakeStatus(inst_id, self.states[inst_id])
+                for inst_id in instance_ids]
+
+
+def make_controller(monkeypatch, states, launch_times):
+    ec2 = FakeEC2(states)
+    monkeypatch.setattr(controller, "get_ec2_connection",
+                        lambda region, credentials: ec2)
+
+    ctrl = Controller.__new__(Controller)
+    ctrl.region = "us-west-2"
+    ctrl.credentials = {}
+    ctrl.instances = [FakeInstance(inst_id) for inst_id in launch_times]
+    ctrl.launch_times = launch_times
+    return ctrl
+
+
+def test_update_instances(monkeypatch):
+    now = time.time()
+    states = {"i-run": "running", "i-boot": "pending",
+              "i-done": "terminated", "i-stop": "stopped"}
+    ctrl = make_controller(monkeypatch, states,
+                           dict((inst_id, now - 3600) for inst_id in states))
+
+    stopped = ctrl.update_instances()
+
+    assert sorted(inst.id for inst in stopped) == ["i-done", "i-stop"]
+    assert sorted(inst.id for inst in ctrl.instances) == ["i-boot", "i-run"]
+
+
+def test_new_instances_not_listed(monkeypatch):
+    now = time.time()
+    states = {"i-run": "running", "i-done": "terminated"}
+    launch_times = {"i-run": now - 3600, "i-done": now - 3600,
+                    "i-new": now - 10}
+    ctrl = make_controller(monkeypatch, states, launch_times)
+
+    # The new instance is not found, but is kept while it boots.
+    stopped = ctrl.update_instances(grace_period=300)
+
+    assert [inst.id for inst in stopped] == ["i-done"]
+    assert sorted(inst.id for inst in ctrl.instances) == ["i-new", "i-run"]
+    assert [inst.id for inst in ctrl.alive_instances()] == \
+        [inst.id for inst in ctrl.instances]
+
+
+def test_instances_never_listed(monkeypatch):
+    now = time.time()
+    states = {"i-run": "running"}
+    launch_times = {"i-run": now - 3600, "i-gone": now - 3600}
+    ctrl = make_controller(monkeypatch, states, launch_times)
+
+    # Neither is new, so which one is missing isn't known.
+    assert ctrl.update_instances(grace_period=300) == []
+    assert len(ctrl.instances) == 2
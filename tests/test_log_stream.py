@@ -0,0 +1,92 @@
+# License under the MIT License - see LICENSE
+
+import os
+import time
+
+from boto.s3.key import Key
+
+from log_stream import LogStreamer, read_streamed_log
+
+
+def wait_for(condition, timeout=10):
+    t0 = time.time()
+    while not condition():
+        assert time.time() - t0 < timeout
+        time.sleep(0.05)
+
+
+def test_logs_uploaded_while_running(s3_bucket, tmpdir):
+    stdout = str(tmpdir.join("stdout.txt"))
+    # Does not exist until the command writes to it.
+    stderr = str(tmpdir.join("stderr.txt"))
+    with open(stdout, "w") as f:
+        f.write("started\n")
+
+    streamer = LogStreamer(s3_bucket, "job_1/logs/", [stdout, stderr],
+                           interval=0.1, poll_interval=0.05)
+    streamer.start()
+
+    # Followed before the job ends.
+    wait_for(lambda: read_streamed_log(s3_bucket, "job_1/logs/",
+                                       "stdout.txt") == b"started\n")
+
+    with open(stdout, "a") as f:
+        f.write("finished\n")
+    with open(stderr, "w") as f:
+        f.write("warning\n")
+
+    stats = streamer.stop()
+
+    assert read_streamed_log(s3_bucket, "job_1/logs/", "stdout.txt") == \
+        b"started\nfinished\n"
+    assert read_streamed_log(s3_bucket, "job_1/logs/", "stderr.txt") == \
+        b"warning\n"
+    assert stats["bytes"] == 25
+    assert stats["errors"] == 0
+
+
+def test_large_logs_split_in_chunks(s3_bucket, tmpdir):
+    stdout = str(tmpdir.join("stdout.txt"))
+    data = os.urandom(2500)
+    with open(stdout, "wb") as f:
+        f.write(data)
+
+    # Never due by time, only by size or on stop.
+    streamer = LogStreamer(s3_bucket, "logs/", [stdout], interval=1e6,
+                           chunk_size=1000)
+    stats = streamer.stop()
+
+    assert stats["chunks"] == 3
+    assert [key.name for key in s3_bucket.list("logs/")] == \
+        ["logs/stdout.txt.000000", "logs/stdout.txt.000001",
+         "logs/stdout.txt.000002"]
+    assert read_streamed_log(s3_bucket, "logs/", "stdout.txt") == data
+
+
+def test_failed_upload_retried(s3_bucket, tmpdir, monkeypatch):
+    stdout = str(tmpdir.join("stdout.txt"))
+    with open(stdout, "w") as f:
+        f.write("output\n")
+
+    upload = Key.set_contents_from_string
+    calls = []
+
+    def flaky_upload(self, data, **kwargs):
+        calls.append(self.key)
+        if len(calls) == 1:
+            raise IOError("Connection reset.")
+        return upload(self, data, **kwargs)
+
+    monkeypatch.setattr(Key, "set_contents_from_string", flaky_upload)
+
+    streamer = LogStreamer(s3_bucket, "logs/", [stdout], interval=0)
+    # The failed chunk is kept, and sent again under the same name.
+    streamer._flush(stdout)
+    assert streamer.offsets[stdout] == 0
+
+    stats = streamer.stop()
+
+    assert calls == ["logs/stdout.txt.000000"] * 2
+    assert stats["errors"] == 1
+    assert read_streamed_log(s3_bucket, "logs/", "stdout.txt") == \
+        b"output\n"
@@ -0,0 +1,84 @@
+# License under the MIT License - see LICENSE
+
+import json
+import os
+
+from result_store import ResultStore, run_name_from_proc_name
+
+
+def result(proc_name, success=True, duration=None, messages=None,
+           timings=None):
+    return {"proc_name": proc_name, "success": success,
+            "duration": duration, "messages": messages or {},
+            "timings": timings or {}}
+
+
+def test_run_name_from_proc_name():
+    assert run_name_from_proc_name("CASA_Timing_2016_3") == \
+        "CASA_Timing_2016"
+    assert run_name_from_proc_name("unit") == "unit"
+
+
+def test_add_and_query():
+    store = ResultStore()
+    store.add_many([
+        result("run_0", duration=10.,
+               timings={"download": {"duration": 2.}, "execute": 8.}),
+        result("run_1", success=False, duration=30.,
+               messages={"execute": "MemoryError: out of memory"},
+               timings={"download": {"duration": 5.}}),
+        result("run_2", duration=20.)])
+
+    assert store.summary() == [{"run_name": "run", "njobs": 3,
+                                "nsuccess": 2, "nfailed": 1,
+                                "mean_duration": 20., "max_duration": 30.}]
+
+    failed = store.failed_jobs()
+    assert [row["proc_name"] for row in failed] == ["run_1"]
+    assert failed[0]["messages"] == {"execute":
+                                     "MemoryError: out of memory"}
+
+    assert [row["proc_name"] for row in store.slowest_jobs(n=2)] == \
+        ["run_1", "run_2"]
+    slowest = store.slowest_jobs(n=1, phase="download")
+    assert slowest == [{"proc_name": "run_1", "run_name": "run",
+                        "duration": 5.}]
+
+    assert [row["proc_name"] for row in
+            store.find_messages("execute", "%MemoryError%")] == ["run_1"]
+
+    phases = dict((row["phase"], row) for row in store.phase_summary())
+    assert phases["download"]["njobs"] == 2
+    assert phases["download"]["max_seconds"] == 5.
+    assert phases["execute"]["mean_seconds"] == 8.
+
+
+def test_rerecorded_job_replaces_phases():
+    store = ResultStore()
+    store.add(result("run_0", success=False,
+                     messages={"download": "Timeout", "execute": "Failed"},
+                     timings={"download": 600., "execute": 1.}))
+
+    # The retry succeeds, with no messages and only an execute timing.
+    store.add(result("run_0", duration=5., timings={"execute": 5.}))
+
+    assert store.failed_jobs() == []
+    assert store.find_messages("download", "%") == []
+    assert store.find_messages("execute", "%") == []
+    assert [row["phase"] for row in store.phase_summary()] == ["execute"]
+    assert store.summary()[0]["njobs"] == 1
+
+
+def test_import_jsonl(tmpdir):
+    filename = os.path.join(str(tmpdir), "results.jsonl")
+    with open(filename, "w") as f:
+        for i in range(5):
+            f.write(json.dumps(result("run_{}".format(i))) + "\n")
+        f.write("\n")
+
+    store = ResultStore(os.path.join(str(tmpdir), "results.db"))
+
+    assert store.import_jsonl(filename, run_name="other", batch_size=2) == 5
+    assert store.summary()[0]["run_name"] == "other"
+    assert store.summary()[0]["njobs"] == 5
+    store.close()
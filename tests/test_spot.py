@@ -0,0 +1,118 @@
+# License under the MIT License - see LICENSE
+
+from collections import namedtuple
+
+import pytest
+
+import controller
+import spot
+from controller import Controller
+from spot import get_spot_prices, select_instance_type
+
+PriceEntry = namedtuple("PriceEntry", ["price", "availability_zone"])
+
+# Recorded spot prices, per type and zone.
+PRICE_FEED = {"c5.large": [PriceEntry(0.031, "us-west-2a"),
+                           PriceEntry(0.029, "us-west-2b")],
+              "c5.xlarge": [PriceEntry(0.058, "us-west-2a"),
+                            PriceEntry(0.061, "us-west-2b")],
+              "m5.large": []}
+
+
+class FakeEC2(object):
+    '''
+    Serves the spot prices from `PRICE_FEED`, and records the requests.
+    '''
+    def __init__(self):
+        self.requests = []
+
+    def get_spot_price_history(self, instance_type=None,
+                               availability_zone=None, **kwargs):
+        return [entry for entry in PRICE_FEED.get(instance_type, [])
+                if availability_zone in [None, entry.availability_zone]]
+
+    def request_spot_instances(self, price, image_id, count=1,
+                               instance_type=None, **kwargs):
+        self.requests.append((price, image_id, count, instance_type))
+        return ["sir-{}".format(i) for i in range(count)]
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+    conn = FakeEC2()
+    monkeypatch.setattr(spot, "get_ec2_connection", lambda *args: conn)
+    return conn
+
+
+def make_controller():
+    ctrl = Controller.__new__(Controller)
+    ctrl.region = "us-west-2"
+    ctrl.key = ctrl.secret = "testing"
+    ctrl.credentials = {}
+    ctrl.request_queue_name = "requests"
+    ctrl.result_queue_name = "results"
+    ctrl.max_instances = 4
+    ctrl.instances = []
+    ctrl.spot_requests = []
+    ctrl.type_durations = {}
+    ctrl.instance_slots = {}
+    return ctrl
+
+
+def test_get_spot_prices(ec2):
+    prices = get_spot_prices(["c5.large", "c5.xlarge", "m5.large"])
+
+    # The cheapest zone, and no entry for types without a price.
+    assert prices == {"c5.large": 0.029, "c5.xlarge": 0.058}
+
+
+def test_get_spot_prices_zone(ec2):
+    prices = get_spot_prices(["c5.large"], availability_zone="us-west-2a")
+
+    assert prices == {"c5.large": 0.031}
+
+
+def test_select_cheapest_without_throughput():
+    prices = {"c5.large": 0.029, "c5.xlarge": 0.058}
+
+    ranking = select_instance_type(["c5.xlarge", "c5.large", "m5.large"],
+                                   prices)
+
+    assert [name for _, name in ranking] == ["c5.large", "c5.xlarge"]
+
+
+def test_select_by_cost_per_job():
+    prices = {"c5.large": 0.029, "c5.xlarge": 0.058}
+    # The larger type finishes over twice as many jobs per hour.
+    throughput = {"c5.large": 10., "c5.xlarge": 25.}
+
+    ranking = select_instance_type(["c5.large", "c5.xlarge"], prices,
+                                   throughput=throughput)
+
+    assert ranking[0] == (pytest.approx(0.058 / 25.), "c5.xlarge")
+
+
+def test_boot_spot_instances(ec2, monkeypatch):
+    monkeypatch.setattr(controller, "get_spot_prices",
+                        lambda types, **kwargs: get_spot_prices(types))
+    ctrl = make_controller()
+    # One-slot c5.large workers take 360 s a job, and four-slot c5.xlarge
+    # workers 600 s: 10 and 24 jobs an hour, for twice the price.
+    ctrl.type_durations = {"c5.large": [360.], "c5.xlarge": [600.]}
+    ctrl.instance_slots = {"i-1": ("c5.large", 1), "i-2": ("c5.xlarge", 4)}
+
+    requests = ctrl.boot_spot_instances("ami-1", ["c5.large", "c5.xlarge"],
+                                        nworkers=2, bid_factor=1.5)
+
+    assert len(requests) == 2
+    price, image_id, count, instance_type = ec2.requests[0]
+    assert (image_id, count, instance_type) == ("ami-1", 2, "c5.xlarge")
+    assert float(price) == pytest.approx(1.5 * 0.058)
+    assert ctrl.spot_requests == requests
+
+
+def test_boot_spot_instances_no_prices(ec2):
+    ctrl = make_controller()
+
+    with pytest.raises(ValueError):
+        ctrl.boot_spot_instances("ami-1", ["m5.large"], prices={})
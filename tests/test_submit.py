@@ -0,0 +1,122 @@
+# License under the MIT License - see LICENSE
+
+import base64
+import json
+
+from boto.sqs.message import Message
+
+from controller import Controller, MAX_BATCH_ENTRIES, MAX_BATCH_SIZE, \
+    MAX_MESSAGE_SIZE
+
+
+class FakeBatchResults(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+
+class FakeRequestQueue(object):
+    '''
+    Accepts batches within the SQS limits, and records the bodies sent.
+    '''
+    def __init__(self, fail_ids=()):
+        self.bodies = []
+        self.nbatches = 0
+        self.fail_ids = set(fail_ids)
+
+    def new_message(self, body=""):
+        return Message(body=body)
+
+    def write_batch(self, entries):
+        if any(entry[0] in self.fail_ids for entry in entries):
+            raise Exception("ServiceUnavailable")
+        if len(entries) > MAX_BATCH_ENTRIES:
+            raise Exception("TooManyEntriesInBatchRequest")
+        if sum(len(entry[1]) for entry in entries) > MAX_BATCH_SIZE:
+            raise Exception("BatchRequestTooLong")
+
+        self.nbatches += 1
+        response = FakeBatchResults()
+        for entry_id, body, delay in entries:
+            self.bodies.append(base64.b64decode(body).decode("utf-8"))
+            response.results.append(
+                {"id": entry_id,
+                 "message_id": "msg-{}".format(len(self.bodies))})
+        return response
+
+
+def make_controller(files, fail_ids=()):
+    ctrl = Controller.__new__(Controller)
+    ctrl.job_name = "test"
+    ctrl.params = {"commands": ["run"]}
+    ctrl.data_files = files
+    ctrl.message_ids = {}
+    ctrl.units = {}
+    ctrl.unsent_jobs = {}
+    ctrl._request_queue = FakeRequestQueue(fail_ids)
+    return ctrl
+
+
+def test_packed_units_batched_by_size():
+    files = ["file_{}.fits".format(i) for i in range(40)]
+    ctrl = make_controller(files)
+    # Each job is ~50 Kb, so a unit holds only a few and 10 units are well
+    # over the limit for a batch.
+    commands = ["echo " + "x" * 50000]
+
+    units = ctrl.new_packed_message(commands=commands, num_workers=2,
+                                    max_retries=0, target_runtime=1e6)
+
+    queue = ctrl._request_queue
+    assert len(queue.bodies) == len(units)
+    assert sum(len(body) for body in queue.bodies) > MAX_BATCH_SIZE
+    # Still within the limit once base64-encoded.
+    assert all(len(body) * 4 / 3. <= MAX_MESSAGE_SIZE
+               for body in queue.bodies)
+    assert queue.nbatches > 1
+
+    assert ctrl.njobs == 40
+    sent = [job["proc_name"] for body in queue.bodies
+            for job in json.loads(body)["jobs"]]
+    assert sorted(sent) == sorted(ctrl.message_ids.keys())
+
+
+def test_small_messages_batched_by_ten():
+    files = ["file_{}.fits".format(i) for i in range(25)]
+    ctrl = make_controller(files)
+
+    message_ids = ctrl.new_sqs_message(max_retries=0)
+
+    assert len(message_ids) == 25
+    assert ctrl._request_queue.nbatches == 3
+
+
+def test_message_bodies_encoded():
+    ctrl = make_controller(["file_0.fits"])
+
+    ctrl.new_sqs_message(max_retries=0)
+
+    # Read back as the worker's queue does.
+    body = json.loads(ctrl._request_queue.bodies[0])
+    assert body["proc_name"] == "test_0"
+    assert body["key_name"] == "file_0.fits"
+
+
+def test_failed_batch_reported():
+    files = ["file_{}.fits".format(i) for i in range(25)]
+    # The second batch holds jobs 10 to 19.
+    ctrl = make_controller(files, fail_ids=["15"])
+
+    message_ids = ctrl.new_sqs_message(num_workers=2, max_retries=0)
+
+    unsent = ["test_{}".format(i) for i in range(10, 20)]
+    assert sorted(ctrl.unsent_jobs.keys()) == sorted(unsent)
+    assert "ServiceUnavailable" in ctrl.unsent_jobs["test_15"]
+    # The other batches are still sent and recorded.
+    assert len(message_ids) == 15
+    assert ctrl.njobs == 15
+
+    # Jobs added later do not reuse the numbers of those not sent.
+    ctrl._request_queue.fail_ids = set()
+    ctrl.new_sqs_message(files=["more.fits"], append=True, max_retries=0)
+    assert "test_25" in ctrl.message_ids
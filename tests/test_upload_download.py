@@ -0,0 +1,129 @@
+# License under the MIT License - see LICENSE
+
+import os
+
+from boto.s3.bucket import Bucket
+from boto.s3.multipart import MultiPartUpload
+import pytest
+
+from upload_download_s3 import auto_multipart_upload, download_from_s3, \
+    ranged_download, remove_s3_bucket, remove_s3_key
+
+MB = 1048576
+
+
+def make_file(folder, name, size):
+    filename = os.path.join(str(folder), name)
+    with open(filename, "wb") as f:
+        f.write(os.urandom(size))
+    return filename
+
+
+def read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def test_multipart_upload_concurrent(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, "big.dat", 12 * MB + 123)
+
+    auto_multipart_upload(filename, s3_bucket, "big.dat", max_size=5 * MB,
+                          chunk_size=5 * MB, num_workers=4)
+
+    key = s3_bucket.get_key("big.dat")
+    assert key.size == 12 * MB + 123
+    # Three parts of 5, 5 and 2 Mb.
+    assert key.etag.strip('"').endswith("-3")
+    assert key.get_contents_as_string() == read(filename)
+
+
+def test_multipart_upload_no_parts_left(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, "big.dat", 11 * MB)
+
+    auto_multipart_upload(filename, s3_bucket, "big.dat", max_size=5 * MB,
+                          chunk_size=5 * MB, num_workers=2)
+
+    assert len(list(s3_bucket.list_multipart_uploads())) == 0
+
+
+def test_multipart_upload_cancelled_on_failure(s3_bucket, tmpdir,
+                                               monkeypatch):
+    filename = make_file(tmpdir, "big.dat", 11 * MB)
+
+    def fail(self):
+        raise IOError("Failed to complete.")
+
+    monkeypatch.setattr(MultiPartUpload, "complete_upload", fail)
+
+    with pytest.raises(IOError):
+        auto_multipart_upload(filename, s3_bucket, "big.dat",
+                              max_size=5 * MB, chunk_size=5 * MB,
+                              num_workers=2)
+
+    # The parts already sent are removed.
+    assert len(list(s3_bucket.list_multipart_uploads())) == 0
+    assert s3_bucket.get_key("big.dat") is None
+
+
+def test_ranged_download(s3_bucket, tmpdir):
+    filename = make_file(tmpdir, "data.dat", 3 * MB + 7)
+    s3_bucket.new_key("data.dat").set_contents_from_filename(filename)
+
+    out_file = os.path.join(str(tmpdir), "out.dat")
+    ranged_download(s3_bucket.get_key("data.dat"), out_file,
+                    range_size=MB, num_workers=3)
+
+    assert read(out_file) == read(filename)
+
+
+def test_download_wildcard_concurrent(s3_bucket, tmpdir):
+    contents = {}
+    for i in range(5):
+        name = "inputs/part_{}.dat".format(i)
+        contents[name] = os.urandom(1000 + i)
+        s3_bucket.new_key(name).set_contents_from_string(contents[name])
+    # Large enough to be fetched in ranges.
+    contents["inputs/large.dat"] = os.urandom(2 * MB + 1)
+    s3_bucket.new_key("inputs/large.dat").set_contents_from_string(
+        contents["inputs/large.dat"])
+    s3_bucket.new_key("other.dat").set_contents_from_string(b"other")
+
+    output_dir = str(tmpdir.mkdir("out"))
+    out_files = download_from_s3("inputs/*", s3_bucket.name,
+                                 conn=s3_bucket.connection,
+                                 output_dir=output_dir, num_workers=4,
+                                 range_size=MB, range_threshold=MB)
+
+    assert len(out_files) == 6
+    for name in contents:
+        assert read(os.path.join(output_dir, name)) == contents[name]
+    assert not os.path.exists(os.path.join(output_dir, "other.dat"))
+
+
+def test_remove_keys(s3_bucket):
+    for i in range(5):
+        s3_bucket.new_key("out/{}.txt".format(i)).set_contents_from_string("a")
+    s3_bucket.new_key("keep.txt").set_contents_from_string("a")
+
+    stats = remove_s3_key("out/*", s3_bucket.name, s3_bucket.connection)
+
+    assert stats["deleted"] == 5
+    assert [key.name for key in s3_bucket.list()] == ["keep.txt"]
+
+
+def test_remove_bucket_raises_on_errors(s3_bucket, monkeypatch):
+    s3_bucket.new_key("a.txt").set_contents_from_string("a")
+
+    def fail(self, keys, quiet=False):
+        raise IOError("Access denied.")
+
+    monkeypatch.setattr(Bucket, "delete_keys", fail)
+
+    with pytest.raises(IOError) as excinfo:
+        remove_s3_bucket(s3_bucket.name, s3_bucket.connection,
+                         max_retries=0)
+    assert "a.txt" in str(excinfo.value)
+
+    # The bucket is kept while it still holds keys.
+    monkeypatch.undo()
+    assert s3_bucket.connection.lookup(s3_bucket.name) is not None
@@ -0,0 +1,88 @@
+# License under the MIT License - see LICENSE
+
+import os
+import threading
+
+import controller
+from controller import Controller
+
+
+def make_controller(monkeypatch, fail=()):
+    uploaded = []
+
+    def upload_to_s3(bucket_name, dat, create_bucket=True, **kwargs):
+        if dat in fail:
+            raise IOError("Connection reset.")
+        uploaded.append((bucket_name, dat))
+
+    monkeypatch.setattr(controller, "upload_to_s3", upload_to_s3)
+
+    ctrl = Controller.__new__(Controller)
+    ctrl.credentials = {}
+    return ctrl, uploaded
+
+
+def make_files(folder, sizes):
+    files = []
+    for i, size in enumerate(sizes):
+        filename = os.path.join(str(folder), "file_{}.fits".format(i))
+        with open(filename, "wb") as f:
+            f.write(b"x" * size)
+        files.append(filename)
+    return files
+
+
+def test_failed_item_does_not_stop_others(tmpdir, monkeypatch):
+    files = make_files(tmpdir, [10, 20, 30])
+    ctrl, uploaded = make_controller(monkeypatch, fail=[files[1]])
+
+    assert not ctrl.upload_request(files, bucket_name="bucket",
+                                   num_workers=2)
+
+    assert sorted(dat for _, dat in uploaded) == [files[0], files[2]]
+    track = ctrl.track_uploaded
+    assert track[files[0]]["status"] == "Success"
+    assert track[files[0]]["bytes"] == 10
+    assert track[files[2]]["bytes"] == 30
+    assert track[files[1]]["status"] == "Failed"
+    assert "Connection reset." in track[files[1]]["error"]
+    assert track[files[1]]["throughput"] is None
+
+
+def test_serial_upload_stops_at_failure(tmpdir, monkeypatch):
+    files = make_files(tmpdir, [10, 20])
+    ctrl, uploaded = make_controller(monkeypatch, fail=[files[0]])
+
+    assert not ctrl.upload_request(files, bucket_name="bucket")
+
+    assert uploaded == []
+    assert ctrl.track_uploaded[files[1]]["status"] == "Pending"
+
+
+def test_nonblocking_items_as_completed(tmpdir, monkeypatch):
+    files = make_files(tmpdir, [10, 20, 30])
+    ctrl, uploaded = make_controller(monkeypatch)
+
+    # The last item is held back until the first two have been returned.
+    release = threading.Event()
+    upload = controller.upload_to_s3
+
+    def held_upload(bucket_name, dat, **kwargs):
+        if dat == files[2]:
+            release.wait(10)
+        upload(bucket_name, dat, **kwargs)
+
+    monkeypatch.setattr(controller, "upload_to_s3", held_upload)
+
+    handle = ctrl.upload_request(files, bucket_name="bucket",
+                                 num_workers=3, block=False)
+
+    completed = handle.as_completed(timeout=10)
+    first = [next(completed), next(completed)]
+    assert sorted(first) == files[:2]
+    assert not handle.ready()
+
+    release.set()
+    assert list(completed) == [files[2]]
+    assert handle.wait(timeout=10)
+    assert handle.successful()
@@ -0,0 +1,180 @@
+# License under the MIT License - see LICENSE
+
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import worker
+from benchmark import LocalQueue
+
+
+@pytest.fixture
+def queues(monkeypatch):
+    '''
+    In-process queues in place of SQS, by name.
+    '''
+
+    queues = {}
+
+    def get_queue(conn, queue_name):
+        return queues.setdefault(queue_name, LocalQueue(queue_name))
+
+    monkeypatch.setattr(worker, "get_sqs_connection",
+                        lambda region, credentials: None)
+    monkeypatch.setattr(worker, "get_queue", get_queue)
+    # Not on EC2.
+    monkeypatch.setitem(worker._instance_info, "instance_id", None)
+    monkeypatch.setitem(worker._instance_info, "instance_type", None)
+    monkeypatch.setitem(worker._instance_info, "image_id", None)
+
+    return get_queue
+
+
+def make_worker(tmpdir):
+    return worker.Worker("requests", "key", "secret",
+                         work_dir=str(tmpdir.mkdir("work")))
+
+
+def test_malformed_messages_deleted(tmpdir, queues):
+    requests = queues(None, "requests")
+    requests.write(requests.new_message("not json"))
+    # Names its job, but has no key or command.
+    requests.write(requests.new_message(json.dumps({"proc_name": "job_1",
+                                                    "bucket": "bucket"})))
+
+    work = make_worker(tmpdir)
+    assert work.run("results", idle_time=0) == 0
+
+    # Neither returns to the queue.
+    assert requests.get_messages(10) == []
+
+    results = [json.loads(mess.get_body())
+               for mess in queues(None, "results").get_messages(10)]
+    assert len(results) == 2
+    assert results[0]["proc_name"] == "job_1"
+    assert not results[0]["success"]
+    assert "not a valid job" in results[0]["messages"]["receive_message"]
+    assert results[1]["status"] == "idle"
+
+
+def test_pipelined_download_time_excludes_polling(tmpdir, queues,
+                                                  monkeypatch):
+    requests = queues(None, "requests")
+    for i in range(2):
+        requests.write(requests.new_message(json.dumps(
+            {"proc_name": "job_{}".format(i), "bucket": "bucket",
+             "key_name": "data.fits", "command": []})))
+
+    receive = worker.Worker.receive_message
+
+    def slow_receive(self, *args, **kwargs):
+        # A long poll waiting for the message.
+        time.sleep(0.2)
+        receive(self, *args, **kwargs)
+
+    monkeypatch.setattr(worker.Worker, "receive_message", slow_receive)
+    for phase in ["download_data", "execute", "upload_results",
+                  "send_result_message"]:
+        monkeypatch.setattr(worker.Worker, phase,
+                            lambda self, *args, **kwargs: None)
+
+    stats = worker.run_pipelined("requests", "key", "secret", "results",
+                                 base_dir=str(tmpdir), idle_time=0,
+                                 min_free_bytes=0)
+
+    assert stats["njobs"] == 2
+    assert stats["download_time"] < 0.1
+    assert requests.get_messages(10) == []
+
+
+def test_job_slots_run_side_by_side(tmpdir, queues, monkeypatch):
+    requests = queues(None, "requests")
+    for i in range(4):
+        requests.write(requests.new_message(json.dumps(
+            {"proc_name": "job_{}".format(i), "bucket": "bucket",
+             "key_name": "data.fits", "command": []})))
+
+    lock = threading.Lock()
+    running = {"now": 0, "most": 0}
+    work_dirs = set()
+
+    def execute(self, **kwargs):
+        with lock:
+            running["now"] += 1
+            running["most"] = max(running["most"], running["now"])
+            work_dirs.add(self.work_dir)
+        time.sleep(0.2)
+        with lock:
+            running["now"] -= 1
+
+    monkeypatch.setattr(worker.Worker, "execute", execute)
+    for phase in ["download_data", "upload_results"]:
+        monkeypatch.setattr(worker.Worker, phase,
+                            lambda self, *args, **kwargs: None)
+
+    base_dir = tmpdir.mkdir("slots")
+    njobs = worker.run_job_slots("requests", "key", "secret", "results",
+                                 nslots=2, base_dir=str(base_dir),
+                                 idle_time=0)
+
+    assert njobs == 4
+    assert running["most"] == 2
+    assert len(work_dirs) == 2
+    # The slot folders are removed once the slots stop.
+    assert os.listdir(str(base_dir)) == []
+
+    results = [json.loads(mess.get_body())
+               for mess in queues(None, "results").get_messages(10)]
+    # A single status message for the instance, after the jobs.
+    statuses = [result for result in results if "status" in result]
+    assert len(results) == 5
+    assert len(statuses) == 1
+    assert statuses[0] is results[-1]
+
+
+def test_run_command_usage(tmpdir):
+    # Holds ~50 Mb, and writes 1 Mb to a file.
+    code = ("import os, sys; data = bytearray(50 * 1048576); "
+            "f = open('out.dat', 'wb'); f.write(data[:1048576]); "
+            "f.close(); sys.exit(3)")
+
+    usage = worker.run_command([sys.executable, "-c", code],
+                               cwd=str(tmpdir))
+
+    assert usage["returncode"] == 3
+    assert usage["max_rss"] > 50 * 1048576
+    assert usage["duration"] > 0
+    assert usage["user_time"] + usage["sys_time"] > 0
+    if os.path.exists("/proc/self/io"):
+        assert usage["io"]["wchar"] >= 1048576
+
+
+def test_result_timings(tmpdir, queues, monkeypatch):
+    requests = queues(None, "requests")
+    code = ("import os; open(os.path.join(os.environ['PRODUCTS_DIR'], "
+            "'out.txt'), 'w').write('done')")
+    requests.write(requests.new_message(json.dumps(
+        {"proc_name": "job_1", "bucket": "bucket", "key_name": "data.fits",
+         "command": [[sys.executable, "-c", code]]})))
+
+    for phase in ["download_data", "upload_results"]:
+        monkeypatch.setattr(worker.Worker, phase,
+                            lambda self, *args, **kwargs: None)
+
+    work = make_worker(tmpdir)
+    assert work.run("results", idle_time=0) == 1
+
+    result = json.loads(queues(None, "results").get_messages(1)[0]
+                        .get_body())
+    assert result["success"]
+    timings = result["timings"]
+    assert timings["receive"]["duration"] >= 0
+    execute = timings["execute"]
+    assert execute["duration"] > 0
+    assert len(execute["commands"]) == 1
+    assert execute["commands"][0]["returncode"] == 0
+    assert execute["commands"][0]["max_rss"] > 0
@@ -0,0 +1,196 @@
+# License under the MIT License - see LICENSE
+
+'''
+Choose the part size of multi-part uploads and ranged downloads, and
+optionally tune the part size and concurrency during a transfer from the
+throughput measured.
+'''
+
+import math
+import threading
+
+from utils import monotonic
+
+
+MB = 1048576
+
+# S3 limits for multi-part uploads. All parts but the last must be at least
+# 5 Mb, and no part can be over 5 Gb.
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * 1024 * MB
+
+
+def _round_up_mb(size):
+    return int(math.ceil(size / float(MB))) * MB
+
+
+def choose_part_size(size, part_size=52428800, num_workers=1,
+                     max_parts=MAX_PARTS, min_part_size=MIN_PART_SIZE,
+                     max_part_size=MAX_PART_SIZE):
+    '''
+    Choose the part size to split a file of `size` bytes into.
+
+    The preferred `part_size` is reduced so each of `num_workers` has a part
+    to transfer, and increased so the file fits into `max_parts` parts. The
+    result is a whole number of megabytes, which keeps the multi-part ETag
+    predictable (see `upload_download_s3.infer_part_size`).
+
+    Parameters
+    ----------
+    size : int
+        Size of the file in bytes.
+    part_size : int, optional
+        Preferred part size. Defaults to 50 Mb.
+    num_workers : int, optional
+        Number of parts transferred at once.
+    max_parts : int, optional
+        Largest number of parts. S3 allows 10,000.
+    min_part_size : int, optional
+        Smallest part size. S3 requires 5 Mb for uploads.
+    max_part_size : int, optional
+        Largest part size. S3 allows 5 Gb.
+
+    Returns
+    -------
+    part_size : int
+        Part size in bytes.
+    '''
+
+    if num_workers > 1 and size > 0:
+        part_size = min(part_size, _round_up_mb(size / float(num_workers)))
+
+    part_size = max(part_size, _round_up_mb(size / float(max_parts)),
+                    min_part_size)
+
+    if part_size > max_part_size:
+        if size > max_part_size * max_parts:
+            raise ValueError("{0} bytes is too large to upload in {1} parts"
+                             " of at most {2} bytes.".format(size, max_parts,
+                                                             max_part_size))
+        part_size = max_part_size
+
+    return _round_up_mb(part_size)
+
+
+class TransferTuner(object):
+    '''
+    Choose the size and concurrency of the parts of a transfer as it runs.
+
+    Without `adapt`, parts are `part_size` (grown only to stay within
+    `max_parts`) and `num_workers` are sent at once. With `adapt`:
+
+    * The part size is doubled when parts finish in under
+      `min_part_time` seconds, where the per-request overhead dominates, and
+      halved when they take over `max_part_time`, where a failed part is
+      costly to retry.
+    * The concurrency is hill-climbed: after each window of `num_workers`
+      parts, the throughput of the window is compared to the previous one.
+      The concurrency keeps moving in the same direction while the
+      throughput improves by at least `min_gain`, and turns back otherwise.
+
+    Parameters
+    ----------
+    part_size : int
+        Initial part size.
+    num_workers : int
+        Initial number of parts to transfer at once.
+    max_workers : int, optional
+        Largest number of parts to transfer at once. Defaults to
+        `2 * num_workers` with `adapt` and `num_workers` otherwise.
+    adapt : bool, optional
+        Tune the part size and concurrency from the measured throughput.
+    min_part_size : int, optional
+        Smallest part size.
+    max_part_size : int, optional
+        Largest part size.
+    max_parts : int, optional
+        Largest number of parts, or None for no limit.
+    min_part_time : float, optional
+        Grow parts that finish faster than this, in seconds.
+    max_part_time : float, optional
+        Shrink parts that take longer than this, in seconds.
+    min_gain : float, optional
+        Fractional gain in throughput needed to keep changing the
+        concurrency in the same direction.
+    '''
+    def __init__(self, part_size, num_workers, max_workers=None, adapt=False,
+                 min_part_size=MIN_PART_SIZE, max_part_size=MAX_PART_SIZE,
+                 max_parts=MAX_PARTS, min_part_time=2., max_part_time=30.,
+                 min_gain=0.05):
+        super(TransferTuner, self).__init__()
+
+        if max_workers is None:
+            max_workers = 2 * num_workers if adapt else num_workers
+
+        self.part_size = max(min(part_size, max_part_size), min_part_size)
+        self.num_workers = max(1, min(num_workers, max_workers))
+        self.max_workers = max(1, max_workers)
+        self.adapt = adapt
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.max_parts = max_parts
+        self.min_part_time = min_part_time
+        self.max_part_time = max_part_time
+        self.min_gain = min_gain
+
+        self.nparts = 0
+        # (part size, concurrency, throughput in bytes/s) of each window.
+        self.history = []
+
+        self._direction = 1
+        self._last_throughput = None
+        self._window_start = monotonic()
+        self._window_bytes = 0
+        self._window_parts = 0
+        self._lock = threading.Lock()
+
+    def next_part_size(self, remaining):
+        '''
+        Size of the next part, given the number of bytes left to transfer.
+        '''
+
+        with self._lock:
+            size = self.part_size
+            if self.max_parts is not None:
+                parts_left = max(1, self.max_parts - self.nparts)
+                size = max(size, int(math.ceil(remaining / float(parts_left))))
+            self.nparts += 1
+            return min(size, remaining)
+
+    def record(self, nbytes, seconds):
+        '''
+        Record a finished part of `nbytes` that took `seconds`.
+        '''
+
+        if not self.adapt:
+            return
+
+        with self._lock:
+            if seconds < self.min_part_time:
+                self.part_size = min(2 * self.part_size, self.max_part_size)
+            elif seconds > self.max_part_time:
+                self.part_size = max(self.part_size // 2, self.min_part_size)
+
+            self._window_bytes += nbytes
+            self._window_parts += 1
+            if self._window_parts < self.num_workers:
+                return
+
+            now = monotonic()
+            elapsed = now - self._window_start
+            throughput = self._window_bytes / elapsed if elapsed > 0 else 0.
+            self.history.append((self.part_size, self.num_workers,
+                                 throughput))
+
+            if self._last_throughput is not None and \
+                    throughput < (1 + self.min_gain) * self._last_throughput:
+                self._direction = -self._direction
+
+            self._last_throughput = throughput
+            self.num_workers = max(1, min(self.num_workers + self._direction,
+                                          self.max_workers))
+
+            self._window_start = now
+            self._window_bytes = 0
+            self._window_parts = 0
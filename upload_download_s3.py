@@ -3,11 +3,22 @@
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from boto.s3.lifecycle import Lifecycle, Expiration, Rule
+from multiprocessing.pool import ThreadPool
 import os
 import math
 import fnmatch
+import hashlib
+import time
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
-from utils import timestring
+from utils import timestring, monotonic
+from transfer_tuner import choose_part_size, TransferTuner, MB
+from connections import get_s3_connection, get_bucket, new_bucket, \
+    forget_bucket, thread_connection, thread_bucket, thread_multipart
+from upload_manifest import UploadManifest
 
 try:
     from filechunkio import FileChunkIO
@@ -17,14 +28,24 @@ except ImportError:
     Warning("The filechunkio library could not be imported. Uploading large "
             "files will result in an error.")
 
+# Characters that start a wildcard in a key name.
+GLOB_CHARS = "*?["
+
+# Default part sizes of common S3 clients (e.g., 8 Mb for the AWS CLI and
+# boto3), tried when inferring the part size of an upload.
+COMMON_PART_SIZES = [8 * MB, 5 * MB, 15 * MB, 16 * MB, 50 * MB, 100 * MB]
+
 
 def upload_to_s3(bucket_name, upload_item,
                  create_bucket=False, chunk_size=52428800, conn=None,
-                 aws_access={}, replace=False, key_prefix=None):
+                 aws_access={}, replace=False, key_prefix=None,
+                 num_workers=1, max_retries=3, sync=False, manifest=None,
+                 autotune=False):
     '''
     Upload a file or folder to an S3 bucket. Optionally, a new bucket can be
     created. For files larger than 50 Mb (by default), downloads are split
     into chunks. *This requires installing the FileChunkIO library.*
+    The chunks can be uploaded concurrently by setting `num_workers`.
 
     Folder uploading is modeled from: https://gist.github.com/SavvyGuard/6115006
 
@@ -38,9 +59,11 @@ def upload_to_s3(bucket_name, upload_item,
         Set whether to create a new bucket. An error is raised if the bucket
         already exists.
     chunksize : int, optional
-        Size of chunks to split a multi-part upload into. Default to 50 Mb.
+        Preferred size of chunks to split a multi-part upload into. Default
+        to 50 Mb. See `auto_multipart_upload`.
     conn : boto.s3.connection.S3Connection, optional
-        A connection to S3. Otherwise, one is created.
+        A connection to S3. Otherwise, one is created. A connection to a
+        local S3 stand-in (e.g., moto) can be given here for testing.
     aws_access : dict, optional
         Dictionary where aws_access_key_id and aws_secret_access_key can be
         given to open a connection. Not needed if your credentials are set
@@ -49,38 +72,44 @@ def upload_to_s3(bucket_name, upload_item,
         Allow files to be overwritten if the key already exists.
     key_prefix : str, optional
         Add a prefix for the bucket key name.
+    num_workers : int, optional
+        Number of parts of a multi-part upload to send at once.
+    max_retries : int, optional
+        Number of times to retry a failed part before aborting the upload.
+    sync : bool, optional
+        Only upload files that are new or have changed, overwriting the
+        changed keys. Files are compared by their ETag, which is cached in
+        a local manifest along with the size and modification time.
+    manifest : str or UploadManifest, optional
+        Manifest file to use with `sync`. Defaults to
+        `~/.aws_controller/upload_manifest.json`.
+    autotune : bool, optional
+        Tune the part size and concurrency of multi-part uploads from the
+        measured throughput. Not used with `sync`.
     '''
 
     # Create S3 connection if none are given.
     if conn is None:
-        if "aws_access_key_id" in aws_access.keys() and "aws_secret_access_key" in aws_access.keys():
-            conn = S3Connection(**aws_access)
-        elif len(aws_access.keys()) > 0:
-            raise KeyError("aws_access must contain 'aws_access_key_id'"
-                           " and 'aws_secret_access_key'. All other"
-                           " entries are ignored.")
-        else:
-            # Use the AWS Keys saved on your machine.
-            conn = S3Connection()
+        conn = return_s3_connection(aws_access)
     else:
         if not isinstance(conn, S3Connection):
             raise TypeError("conn provided is not an S3 Connection.")
+        # Uploads may run side-by-side (e.g., Controller.upload_request).
+        conn = thread_connection(conn)
 
     # Check if that bucket exists. Otherwise create a new one if asked for.
-    existing_buckets = [b.name for b in conn.get_all_buckets()]
-    bucket_exists = True if bucket_name in existing_buckets else False
-
-    if bucket_exists and create_bucket:
-        raise Warning("The bucket name given '" + bucket_name +
-                      "' already exists.")
-
     if create_bucket:
-        bucket = conn.create_bucket(bucket_name)
+        if conn.lookup(bucket_name) is not None:
+            raise Warning("The bucket name given '" + bucket_name +
+                          "' already exists.")
+        bucket = new_bucket(conn, bucket_name)
     else:
-        bucket = conn.get_bucket(bucket_name)
+        bucket = get_bucket(conn, bucket_name)
 
     key_name = upload_item.rstrip("/").split("/")[-1]
 
+    upload_files = []
+
     # Now check if the item to upload is a file or folder
     if os.path.isdir(upload_item):
         # Walk through the folder structure.
@@ -98,23 +127,129 @@ def upload_to_s3(bucket_name, upload_item,
                     full_key_name = os.path.join(key_prefix, full_key_path,
                                                  filename)
 
-                auto_multipart_upload(full_filename, bucket, full_key_name,
-                                      replace=replace, chunk_size=chunk_size)
+                upload_files.append((full_filename, full_key_name))
     elif os.path.isfile(upload_item):
         if key_prefix is not None:
             key_name = os.path.join(key_prefix, key_name)
-        auto_multipart_upload(upload_item, bucket, key_name, replace=replace,
-                              chunk_size=chunk_size)
+        upload_files.append((upload_item, key_name))
     else:
         raise TypeError(upload_item + " is not an existing file or folder."
                         " Check given input.")
 
+    if sync and not isinstance(manifest, UploadManifest):
+        manifest = UploadManifest(manifest)
+
+    try:
+        for filename, file_key_name in upload_files:
+            if sync:
+                sync_upload(filename, bucket, file_key_name, manifest,
+                            chunk_size=chunk_size, num_workers=num_workers,
+                            max_retries=max_retries)
+            else:
+                auto_multipart_upload(filename, bucket, file_key_name,
+                                      replace=replace, chunk_size=chunk_size,
+                                      num_workers=num_workers,
+                                      max_retries=max_retries,
+                                      autotune=autotune)
+    finally:
+        # Keep the record of whatever was uploaded before any failure.
+        if sync:
+            manifest.save()
+
+
+def sync_upload(filename, bucket, key_name, manifest, max_size=104857600,
+                chunk_size=52428800, num_workers=1, max_retries=3):
+    '''
+    Upload a file only if the key does not exist, or if its ETag differs
+    from the file's. The ETag of the file is taken from the manifest when
+    its size and modification time are unchanged, and otherwise computed.
+
+    Parameters
+    ----------
+    filename : str
+        File to upload.
+    bucket : boto.s3.bucket.Bucket
+        Bucket to upload to.
+    key_name : str
+        Name of the key.
+    manifest : UploadManifest
+        Record of previously uploaded files. The file is added to it.
+    max_size : int, optional
+        Size above which a multi-part upload is used.
+    chunk_size : int, optional
+        Size of the parts in a multi-part upload.
+    num_workers : int, optional
+        Number of parts to upload at once.
+    max_retries : int, optional
+        Number of times to retry a failed part.
+
+    Returns
+    -------
+    uploaded : bool
+        Whether the file was uploaded.
+    '''
+
+    source_size = os.stat(filename).st_size
+    # The part size only depends on the file and chunk_size, not on the
+    # number of workers, so the ETag is the same from one sync to the next.
+    part_size = choose_part_size(source_size, chunk_size) \
+        if source_size > max_size else None
+
+    entry = manifest.lookup(filename, bucket.name, key_name)
+    if entry is not None:
+        local_etag = entry["etag"]
+    else:
+        local_etag = compute_etag(filename, part_size=part_size)
+
+    remote = bucket.get_key(key_name)
+
+    if remote is not None:
+        remote_etag = remote.etag.strip('"')
+
+        # The key may have been uploaded with another part size, giving a
+        # different multi-part ETag for the same contents.
+        if remote_etag != local_etag and "-" in remote_etag and \
+                remote.size == source_size:
+            part_sizes = [choose_part_size(source_size, chunk_size,
+                                           num_workers=num_workers)]
+            if infer_part_size(filename, remote_etag,
+                               part_sizes=part_sizes) is not None:
+                local_etag = remote_etag
+
+        if remote_etag == local_etag:
+            manifest.record(filename, bucket.name, key_name, local_etag)
+            return False
+
+    auto_multipart_upload(filename, bucket, key_name, max_size=max_size,
+                          chunk_size=chunk_size, replace=True,
+                          num_workers=num_workers, max_retries=max_retries,
+                          part_size=part_size)
+
+    manifest.record(filename, bucket.name, key_name, local_etag)
+
+    return True
+
 
 def auto_multipart_upload(filename, bucket, key_name, max_size=104857600,
-                          chunk_size=52428800, replace=False):
+                          chunk_size=52428800, replace=False, num_workers=1,
+                          max_retries=3, autotune=False, max_workers=None,
+                          part_size=None):
     '''
     Based on the size of the file to be uploaded, automatically partition into
     a multi-part upload.
+
+    The part size starts from `chunk_size`, and is reduced so each of the
+    `num_workers` has a part to upload, or increased to stay within the
+    10,000 part limit (see `transfer_tuner.choose_part_size`). A fixed
+    `part_size` can be given instead, e.g. to get a known ETag. With
+    `autotune`, the part size and the number of parts sent at once are then
+    adjusted from the throughput of the parts uploaded so far, up to
+    `max_workers` at once (see `transfer_tuner.TransferTuner`).
+
+    Parts are read straight from disk by each worker, so no more than
+    `num_workers` parts are held in flight at once. Each part is retried up
+    to `max_retries` times. If a part still fails, the multi-part upload is
+    aborted so the partial parts are not left (and billed) in the bucket.
     '''
 
     source_size = os.stat(filename).st_size
@@ -122,8 +257,7 @@ def auto_multipart_upload(filename, bucket, key_name, max_size=104857600,
     # Check if the given key (ie. file or folder name) already exists in
     # the bucket.
     if not replace:
-        all_key_names = [k.name for k in bucket.get_all_keys()]
-        if key_name in all_key_names:
+        if key_exists(bucket, key_name):
             raise KeyError(key_name + " already exists in the bucket " +
                            bucket.name + ". Please choose a new key name.")
 
@@ -134,15 +268,23 @@ def auto_multipart_upload(filename, bucket, key_name, max_size=104857600,
                               " at your own risk.")
         mp = bucket.initiate_multipart_upload(key_name)
 
-        nchunks = int(math.ceil(source_size / float(chunk_size)))
-
-        for i in range(nchunks):
-            offset = chunk_size * i
-            bytes = min(chunk_size, source_size - offset)
-            with FileChunkIO(filename, 'r', offset=offset, bytes=bytes) as fp:
-                mp.upload_part_from_file(fp, part_num=i+1)
+        if part_size is None:
+            part_size = choose_part_size(source_size, chunk_size,
+                                         num_workers)
+        tuner = TransferTuner(part_size, num_workers, max_workers=max_workers,
+                              adapt=autotune)
 
-        mp.complete_upload()
+        # The parts of an upload that fails to complete are billed until
+        # it is cancelled.
+        try:
+            _transfer_parts(source_size, tuner, _upload_part,
+                            lambda part_num, offset, nbytes:
+                            (mp, filename, part_num, offset, nbytes,
+                             max_retries))
+            mp.complete_upload()
+        except Exception:
+            mp.cancel_upload()
+            raise
 
     else:
         # Single part upload
@@ -151,12 +293,88 @@ def auto_multipart_upload(filename, bucket, key_name, max_size=104857600,
         k.set_contents_from_filename(filename, replace=replace)
 
 
+def _transfer_parts(size, tuner, func, make_args):
+    '''
+    Transfer `size` bytes as consecutive parts, with the part sizes and the
+    number of parts in flight set by a `TransferTuner`. Each part is passed
+    to `func` as `make_args(part_num, offset, nbytes)`, and its time is
+    reported back to the tuner. The first failed part is raised.
+    '''
+
+    if size == 0:
+        return 0
+
+    done = Queue()
+
+    def run(part_args, nbytes):
+        t0 = monotonic()
+        try:
+            func(part_args)
+            done.put((nbytes, monotonic() - t0, None))
+        except Exception as exc:
+            done.put((nbytes, monotonic() - t0, exc))
+
+    pool = ThreadPool(tuner.max_workers)
+    try:
+        offset = 0
+        part_num = 0
+        in_flight = 0
+        while offset < size or in_flight > 0:
+            while offset < size and in_flight < tuner.num_workers:
+                nbytes = tuner.next_part_size(size - offset)
+                part_num += 1
+                pool.apply_async(run, (make_args(part_num, offset, nbytes),
+                                       nbytes))
+                offset += nbytes
+                in_flight += 1
+
+            nbytes, seconds, exc = done.get()
+            in_flight -= 1
+            if exc is not None:
+                raise exc
+            tuner.record(nbytes, seconds)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return part_num
+
+
+def _upload_part(args):
+    '''
+    Upload a single part of a multi-part upload, retrying on failure.
+    '''
+
+    mp, filename, part_num, offset, bytes, max_retries = args
+
+    mp = thread_multipart(mp)
+
+    for attempt in range(max_retries + 1):
+        try:
+            with FileChunkIO(filename, 'r', offset=offset, bytes=bytes) as fp:
+                mp.upload_part_from_file(fp, part_num=part_num)
+            return part_num
+        except Exception:
+            if attempt == max_retries:
+                raise
+            # Back off before trying again.
+            time.sleep(2 ** attempt)
+
+
 def download_from_s3(key_name, bucket_name, conn=None,
-                     aws_access={}, output_dir=None):
+                     aws_access={}, output_dir=None, num_workers=1,
+                     range_size=52428800, range_threshold=104857600,
+                     max_retries=3, verify=True, cache=None, cache_stats=None,
+                     autotune=False):
     '''
 
     Download a key from a S3 bucket and save to a given file name.
 
+    Keys larger than `range_threshold` are split into byte ranges of
+    `range_size` which are fetched concurrently and written in place into
+    the output file. When using wildcards, the smaller keys are downloaded
+    concurrently instead.
+
     Parameters
     ----------
     key_name : str
@@ -172,43 +390,347 @@ def download_from_s3(key_name, bucket_name, conn=None,
         on your machine.
     output_dir : str
         Path appended to the files downloaded.
+    num_workers : int, optional
+        Number of ranges or keys to download at once.
+    range_size : int, optional
+        Size of the byte ranges a large key is split into. Default to 50 Mb.
+    range_threshold : int, optional
+        Keys larger than this are downloaded in ranges. Default to 100 Mb.
+    max_retries : int, optional
+        Number of times to retry a failed range before raising an error.
+    verify : bool, optional
+        Check the downloaded files against the key's ETag or size.
+    cache : input_cache.InputCache, optional
+        Cache to fetch the keys through. Keys already in the cache (with the
+        same ETag) are linked into place instead of downloaded.
+    cache_stats : dict, optional
+        Cache hits and misses of this download are counted in this
+        dictionary.
+    autotune : bool, optional
+        Tune the range size and concurrency of ranged downloads from the
+        measured throughput.
+
+    Returns
+    -------
+    out_files : list
+        Names of the downloaded files.
     '''
 
     # Create S3 connection if none are given.
-    conn = return_s3_connection(aws_access) if conn is None else conn
+    conn = return_s3_connection(aws_access) if conn is None else \
+        thread_connection(conn)
 
     if output_dir is None:
         output_dir = ""
 
-    bucket = conn.get_bucket(bucket_name)
+    bucket = get_bucket(conn, bucket_name)
 
-    if "*" not in key_name:
+    download_kwargs = {"num_workers": num_workers, "range_size": range_size,
+                       "range_threshold": range_threshold,
+                       "max_retries": max_retries, "verify": verify,
+                       "cache": cache, "cache_stats": cache_stats,
+                       "autotune": autotune}
+
+    if not has_wildcard(key_name):
         key = bucket.get_key(key_name)
 
         # Strip out preceding directory and leave filename
         out_file = os.path.join(output_dir, key_name.split("/")[-1])
 
-        key.get_contents_to_filename(out_file)
+        return [_download_key((key, out_file, download_kwargs))]
     else:
-        all_keys = bucket.get_all_keys()
+        small_keys = []
+        large_keys = []
+        for key in iter_matching_keys(bucket, key_name):
+            out_file = os.path.join(output_dir, key.name)
+
+            # Check that the file structure exists. If not, create it.
+            folders = out_file.rstrip("/").split("/")[:-1]
+            slash_start = 0 if out_file.startswith("/") else 1
+            for folder in accumulator(folders, start_space=slash_start):
+                if os.path.isdir(folder):
+                    continue
+                os.mkdir(folder)
+
+            if key.size > range_threshold:
+                large_keys.append((key, out_file, download_kwargs))
+            else:
+                small_keys.append((key, out_file, download_kwargs))
+
+        out_files = []
+
+        # Many small keys are fetched side-by-side, while the large keys
+        # already use all the workers for their ranges.
+        if num_workers > 1 and len(small_keys) > 1:
+            pool = ThreadPool(min(num_workers, len(small_keys)))
+            try:
+                for out_file in pool.imap_unordered(_download_key,
+                                                    small_keys):
+                    out_files.append(out_file)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for args in small_keys:
+                out_files.append(_download_key(args))
+
+        for args in large_keys:
+            out_files.append(_download_key(args))
+
+        return out_files
+
+
+def _download_key(args):
+    '''
+    Download a single key, using ranged requests if it is large enough.
+    '''
+
+    key, out_file, kwargs = args
+
+    def fetch(filename):
+        if kwargs["num_workers"] > 1 and key.size > kwargs["range_threshold"]:
+            ranged_download(key, filename, range_size=kwargs["range_size"],
+                            num_workers=kwargs["num_workers"],
+                            max_retries=kwargs["max_retries"],
+                            autotune=kwargs["autotune"])
+        else:
+            Key(thread_bucket(key.bucket), key.name) \
+                .get_contents_to_filename(filename)
+
+        if kwargs["verify"]:
+            verify_download(key, filename)
+
+    if kwargs.get("cache") is not None:
+        kwargs["cache"].fetch(key, out_file, fetch,
+                              stats=kwargs.get("cache_stats"))
+    else:
+        fetch(out_file)
+
+    return out_file
+
+
+def ranged_download(key, out_file, range_size=52428800, num_workers=4,
+                    max_retries=3, autotune=False, max_workers=None):
+    '''
+    Download a key by fetching byte ranges concurrently. The output file is
+    allocated to the full size first and each range is written at its
+    offset. With `autotune`, the range size and the number of ranges fetched
+    at once (up to `max_workers`) are adjusted from the measured throughput.
+
+    Parameters
+    ----------
+    key : boto.s3.key.Key
+        Key to download. The size must be known (i.e., from `get_key` or a
+        bucket listing).
+    out_file : str
+        Name of the file to write to.
+    range_size : int, optional
+        Size of each byte range.
+    num_workers : int, optional
+        Number of ranges to download at once.
+    max_retries : int, optional
+        Number of times to retry a failed range.
+    autotune : bool, optional
+        Tune the range size and concurrency during the download.
+    max_workers : int, optional
+        Largest number of ranges to fetch at once with `autotune`. Defaults
+        to twice `num_workers`.
+    '''
+
+    size = key.size
 
-        for key in all_keys:
-            if fnmatch.fnmatchcase(key.name, key_name):
-                out_file = os.path.join(output_dir, key.name)
+    with open(out_file, "wb") as fp:
+        fp.truncate(size)
+        if hasattr(os, "posix_fallocate") and size > 0:
+            try:
+                os.posix_fallocate(fp.fileno(), 0, size)
+            except OSError:
+                # Not supported by all file systems. The file is sparse.
+                pass
 
-                # Check that the file structure exists. If not, create it.
-                folders = out_file.rstrip("/").split("/")[:-1]
-                slash_start = 0 if out_file.startswith("/") else 1
-                for folder in accumulator(folders, start_space=slash_start):
-                    if os.path.isdir(folder):
-                        continue
-                    os.mkdir(folder)
-                key.get_contents_to_filename(out_file)
+    # Ranges have no minimum size or limit on their number.
+    tuner = TransferTuner(range_size, num_workers, max_workers=max_workers,
+                          adapt=autotune, min_part_size=min(MB, range_size),
+                          max_parts=None)
 
+    _transfer_parts(size, tuner, _download_range,
+                    lambda part_num, start, nbytes:
+                    (key.bucket, key.name, out_file, start,
+                     start + nbytes - 1, max_retries))
 
-def remove_s3_bucket(bucket_name, connection):
+
+def _download_range(args):
+    '''
+    Download one byte range of a key into its place in the output file.
     '''
-    Delete entire bucket.
+
+    bucket, key_name, out_file, start, end, max_retries = args
+
+    headers = {"Range": "bytes={0}-{1}".format(start, end)}
+
+    for attempt in range(max_retries + 1):
+        try:
+            # A new Key avoids sharing the response state between threads.
+            key = Key(thread_bucket(bucket), key_name)
+            with open(out_file, "r+b") as fp:
+                fp.seek(start)
+                key.get_contents_to_file(fp, headers=headers)
+                if fp.tell() != end + 1:
+                    raise IOError("Incomplete range {0}-{1} for {2}"
+                                  .format(start, end, key_name))
+            return start
+        except Exception:
+            if attempt == max_retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def verify_download(key, filename):
+    '''
+    Check a downloaded file against its key. The MD5 is compared when the
+    ETag is a plain MD5 (i.e., not from a multi-part upload). Otherwise only
+    the size is compared.
+    '''
+
+    local_size = os.stat(filename).st_size
+    if key.size is not None and local_size != key.size:
+        raise IOError("Downloaded size of {0} ({1}) does not match the key "
+                      "size ({2}).".format(filename, local_size, key.size))
+
+    etag = key.etag.strip('"') if key.etag is not None else None
+    if etag is not None and "-" not in etag:
+        if file_md5(filename) != etag:
+            raise IOError("MD5 of {0} does not match the ETag of {1}."
+                          .format(filename, key.name))
+
+
+def compute_etag(filename, part_size=None, block_size=8388608):
+    '''
+    Compute the ETag S3 gives a file. This is the MD5 for a single-part
+    upload. For a multi-part upload, it is the MD5 of the concatenated
+    binary MD5s of each part, followed by "-" and the number of parts.
+
+    Parameters
+    ----------
+    filename : str
+        File to hash. It is read in blocks of `block_size`.
+    part_size : int, optional
+        Size of the parts of a multi-part upload. The single-part ETag is
+        returned when not given.
+
+    Returns
+    -------
+    etag : str
+        ETag without the surrounding quotes.
+    '''
+
+    if part_size is None:
+        return file_md5(filename, block_size=block_size)
+
+    part_digests = []
+    with open(filename, "rb") as fp:
+        while True:
+            md5 = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                block = fp.read(min(block_size, remaining))
+                if not block:
+                    break
+                md5.update(block)
+                remaining -= len(block)
+            if remaining == part_size:
+                break
+            part_digests.append(md5.digest())
+            if remaining > 0:
+                break
+
+    etag = hashlib.md5(b"".join(part_digests)).hexdigest()
+    return "{0}-{1}".format(etag, len(part_digests))
+
+
+def infer_part_size(filename, etag, part_sizes=None,
+                    block_size=8388608):
+    '''
+    Find the part size a file was uploaded to S3 with, from the ETag of
+    its key.
+
+    Only part sizes that give the number of parts in the ETag are tried.
+    They are the `part_sizes` given, the defaults of this module (see
+    `transfer_tuner.choose_part_size`) and of common S3 clients, then every
+    other whole number of megabytes. The file is read once for each part
+    size tried, until one gives the same ETag.
+
+    Parameters
+    ----------
+    filename : str
+        Local copy of the key.
+    etag : str
+        Multi-part ETag of the key, e.g. "<md5>-3".
+    part_sizes : list, optional
+        Part sizes to try first.
+    block_size : int, optional
+        Size of the blocks the file is read in.
+
+    Returns
+    -------
+    part_size : int
+        Part size that gives the ETag, or None if none does.
+    '''
+
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return None
+
+    nparts = int(etag.split("-")[-1])
+    size = os.stat(filename).st_size
+
+    if part_sizes is None:
+        part_sizes = []
+    candidates = list(part_sizes) + \
+        [choose_part_size(size, part_size) for part_size in
+         COMMON_PART_SIZES] + COMMON_PART_SIZES
+
+    # Any size with that many parts, from the smallest.
+    smallest = int(math.ceil(size / float(nparts) / MB))
+    if nparts == 1:
+        # All sizes over the file's give the same ETag.
+        candidates.append(smallest * MB)
+    else:
+        largest = int(math.ceil(size / float(nparts - 1) / MB)) - 1
+        candidates.extend(n * MB for n in range(smallest, largest + 1))
+
+    tried = set()
+    for part_size in candidates:
+        if part_size in tried or part_size <= 0 or \
+                int(math.ceil(size / float(part_size))) != nparts:
+            continue
+        tried.add(part_size)
+
+        if compute_etag(filename, part_size=part_size,
+                        block_size=block_size) == etag:
+            return part_size
+
+    return None
+
+
+def file_md5(filename, block_size=8388608):
+    '''
+    Return the hex MD5 of a file, reading in blocks.
+    '''
+
+    md5 = hashlib.md5()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def remove_s3_bucket(bucket_name, connection, num_workers=4, max_retries=3):
+    '''
+    Delete entire bucket. Unfinished multi-part uploads are aborted, and
+    the keys are deleted in batches of 1000 as the bucket is listed (see
+    `delete_keys`). The bucket is only deleted once all of its keys are;
+    otherwise an IOError is raised.
 
     Parameters
     ----------
@@ -216,19 +738,39 @@ def remove_s3_bucket(bucket_name, connection):
         Name of existing bucket or one to be created.
     conn : boto.s3.connection.S3Connection
         A connection to S3.
+    num_workers : int, optional
+        Number of batches to delete at once.
+    max_retries : int, optional
+        Number of times to retry keys that failed to delete.
+
+    Returns
+    -------
+    stats : dict
+        The number of keys deleted and requests made, and the number of
+        uploads aborted.
     '''
 
-    bucket = connection.get_bucket(bucket_name)
+    bucket = get_bucket(connection, bucket_name)
+
+    stats = delete_keys(bucket, bucket.list(), num_workers=num_workers,
+                        max_retries=max_retries)
+    # Aborting after the listing catches uploads started during it.
+    stats["aborted_uploads"] = abort_multipart_uploads(bucket)
 
-    for key in bucket.list():
-        key.delete()
+    _raise_delete_errors(stats["errors"], bucket_name)
 
     bucket.delete()
+    forget_bucket(bucket_name)
 
+    return stats
 
-def remove_s3_key(key_names, bucket_name, connection):
+
+def remove_s3_key(key_names, bucket_name, connection, num_workers=4,
+                  max_retries=3, abort_uploads=True):
     '''
-    Delete a key or a list of keys in a given bucket.
+    Delete a key or a list of keys in a given bucket. The keys are deleted
+    in batches of 1000 (see `delete_keys`). An IOError is raised if any
+    could not be deleted.
 
     Parameters
     ----------
@@ -239,20 +781,285 @@ def remove_s3_key(key_names, bucket_name, connection):
         Name of existing bucket.
     conn : boto.s3.connection.S3Connection
         A connection to S3.
+    num_workers : int, optional
+        Number of batches to delete at once.
+    max_retries : int, optional
+        Number of times to retry keys that failed to delete.
+    abort_uploads : bool, optional
+        With a wildcard, also abort the unfinished multi-part uploads to
+        matching keys.
 
+    Returns
+    -------
+    stats : dict
+        The number of keys deleted and requests made.
     '''
 
-    bucket = connection.get_bucket(bucket_name)
+    bucket = get_bucket(connection, bucket_name)
 
     if isinstance(key_names, list):
-        bucket.delete_keys(key_names)
-    elif "*" in key_names:
-        all_keys = bucket.get_all_keys()
-        for key in all_keys:
-            if fnmatch.fnmatchcase(key.name, key_names):
-                bucket.delete_key(key.name)
+        keys = key_names
+    elif has_wildcard(key_names):
+        keys = (key.name for key in iter_matching_keys(bucket, key_names))
     else:
-        bucket.delete_key(key_names)
+        keys = [key_names]
+
+    stats = delete_keys(bucket, keys, num_workers=num_workers,
+                        max_retries=max_retries)
+
+    if abort_uploads and not isinstance(key_names, list) and \
+            has_wildcard(key_names):
+        stats["aborted_uploads"] = abort_multipart_uploads(bucket, key_names)
+
+    _raise_delete_errors(stats["errors"], bucket_name)
+
+    return stats
+
+
+def _raise_delete_errors(errors, bucket_name, nshow=5):
+    '''
+    Raise an IOError listing the first `nshow` keys that could not be
+    deleted, if there are any.
+    '''
+
+    if len(errors) == 0:
+        return
+
+    shown = "\n".join("{0}: {1} {2}".format(error["key"], error["code"],
+                                            error["message"])
+                      for error in errors[:nshow])
+    raise IOError("Failed to delete {0} keys from {1}:\n{2}".format(
+        len(errors), bucket_name, shown))
+
+
+def delete_keys(bucket, keys, num_workers=4, batch_size=1000,
+                max_retries=3):
+    '''
+    Delete keys with the multi-object delete API, `batch_size` (at most
+    1000) keys per request and `num_workers` requests at once. The keys
+    are consumed as they are deleted, so a lazy listing is never held in
+    memory.
+
+    Keys that fail with a transient error (e.g., SlowDown), or whose whole
+    request failed, are retried with a back-off. The rest are reported.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket to delete from.
+    keys : iterable
+        Key names, or boto.s3.key.Key objects.
+    num_workers : int, optional
+        Number of requests to send at once.
+    batch_size : int, optional
+        Number of keys in each request.
+    max_retries : int, optional
+        Number of times to retry keys that failed to delete.
+
+    Returns
+    -------
+    stats : dict
+        The number of keys deleted and requests sent, and the key, code and
+        message of each key that could not be deleted.
+    '''
+
+    batch_size = max(1, min(batch_size, 1000))
+    num_workers = max(1, num_workers)
+
+    stats = {"deleted": 0, "requests": 0, "errors": []}
+
+    done = Queue()
+
+    def run(batch):
+        try:
+            done.put(_delete_batch(thread_bucket(bucket), batch,
+                                   max_retries))
+        except Exception as exc:
+            done.put(exc)
+
+    def batches():
+        batch = []
+        for key in keys:
+            batch.append(key if isinstance(key, str) else
+                         getattr(key, "name", key))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    pool = ThreadPool(num_workers)
+    try:
+        in_flight = 0
+        pending = batches()
+        exhausted = False
+        while not exhausted or in_flight > 0:
+            # Only list as far ahead as the requests in flight need.
+            while not exhausted and in_flight < num_workers:
+                try:
+                    batch = next(pending)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pool.apply_async(run, (batch, ))
+                in_flight += 1
+
+            if in_flight == 0:
+                break
+
+            result = done.get()
+            in_flight -= 1
+            if isinstance(result, Exception):
+                raise result
+            stats["deleted"] += result["deleted"]
+            stats["requests"] += result["requests"]
+            stats["errors"].extend(result["errors"])
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return stats
+
+
+# Error codes of keys worth trying to delete again.
+RETRY_DELETE_CODES = ["InternalError", "SlowDown", "ServiceUnavailable"]
+
+
+def _delete_batch(bucket, key_names, max_retries=3):
+    '''
+    Delete one batch of keys, retrying those that fail transiently.
+    '''
+
+    result = {"deleted": 0, "requests": 0, "errors": []}
+
+    for attempt in range(max_retries + 1):
+        result["requests"] += 1
+        try:
+            response = bucket.delete_keys(key_names, quiet=True)
+        except Exception as exc:
+            if attempt == max_retries:
+                result["errors"].extend({"key": name,
+                                         "code": type(exc).__name__,
+                                         "message": str(exc)}
+                                        for name in key_names)
+                return result
+            time.sleep(2 ** attempt)
+            continue
+
+        retry = []
+        for error in response.errors:
+            if error.code in RETRY_DELETE_CODES and attempt < max_retries:
+                retry.append(error.key)
+            else:
+                result["errors"].append({"key": error.key,
+                                         "code": error.code,
+                                         "message": error.message})
+
+        # In quiet mode, only the failed keys are listed.
+        result["deleted"] += len(key_names) - len(response.errors)
+
+        if len(retry) == 0:
+            return result
+
+        key_names = retry
+        time.sleep(2 ** attempt)
+
+    return result
+
+
+def abort_multipart_uploads(bucket, pattern=None):
+    '''
+    Abort the unfinished multi-part uploads in a bucket, so the parts
+    already uploaded are removed.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket holding the uploads.
+    pattern : str, optional
+        Only abort uploads to keys matching this glob pattern.
+
+    Returns
+    -------
+    naborted : int
+        Number of uploads aborted.
+    '''
+
+    naborted = 0
+    for upload in bucket.list_multipart_uploads():
+        if pattern is not None and \
+                not fnmatch.fnmatchcase(upload.key_name, pattern):
+            continue
+        upload.cancel_upload()
+        naborted += 1
+
+    return naborted
+
+
+def has_wildcard(key_name):
+    '''
+    Check whether a key name contains glob wildcards.
+    '''
+    return any(char in key_name for char in GLOB_CHARS)
+
+
+def glob_prefix(pattern):
+    '''
+    Return the literal start of a glob pattern, up to the first wildcard.
+    This is used as the prefix to scope a listing to.
+
+    Parameters
+    ----------
+    pattern : str
+        Glob pattern of key names (e.g., "data_products/*.fits").
+
+    Returns
+    -------
+    prefix : str
+        Literal prefix of the pattern (e.g., "data_products/").
+    '''
+    for i, char in enumerate(pattern):
+        if char in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+def iter_matching_keys(bucket, pattern=None, prefix=None):
+    '''
+    Lazily list the keys in a bucket. Only the keys under the literal prefix
+    of the pattern are requested, and the listing is paged through as the
+    generator is consumed.
+
+    Parameters
+    ----------
+    bucket : boto.s3.bucket.Bucket
+        Bucket to list.
+    pattern : str, optional
+        Glob pattern the key names must match. All keys are returned when
+        not given.
+    prefix : str, optional
+        Prefix to list under. Defaults to the literal prefix of `pattern`.
+
+    Yields
+    ------
+    key : boto.s3.key.Key
+        Matching keys.
+    '''
+
+    if prefix is None:
+        prefix = "" if pattern is None else glob_prefix(pattern)
+
+    # bucket.list pages through the results with markers as it's iterated.
+    for key in bucket.list(prefix=prefix):
+        if pattern is None or fnmatch.fnmatchcase(key.name, pattern):
+            yield key
+
+
+def key_exists(bucket, key_name):
+    '''
+    Check whether a key exists with a single HEAD request.
+    '''
+    return bucket.get_key(key_name) is not None
 
 
 def accumulator(iterable, typeof=str, spacer="/", start_space=0):
@@ -268,7 +1075,8 @@ def accumulator(iterable, typeof=str, spacer="/", start_space=0):
 
 def return_s3_connection(aws_access):
     '''
-    Return an S3 connection, optionally given the key and secret.
+    Return an S3 connection, optionally given the key and secret. The
+    connection is shared with all other calls using the same credentials.
 
     Parameters
     ----------
@@ -281,18 +1089,8 @@ def return_s3_connection(aws_access):
     conn : boto.s3.connection.S3Connection
         Connection to S3.
     '''
-    # Create S3 connection if none are given.
-    if "aws_access_key_id" in aws_access.keys() and "aws_secret_access_key" in aws_access.keys():
-        conn = S3Connection(**aws_access)
-    elif len(aws_access.keys()) > 0:
-        raise KeyError("aws_access must contain 'aws_access_key_id'"
-                       " and 'aws_secret_access_key'. All other"
-                       " entries are ignored.")
-    else:
-        # Use the AWS Keys saved on your machine.
-        conn = S3Connection()
-
-    return conn
+    # Uses the AWS Keys saved on your machine when aws_access is empty.
+    return get_s3_connection(aws_access)
 
 
 def set_bucket_lifetime(bucket_name, days=14, aws_access={}, conn=None):
@@ -302,7 +1100,7 @@ def set_bucket_lifetime(bucket_name, days=14, aws_access={}, conn=None):
 
     conn = return_s3_connection(aws_access) if conn is None else conn
 
-    bucket = conn.get_bucket(bucket_name)
+    bucket = get_bucket(conn, bucket_name)
     expiration = Expiration(days=days)
     rule = Rule(id='ruleid', prefix='', status='Enabled',
                 expiration=expiration)
@@ -0,0 +1,88 @@
+# License under the MIT License - see LICENSE
+
+'''
+Local record of the files uploaded to S3, used to only upload new or
+changed files when syncing.
+'''
+
+import json
+import os
+import threading
+
+
+DEFAULT_MANIFEST = os.path.expanduser("~/.aws_controller/upload_manifest.json")
+
+
+class UploadManifest(object):
+    '''
+    Cache of the size, modification time and ETag of each uploaded file,
+    stored as JSON.
+
+    Parameters
+    ----------
+    filename : str, optional
+        File to keep the manifest in. Defaults to
+        `~/.aws_controller/upload_manifest.json`.
+    '''
+    def __init__(self, filename=None):
+        super(UploadManifest, self).__init__()
+
+        self.filename = DEFAULT_MANIFEST if filename is None else filename
+
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def lookup(self, filename, bucket_name, key_name):
+        '''
+        Return the entry for a file uploaded to the given key. None is
+        returned when the file has not been recorded, or when the file's size
+        or modification time have changed since.
+        '''
+
+        with self._lock:
+            entry = self.entries.get(bucket_name, {}).get(key_name)
+
+        if entry is None:
+            return None
+
+        stat = os.stat(filename)
+        if entry["path"] != os.path.abspath(filename) or \
+                entry["size"] != stat.st_size or \
+                entry["mtime"] != stat.st_mtime:
+            return None
+
+        return entry
+
+    def record(self, filename, bucket_name, key_name, etag):
+        '''
+        Record a file as uploaded to the given key.
+        '''
+
+        stat = os.stat(filename)
+        entry = {"path": os.path.abspath(filename),
+                 "size": stat.st_size,
+                 "mtime": stat.st_mtime,
+                 "etag": etag}
+
+        with self._lock:
+            self.entries.setdefault(bucket_name, {})[key_name] = entry
+
+    def save(self):
+        '''
+        Write the manifest to disk. The file is replaced atomically.
+        '''
+
+        folder = os.path.dirname(self.filename)
+        if folder != "" and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        tmp_filename = self.filename + ".tmp"
+        with self._lock:
+            with open(tmp_filename, "w") as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_filename, self.filename)
@@ -3,6 +3,11 @@
 from datetime import datetime
 import os
 import time
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library.
+    monotonic = time.time
 
 
 def timestring():
@@ -17,3 +22,16 @@ def human_time():
 
 def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
+
+
+def path_size(path):
+    '''
+    Return the size in bytes of a file, or of all files within a folder.
+    '''
+    if os.path.isdir(path):
+        total = 0
+        for (source_dir, _, filename_list) in os.walk(path):
+            for filename in filename_list:
+                total += os.path.getsize(os.path.join(source_dir, filename))
+        return total
+    return os.path.getsize(path)
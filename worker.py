@@ -1,19 +1,34 @@
 # License under the MIT License - see LICENSE
 
 import boto
-from boto import sqs
+import boto.utils
 import json
+from multiprocessing import cpu_count
 from subprocess import Popen, PIPE
 import os
+import shutil
+import threading
+import time
 import traceback as tr
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
-from upload_download_s3 import download_from_s3, upload_to_s3
-from utils import listdir_fullpath
+from upload_download_s3 import download_from_s3, upload_to_s3, \
+    return_s3_connection
+from stream_upload import stream_tar_to_s3, TAR_EXTENSIONS
+from log_stream import LogStreamer
+from connections import get_sqs_connection, get_queue, get_bucket, \
+    get_ec2_connection, thread_message
+from spot import InterruptionWatcher
+from utils import listdir_fullpath, monotonic, path_size
 
 
 class Worker(object):
     """docstring for Worker"""
-    def __init__(self, queue_name, key, secret, region='us-west-2'):
+    def __init__(self, queue_name, key, secret, region='us-west-2',
+                 work_dir=None, cache=None):
 
         self.queue_name = queue_name
         self.message_dict = {}
@@ -26,70 +41,359 @@ class Worker(object):
 
         self.success = True
         self.empty_flag = False
+        # Set when the message read could not be understood as a job.
+        self.rejected = False
 
-    def receive_message(self, max_time=3600, save_message=True):
+        self.proc_name = None
+        self.message = None
+        self.output_files = []
+        # The inputs are downloaded into the work folder, where the
+        # commands are run. These are the files and folders they added.
+        self.input_paths = []
+        self.start_time = None
+        self.end_time = None
+        self.instance_id, self.instance_type = get_instance_info()
+
+        # A message can hold a work unit of several packed jobs. Each is run
+        # by its own Worker, in its own folder within jobs_dir.
+        self.unit_workers = []
+
+        # Time (and bytes or resources) of each phase of the current job.
+        # The result message can't include the time taken to send itself,
+        # so it is reported with the next job.
+        self.timings = {}
+        self.last_send = None
+
+        self.heartbeat = None
+        self.interrupted = False
+        # Set once the controller asks this instance to drain.
+        self.draining = False
+        self._last_drain_check = None
+        # Guards the heartbeat and the sending of results against an
+        # interruption arriving from the watcher thread.
+        self._interrupt_lock = threading.Lock()
+        # Number of jobs this instance runs at once, reported with the
+        # results so the controller can compare instance types.
+        self.nslots = 1
+
+        # Optional input_cache.InputCache, shared between job slots.
+        self.cache = cache
+
+        # Each worker keeps its input and output in its own folders, so
+        # several can run side-by-side.
+        self.work_dir = os.getcwd() if work_dir is None else work_dir
+        self.data_dir = os.path.join(self.work_dir, "data")
+        self.products_dir = os.path.join(self.work_dir, "data_products")
+        self.jobs_dir = os.path.join(self.work_dir, "jobs")
+        self.tar_file = os.path.join(self.work_dir, "data_products.tar")
+
+        for folder in [self.data_dir, self.products_dir]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def reset(self):
+        '''
+        Clear the state from the previous job, remove its inputs, and
+        empty the data and data_products folders.
+        '''
+
+        self.message_dict = {}
+        self.success = True
+        self.empty_flag = False
+        self.rejected = False
+        self.proc_name = None
+        self.message = None
+        self.output_files = []
+        self.start_time = None
+        self.end_time = None
+        self.timings = {}
+        self.unit_workers = []
+
+        paths = self.input_paths
+        self.input_paths = []
+        for folder in [self.data_dir, self.products_dir]:
+            if os.path.isdir(folder):
+                paths.extend(listdir_fullpath(folder))
+
+        for name in paths:
+            if os.path.isdir(name):
+                shutil.rmtree(name)
+            elif os.path.exists(name):
+                os.remove(name)
+
+        if os.path.isdir(self.jobs_dir):
+            shutil.rmtree(self.jobs_dir)
+
+        if os.path.exists(self.tar_file):
+            os.remove(self.tar_file)
+
+    def receive_message(self, max_time=3600, save_message=True,
+                        delete=True, wait_time=None):
         '''
         Connect to the queue and read the next message.
+
+        Parameters
+        ----------
+        max_time : int, optional
+            Visibility timeout of the message, in seconds.
+        save_message : bool, optional
+            Save the message contents to data/params.txt.
+        delete : bool, optional
+            Delete the message from the queue once read. Otherwise, call
+            `delete_message` once the job is finished. If the worker dies
+            before then, the message returns to the queue.
+        wait_time : int, optional
+            Wait up to this many seconds (max. 20) for a message to arrive.
         '''
 
-        queue = sqs.connect_to_region(self.region,
-                                           aws_access_key_id=self.key,
-                                           aws_secret_access_key=self.secret).create_queue(self.queue_name)
+        t0 = monotonic()
+
+        queue = get_queue(get_sqs_connection(self.region, self.credentials),
+                          self.queue_name)
         # Get the message from the queue within some max time
-        mess = queue.read(max_time)
+        mess = queue.read(max_time, wait_time_seconds=wait_time)
+
+        self._record_time('receive', t0)
 
         if mess is None:
             self.empty_flag = True
             self.success = False
             self.message_dict['receive_message'] = "Found no message to read."
         else:
-            contents = json.loads(mess.get_body())
+            self.proc_name = None
+            try:
+                contents = json.loads(mess.get_body())
 
-            self.proc_name = contents['proc_name']
-            self.bucket_name = contents['bucket']
-            self.key_name = contents['key_name']
-            self.command = contents['command']
+                self.proc_name = contents['proc_name']
+                self.bucket_name = contents['bucket']
+                # Jobs sharing a bucket are given their own output prefix.
+                self.output_prefix = contents.get('output_prefix',
+                                                  "data_products/")
 
-            try:
-                queue.delete_message(mess)
-            except Exception:
-                print("No message to delete.")
+                if 'jobs' in contents:
+                    # A work unit of packed jobs.
+                    self.key_name = None
+                    self.command = []
+                    self.unit_workers = [self._unit_worker(job, save_message)
+                                         for job in contents['jobs']]
+                else:
+                    self.key_name = contents['key_name']
+                    self.command = contents['command']
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self._reject_message(mess)
+                return
+
+            self.message = mess
+
+            if delete:
+                self.delete_message()
 
             if save_message:
-                with open("data/params.txt", "w") as f:
+                with open(os.path.join(self.data_dir, "params.txt"),
+                          "w") as f:
                     json.dump(contents, f)
 
+            self.start_time = time.time()
+
+            # The time from boot to the first message of the instance is
+            # reported, to compare worker images with.
+            uptime = first_message_uptime()
+            if uptime is not None:
+                self.timings['boot'] = {'duration': uptime,
+                                        'image_id': get_image_id()}
+
             self.message_dict['receive_message'] = "Successfully read message."
 
-    def download_data(self):
-        if not self.empty_flag:
+    def _reject_message(self, mess):
+        '''
+        Delete a message that can't be read as a job, which would otherwise
+        return to the queue and be read again forever. Nothing is run for
+        it, and the error is kept in `message_dict`.
+        '''
+
+        error = tr.format_exc()
+        print("Rejected a job message:\n" + mess.get_body() + "\n" + error)
+
+        self.message = mess
+        self.delete_message()
+
+        self.rejected = True
+        # The later phases skip the job.
+        self.empty_flag = True
+        self.success = False
+        self.unit_workers = []
+        self.message_dict['receive_message'] = \
+            "Rejected a message that is not a valid job:\n" + error
+
+    def report_rejected(self, resp_queue_name):
+        '''
+        Send a failed result for a rejected message, if it names its job,
+        so the controller does not wait on the job.
+        '''
+
+        if self.proc_name is None:
+            return
+
+        try:
+            self.send_result_message(resp_queue_name)
+        except Exception:
+            print(tr.format_exc())
+
+    def _unit_worker(self, job, save_message=True):
+        '''
+        Set up the Worker that runs one job of a work unit.
+        '''
+
+        work = Worker(self.queue_name, self.key, self.secret,
+                      region=self.region,
+                      work_dir=os.path.join(self.jobs_dir, job['proc_name']),
+                      cache=self.cache)
+
+        work.proc_name = job['proc_name']
+        work.bucket_name = job.get('bucket', self.bucket_name)
+        work.key_name = job['key_name']
+        work.command = job['command']
+        work.output_prefix = job.get('output_prefix', self.output_prefix)
+
+        if save_message:
+            with open(os.path.join(work.data_dir, "params.txt"), "w") as f:
+                json.dump(job, f)
+
+        return work
+
+    def delete_message(self):
+        '''
+        Delete the current message from the queue.
+        '''
+
+        queue = get_queue(get_sqs_connection(self.region, self.credentials),
+                          self.queue_name)
+        try:
+            queue.delete_message(self.message)
+        except Exception:
+            print("No message to delete.")
+
+    def download_data(self, num_workers=1):
+        if not self.empty_flag and len(self.unit_workers) > 0:
+            t0 = monotonic()
+            for work in self.unit_workers:
+                work.start_time = time.time()
+                work.download_data(num_workers=num_workers)
+            self._record_time('download', t0,
+                              bytes=sum(work.timings['download']
+                                        .get('bytes', 0)
+                                        for work in self.unit_workers))
+            self.message_dict['download_data'] = \
+                "Downloaded the data of {} jobs.".format(
+                    len(self.unit_workers))
+        elif not self.empty_flag:
+            cache_stats = {"hits": 0, "misses": 0}
+            existing = set(os.listdir(self.work_dir))
+            t0 = monotonic()
             try:
-                download_from_s3(self.key_name, self.bucket_name,
-                                 aws_access=self.credentials)
+                out_files = \
+                    download_from_s3(self.key_name, self.bucket_name,
+                                     aws_access=self.credentials,
+                                     output_dir=self.work_dir,
+                                     num_workers=num_workers,
+                                     cache=self.cache,
+                                     cache_stats=cache_stats)
+                self._record_time('download', t0,
+                                  bytes=sum(os.path.getsize(name)
+                                            for name in out_files))
                 self.message_dict['download_data'] = \
                     "Successfully downloaded data."
             except Exception:
+                self._record_time('download', t0)
                 self.success = False
                 self.message_dict['download_data'] = tr.format_exc()
 
-    def execute(self):
-        if not self.empty_flag:
+            # Includes anything left by a failed download.
+            self.input_paths = [os.path.join(self.work_dir, name)
+                                for name in os.listdir(self.work_dir)
+                                if name not in existing]
+
+            if self.cache is not None:
+                self.message_dict['input_cache'] = cache_stats
+
+    def execute(self, stream_logs=False, log_interval=5.,
+                log_chunk_size=1048576):
+        '''
+        Run the job's commands, with their output written to stdout.txt and
+        stderr.txt in the data_products folder.
+
+        Parameters
+        ----------
+        stream_logs : bool, optional
+            Upload the output to `<output_prefix>logs/` in the bucket as it
+            is written (see `log_stream.LogStreamer`), rather than only with
+            the results.
+        log_interval : float, optional
+            Longest time, in seconds, between uploads of the logs.
+        log_chunk_size : int, optional
+            Upload the logs once this many bytes are waiting.
+        '''
+        if not self.empty_flag and len(self.unit_workers) > 0:
+            # Run the packed jobs back to back, and gather their products.
+            t0 = monotonic()
+            for work in self.unit_workers:
+                if work.success and not self.interrupted:
+                    work.execute(stream_logs=stream_logs,
+                                 log_interval=log_interval,
+                                 log_chunk_size=log_chunk_size)
+                work.end_time = time.time()
+                if len(work.output_files) > 0:
+                    self.output_files.append(work.products_dir)
+            self._record_time('execute', t0)
+            self.message_dict['execute'] = \
+                "Ran {0} jobs, {1} successfully.".format(
+                    len(self.unit_workers),
+                    sum(work.success for work in self.unit_workers))
+        elif not self.empty_flag:
+            t0 = monotonic()
+            commands = []
+            streamer = None
             try:
-                stdout_file = open("data_products/stdout.txt", "a")
-                stderr_file = open("data_products/stderr.txt", "a")
+                stdout_name = os.path.join(self.products_dir, "stdout.txt")
+                stderr_name = os.path.join(self.products_dir, "stderr.txt")
+                stdout_file = open(stdout_name, "a")
+                stderr_file = open(stderr_name, "a")
+
+                if stream_logs:
+                    bucket = get_bucket(return_s3_connection(self.credentials),
+                                        self.bucket_name)
+                    streamer = LogStreamer(bucket,
+                                           self.output_prefix + "logs/",
+                                           [stdout_name, stderr_name],
+                                           interval=log_interval,
+                                           chunk_size=log_chunk_size)
+                    streamer.start()
+
+                # Commands run from the work folder, and can find their
+                # folders through the environment.
+                env = os.environ.copy()
+                env["WORK_DIR"] = self.work_dir
+                env["DATA_DIR"] = self.data_dir
+                env["PRODUCTS_DIR"] = self.products_dir
                 for cmd in self.command:
+                    if self.interrupted:
+                        raise Exception("Interrupted before running: " +
+                                        str(cmd))
                     if not isinstance(cmd, list):
                         cmd = cmd.split()
-                    proc = Popen(cmd, stdout=stdout_file, stderr=stderr_file)
-                    proc.communicate()
+                    commands.append(run_command(cmd, stdout=stdout_file,
+                                                stderr=stderr_file,
+                                                cwd=self.work_dir, env=env))
                     stdout_file.flush()
                 stdout_file.close()
+                stderr_file.close()
                 # Put a copy of the parameter file for the job into the
                 # data_products folder.
-                os.system("cp /home/ubuntu/data/params.txt "
-                          "/home/ubuntu/data_products/")
+                params_file = os.path.join(self.data_dir, "params.txt")
+                if os.path.exists(params_file):
+                    shutil.copy(params_file, self.products_dir)
                 # Check the files in the output folder
-                self.output_files = listdir_fullpath("/home/ubuntu/data_products/")
+                self.output_files = listdir_fullpath(self.products_dir)
                 if len(self.output_files) == 0:
                     raise Exception("No output files found.")
                 self.message_dict['execute'] = "Successfully executed command."
@@ -100,43 +404,798 @@ class Worker(object):
                 self.output_files = []
                 try:
                     stdout_file.close()
+                    stderr_file.close()
                 except Exception:
                     pass
 
-    def upload_results(self, make_tar=False):
+            if streamer is not None:
+                self.message_dict['log_stream'] = streamer.stop()
+
+            self._record_time('execute', t0, commands=commands)
+
+    def upload_results(self, make_tar=False, num_workers=1, stream=False,
+                       compression=None, compression_level=6):
+        '''
+        Upload the data products. With `make_tar`, the products are combined
+        into a single tar file. With `stream`, the tar is written straight
+        into the upload (optionally compressed with 'gz' or 'zst') rather
+        than to local disk first.
+        '''
 
         if not self.empty_flag:
             if len(self.output_files) == 0:
                 self.message_dict['upload_results'] = "No output files found."
+            elif make_tar and stream:
+                t0 = monotonic()
+                try:
+                    bucket = get_bucket(return_s3_connection(self.credentials),
+                                        self.bucket_name)
+                    key_name = self.output_prefix + "data_products" + \
+                        TAR_EXTENSIONS[compression]
+                    stats = stream_tar_to_s3(
+                        self.output_files, bucket, key_name,
+                        compression=compression,
+                        compression_level=compression_level,
+                        num_workers=max(2, num_workers))
+                    self.message_dict['upload_stats'] = stats
+                    self._record_time('upload', t0,
+                                      bytes=stats['compressed_bytes'],
+                                      raw_bytes=stats['raw_bytes'])
+                    self.message_dict['upload_results'] = \
+                        "Successfully uploaded results."
+                except Exception:
+                    self._record_time('upload', t0)
+                    self.message_dict['upload_results'] = tr.format_exc()
+                    self.success = False
+            elif len(self.unit_workers) > 0 and not make_tar:
+                # Each job of a work unit keeps its own output prefix.
+                t0 = monotonic()
+                uploaded = [work for work in self.unit_workers
+                            if len(work.output_files) > 0]
+                for work in uploaded:
+                    work.upload_results(num_workers=num_workers)
+                self._record_time('upload', t0,
+                                  bytes=sum(work.timings['upload']
+                                            .get('bytes', 0)
+                                            for work in uploaded))
+                if all(work.success for work in uploaded):
+                    self.message_dict['upload_results'] = \
+                        "Successfully uploaded results."
+                else:
+                    self.message_dict['upload_results'] = \
+                        "Failed to upload the results of some jobs."
             else:
                 if make_tar:
                     # Create a tar file and only upload it.
                     import tarfile
-                    tar = tarfile.open("data_products.tar", "w:")
+                    t0 = monotonic()
+                    tar = tarfile.open(self.tar_file, "w:")
                     for name in self.output_files:
                         tar.add(name)
                     tar.close()
-                    self.output_files = ["data_products.tar"]
+                    self.output_files = [self.tar_file]
+                    self._record_time('tar', t0,
+                                      bytes=os.path.getsize(self.tar_file))
 
+                t0 = monotonic()
                 try:
                     for out in self.output_files:
                         upload_to_s3(self.bucket_name, out,
                                      aws_access=self.credentials,
                                      create_bucket=False,
-                                     key_prefix="data_products/")
+                                     key_prefix=self.output_prefix,
+                                     num_workers=num_workers)
+                    self._record_time('upload', t0,
+                                      bytes=sum(path_size(out) for out in
+                                                self.output_files))
                     self.message_dict['upload_results'] = \
                         "Successfully uploaded results."
                 except Exception:
+                    self._record_time('upload', t0)
                     self.message_dict['upload_results'] = tr.format_exc()
                     self.success = False
 
     def send_result_message(self, resp_queue_name):
-        resp_queue = sqs.connect_to_region(self.region,
-                                           aws_access_key_id=self.key,
-                                           aws_secret_access_key=self.secret).create_queue(resp_queue_name)
+        t0 = monotonic()
+
+        if self.last_send is not None:
+            self.timings['previous_send'] = self.last_send
+
+        resp_queue = get_queue(get_sqs_connection(self.region,
+                                                  self.credentials),
+                               resp_queue_name)
         resp_message = {'proc_name': self.proc_name,
                         'success': self.success,
-                        'messages': self.message_dict}
+                        'messages': self.message_dict,
+                        'instance_id': self.instance_id,
+                        'instance_type': self.instance_type,
+                        'nslots': self.nslots,
+                        'timings': self.timings}
+        if self.start_time is not None:
+            resp_message['duration'] = time.time() - self.start_time
 
-        mess = resp_queue.new_message(body=json.dumps(resp_message))
+        if len(self.unit_workers) > 0:
+            # One result per job of the work unit. A failed upload fails
+            # all of them.
+            resp_message['jobs'] = []
+            for work in self.unit_workers:
+                messages = dict(work.message_dict)
+                if 'upload_results' in messages:
+                    # Uploaded on its own.
+                    output_prefix = work.output_prefix
+                else:
+                    output_prefix = self.output_prefix
+                    if len(work.output_files) > 0 and \
+                            'upload_results' in self.message_dict:
+                        messages['upload_results'] = \
+                            self.message_dict['upload_results']
+                job = {'proc_name': work.proc_name,
+                       'success': work.success and self.success,
+                       'messages': messages,
+                       'timings': work.timings,
+                       'output_prefix': output_prefix}
+                if work.start_time is not None and work.end_time is not None:
+                    job['duration'] = work.end_time - work.start_time
+                resp_message['jobs'].append(job)
+            resp_message['success'] = \
+                all(job['success'] for job in resp_message['jobs'])
+
+        body = json.dumps(resp_message)
+        if len(body) > MAX_RESULT_SIZE:
+            body = self._result_reference(resp_message, body)
+        mess = resp_queue.new_message(body=body)
         resp_queue.write(mess)
+
+        self.last_send = {'duration': monotonic() - t0, 'bytes': len(body)}
+
+    def _result_reference(self, resp_message, body):
+        '''
+        Results too large for an SQS message (e.g., a work unit of many
+        jobs with long tracebacks) are uploaded to
+        `<output_prefix>result.json`, and the message points to them. If
+        that fails, only the outcome of each job is sent.
+        '''
+
+        key_name = self.output_prefix + "result.json"
+        summary = dict((field, resp_message.get(field))
+                       for field in ['proc_name', 'success', 'instance_id',
+                                     'instance_type', 'duration'])
+        try:
+            bucket = get_bucket(return_s3_connection(self.credentials),
+                                self.bucket_name)
+            key = bucket.new_key(key_name)
+            key.set_contents_from_string(body)
+            summary['result_key'] = key_name
+            summary['bucket'] = self.bucket_name
+        except Exception:
+            summary['messages'] = {'send_result_message':
+                                   "Results too large to send, and their "
+                                   "upload failed:\n" + tr.format_exc()}
+            if 'jobs' in resp_message:
+                summary['jobs'] = [dict((field, job.get(field))
+                                        for field in ['proc_name', 'success',
+                                                      'duration',
+                                                      'output_prefix'])
+                                   for job in resp_message['jobs']]
+        return json.dumps(summary)
+
+    def _record_time(self, phase, t0, **extra):
+        '''
+        Record the time since `t0` (from `monotonic`) spent in a phase,
+        along with any other counters.
+        '''
+        self.timings[phase] = dict(duration=monotonic() - t0, **extra)
+
+    def interrupt(self):
+        '''
+        Stop taking new jobs, and return the current job's message to the
+        queue straight away so another worker can pick it up. The current
+        job stops before its next phase or command, and its result is not
+        sent.
+        '''
+
+        with self._interrupt_lock:
+            self.interrupted = True
+
+            if self.heartbeat is not None:
+                self.heartbeat.release()
+
+    def drain_requested(self, check_interval=30):
+        '''
+        Check whether the controller has tagged this instance to drain.
+        The tags are read at most once every `check_interval` seconds.
+        '''
+
+        if self.draining or self.instance_id is None:
+            return self.draining
+
+        now = monotonic()
+        if self._last_drain_check is not None and \
+                now - self._last_drain_check < check_interval:
+            return False
+        self._last_drain_check = now
+
+        try:
+            ec2 = get_ec2_connection(self.region, self.credentials)
+            tags = ec2.get_all_tags(filters={'resource-id': self.instance_id,
+                                             'key': DRAIN_TAG})
+        except Exception:
+            print("Failed to read the instance tags.")
+            return False
+
+        self.draining = len(tags) > 0
+        return self.draining
+
+    def send_status_message(self, resp_queue_name):
+        '''
+        Tell the controller this instance has stopped taking jobs on its
+        own: 'drained' when asked to by the controller, and can be
+        terminated, or 'idle' when it found no more jobs. An instance that
+        stops without one has been lost.
+        '''
+
+        status = 'drained' if self.draining else 'idle'
+        try:
+            resp_queue = get_queue(get_sqs_connection(self.region,
+                                                      self.credentials),
+                                   resp_queue_name)
+            body = json.dumps({'status': status,
+                               'instance_id': self.instance_id})
+            resp_queue.write(resp_queue.new_message(body=body))
+        except Exception:
+            print(tr.format_exc())
+
+    def run(self, resp_queue_name, idle_time=600, visibility_timeout=600,
+            heartbeat_interval=None, watch_interruptions=False,
+            stream_logs=False, drain_check_interval=30, report_status=True,
+            **upload_kwargs):
+        '''
+        Keep running jobs until no message has been received for `idle_time`
+        seconds.
+
+        While a job runs, the visibility timeout of its message is extended
+        with a heartbeat. The message is only deleted after the result
+        message is sent, so the job returns to the queue if the worker dies.
+
+        Parameters
+        ----------
+        resp_queue_name : str
+            Name of the queue to send the results to.
+        idle_time : int, optional
+            Stop after this many seconds without a message.
+        visibility_timeout : int, optional
+            Visibility timeout given to the messages, in seconds.
+        heartbeat_interval : int, optional
+            Seconds between extending the visibility timeout. Defaults to
+            half of `visibility_timeout`.
+        watch_interruptions : bool, optional
+            Watch for a spot interruption notice. When one arrives, the
+            current job is returned to the queue and no more are taken.
+        stream_logs : bool, optional
+            Stream the job output to S3 as it is written. See `execute`.
+        drain_check_interval : int, optional
+            Seconds between checks for a drain request from the controller.
+            Once one is seen, no more jobs are taken. See `drain_requested`.
+        report_status : bool, optional
+            Tell the controller why the worker stopped, unless it was
+            interrupted. See `send_status_message`.
+        upload_kwargs : passed to `upload_results`.
+
+        Returns
+        -------
+        njobs : int
+            Number of jobs run.
+        '''
+
+        if watch_interruptions:
+            watcher = InterruptionWatcher(self.interrupt)
+            watcher.start()
+
+        if heartbeat_interval is None:
+            heartbeat_interval = visibility_timeout / 2.
+
+        upload_kwargs.setdefault("make_tar", True)
+
+        njobs = 0
+        last_job = time.time()
+
+        while not self.interrupted:
+            self.reset()
+
+            if self.drain_requested(drain_check_interval):
+                break
+
+            try:
+                self.receive_message(max_time=visibility_timeout,
+                                     delete=False, wait_time=20)
+            except Exception:
+                # e.g., SQS can't be reached. Counts as idle time.
+                print(tr.format_exc())
+                self.empty_flag = True
+                time.sleep(5)
+
+            if self.rejected:
+                self.report_rejected(resp_queue_name)
+                last_job = time.time()
+                continue
+
+            if self.empty_flag:
+                if time.time() - last_job > idle_time:
+                    break
+                continue
+
+            heartbeat = Heartbeat(self.message, visibility_timeout,
+                                  heartbeat_interval)
+            with self._interrupt_lock:
+                if self.interrupted:
+                    heartbeat.release()
+                    break
+                self.heartbeat = heartbeat
+            heartbeat.start()
+
+            try:
+                for phase in [self.download_data,
+                              lambda: self.execute(stream_logs=stream_logs),
+                              lambda: self.upload_results(**upload_kwargs)]:
+                    if self.interrupted:
+                        break
+                    phase()
+
+                # Once interrupted, the message has been released to
+                # another worker, so the result must not be sent.
+                with self._interrupt_lock:
+                    if not self.interrupted:
+                        heartbeat.stop()
+                        self.send_result_message(resp_queue_name)
+                        self.delete_message()
+                        njobs += 1
+            except Exception:
+                # The message returns to the queue once its visibility
+                # timeout is over, and the job is retried.
+                print(tr.format_exc())
+            finally:
+                with self._interrupt_lock:
+                    heartbeat.stop()
+                    self.heartbeat = None
+
+            last_job = time.time()
+
+        if watch_interruptions:
+            watcher.stop()
+
+        if report_status and not self.interrupted:
+            self.send_status_message(resp_queue_name)
+
+        return njobs
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Extend the visibility timeout of a message every `interval` seconds
+    until stopped, so a long job is not handed to another worker.
+    '''
+    def __init__(self, message, visibility_timeout, interval):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+
+        self.message = message
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                # Runs alongside the job, so uses its own connection.
+                thread_message(self.message).change_visibility(
+                    self.visibility_timeout)
+            except Exception:
+                print("Failed to extend the message visibility.")
+
+    def stop(self):
+        self._stop_event.set()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def release(self):
+        '''
+        Stop extending the timeout and make the message visible again.
+        '''
+        self.stop()
+        try:
+            thread_message(self.message).change_visibility(0)
+        except Exception:
+            print("Failed to release the message.")
+
+
+def run_job_slots(queue_name, key, secret, resp_queue_name,
+                  region='us-west-2', nslots=None, base_dir=None, cache=None,
+                  **run_kwargs):
+    '''
+    Run several workers side-by-side, each pulling and running jobs from the
+    same queue. Each slot gets its own work folder (`base_dir/slot_<n>`),
+    with separate data and data_products folders and stdout/stderr files.
+
+    Parameters
+    ----------
+    queue_name : str
+        Name of the queue to read jobs from.
+    key : str
+        AWS access key.
+    secret : str
+        AWS secret key.
+    resp_queue_name : str
+        Name of the queue to send the results to.
+    region : str, optional
+        AWS region name.
+    nslots : int, optional
+        Number of jobs to run at once. Defaults to the number of CPUs.
+    base_dir : str, optional
+        Folder to create the slot folders in. Defaults to the current
+        folder.
+    cache : input_cache.InputCache, optional
+        Input cache shared by the slots.
+    run_kwargs : passed to `Worker.run`.
+
+    Returns
+    -------
+    njobs : int
+        Total number of jobs run.
+    '''
+
+    # The instance has stopped once every slot has.
+    run_kwargs['report_status'] = False
+
+    if nslots is None:
+        nslots = cpu_count()
+
+    if base_dir is None:
+        base_dir = os.getcwd()
+
+    workers = []
+    for i in range(nslots):
+        work_dir = os.path.join(base_dir, "slot_{}".format(i))
+        workers.append(Worker(queue_name, key, secret, region=region,
+                              work_dir=work_dir, cache=cache))
+
+    njobs = [0] * nslots
+
+    def run_slot(i):
+        workers[i].nslots = nslots
+        try:
+            njobs[i] = workers[i].run(resp_queue_name, **run_kwargs)
+        finally:
+            shutil.rmtree(workers[i].work_dir, ignore_errors=True)
+
+    threads = [threading.Thread(target=run_slot, args=(i,))
+               for i in range(nslots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not any(work.interrupted for work in workers):
+        workers[0].draining = any(work.draining for work in workers)
+        workers[0].send_status_message(resp_queue_name)
+
+    return sum(njobs)
+
+
+def run_pipelined(queue_name, key, secret, resp_queue_name,
+                  region='us-west-2', prefetch=1, base_dir=None,
+                  min_free_bytes=10737418240, idle_time=600,
+                  visibility_timeout=600, heartbeat_interval=None,
+                  cache=None, stream_logs=False, **upload_kwargs):
+    '''
+    Run jobs with the network transfers overlapped with the computation.
+    While job N executes, job N+1 is received and its data downloaded, and
+    the results of job N-1 are uploaded and sent.
+
+    Each job gets its own work folder (`base_dir/job_<n>`), which is
+    removed once its results are sent. Messages are only deleted after the
+    result is sent, and their visibility is extended while the job is in
+    the pipeline.
+
+    Parameters
+    ----------
+    queue_name : str
+        Name of the queue to read jobs from.
+    key : str
+        AWS access key.
+    secret : str
+        AWS secret key.
+    resp_queue_name : str
+        Name of the queue to send the results to.
+    region : str, optional
+        AWS region name.
+    prefetch : int, optional
+        Number of downloaded jobs to hold waiting to be executed.
+    base_dir : str, optional
+        Folder to create the job folders in. Defaults to the current folder.
+    min_free_bytes : int, optional
+        Only fetch the next job while this much disk space is free in
+        `base_dir`, unless no other job is in the pipeline. Defaults to
+        10 Gb.
+    idle_time : int, optional
+        Stop once no message has been received for this many seconds.
+    visibility_timeout : int, optional
+        Visibility timeout given to the messages, in seconds.
+    heartbeat_interval : int, optional
+        Seconds between extending the visibility timeout. Defaults to half
+        of `visibility_timeout`.
+    cache : input_cache.InputCache, optional
+        Cache to fetch the job inputs through.
+    stream_logs : bool, optional
+        Stream the job output to S3 as it is written. See `Worker.execute`.
+    upload_kwargs : passed to `Worker.upload_results`.
+
+    Returns
+    -------
+    stats : dict
+        Number of jobs, the wall time, and the total time spent in each
+        phase along with how much of it was hidden behind execution.
+    '''
+
+    if base_dir is None:
+        base_dir = os.getcwd()
+
+    if heartbeat_interval is None:
+        heartbeat_interval = visibility_timeout / 2.
+
+    upload_kwargs.setdefault("make_tar", True)
+
+    execute_queue = Queue(maxsize=prefetch)
+    upload_queue = Queue(maxsize=1)
+
+    # Number of jobs received whose results have not been sent.
+    in_pipeline = [0]
+    lock = threading.Lock()
+
+    intervals = {"download": [], "execute": [], "upload": []}
+
+    def fetch():
+        njob = 0
+        last_message = time.time()
+        try:
+            while True:
+                while in_pipeline[0] > 0 and \
+                        free_disk_space(base_dir) < min_free_bytes:
+                    time.sleep(5)
+
+                job = Worker(queue_name, key, secret, region=region,
+                             work_dir=os.path.join(base_dir,
+                                                   "job_{}".format(njob)),
+                             cache=cache)
+
+                try:
+                    job.receive_message(max_time=visibility_timeout,
+                                        delete=False, wait_time=20)
+                except Exception:
+                    # e.g., SQS can't be reached. Counts as idle time.
+                    print(tr.format_exc())
+                    job.empty_flag = True
+                    time.sleep(5)
+                if job.rejected:
+                    job.report_rejected(resp_queue_name)
+                    last_message = time.time()
+                if job.empty_flag:
+                    shutil.rmtree(job.work_dir)
+                    if time.time() - last_message > idle_time:
+                        break
+                    continue
+
+                last_message = time.time()
+                njob += 1
+                with lock:
+                    in_pipeline[0] += 1
+
+                job.heartbeat = Heartbeat(job.message, visibility_timeout,
+                                          heartbeat_interval)
+                job.heartbeat.start()
+
+                # Starts once there is a message, so the long poll for one
+                # isn't counted as download time.
+                t0 = time.time()
+                job.download_data()
+                intervals["download"].append((t0, time.time()))
+
+                execute_queue.put(job)
+        finally:
+            # Always let the other stages finish.
+            execute_queue.put(None)
+
+    def upload():
+        while True:
+            job = upload_queue.get()
+            if job is None:
+                break
+
+            t0 = time.time()
+            try:
+                job.upload_results(**upload_kwargs)
+                job.send_result_message(resp_queue_name)
+                job.heartbeat.stop()
+                job.delete_message()
+            except Exception:
+                # The message returns to the queue once its visibility
+                # timeout is over.
+                job.heartbeat.stop()
+                print(tr.format_exc())
+            intervals["upload"].append((t0, time.time()))
+
+            shutil.rmtree(job.work_dir)
+            with lock:
+                in_pipeline[0] -= 1
+
+    t_start = time.time()
+
+    fetch_thread = threading.Thread(target=fetch)
+    upload_thread = threading.Thread(target=upload)
+    fetch_thread.start()
+    upload_thread.start()
+
+    njobs = 0
+    while True:
+        job = execute_queue.get()
+        if job is None:
+            break
+
+        t0 = time.time()
+        try:
+            job.execute(stream_logs=stream_logs)
+        except Exception:
+            # Reported with the job's result.
+            job.success = False
+            job.message_dict['execute'] = tr.format_exc()
+        intervals["execute"].append((t0, time.time()))
+        njobs += 1
+
+        upload_queue.put(job)
+
+    upload_queue.put(None)
+    fetch_thread.join()
+    upload_thread.join()
+
+    stats = {"njobs": njobs, "wall_time": time.time() - t_start}
+    for phase in intervals:
+        stats[phase + "_time"] = \
+            sum(end - start for start, end in intervals[phase])
+    for phase in ["download", "upload"]:
+        stats[phase + "_hidden"] = _overlap(intervals[phase],
+                                            intervals["execute"])
+
+    return stats
+
+
+def _overlap(intervals, others):
+    '''
+    Total time the given intervals overlap with a set of non-overlapping
+    intervals.
+    '''
+    total = 0.
+    for start, end in intervals:
+        for other_start, other_end in others:
+            total += max(0., min(end, other_end) - max(start, other_start))
+    return total
+
+
+def get_instance_info():
+    '''
+    Return the ID and type of the EC2 instance this is running on, or None
+    for both when not on EC2. The metadata service is only asked once.
+    '''
+    if 'instance_id' not in _instance_info:
+        try:
+            metadata = boto.utils.get_instance_metadata(timeout=1,
+                                                        num_retries=1)
+        except Exception:
+            metadata = None
+        if not metadata:
+            metadata = {}
+        _instance_info['instance_id'] = metadata.get('instance-id')
+        _instance_info['instance_type'] = metadata.get('instance-type')
+        _instance_info['image_id'] = metadata.get('ami-id')
+    return _instance_info['instance_id'], _instance_info['instance_type']
+
+
+_instance_info = {}
+
+# SQS limits a message to 256 Kb, and messages are base64-encoded, which
+# adds a third to their size. Larger results are sent through S3.
+MAX_RESULT_SIZE = 262144 * 3 // 4 - 1024
+
+# The controller tags an instance with this to ask it to stop taking jobs
+# before it is terminated.
+DRAIN_TAG = "aws_controller_drain"
+
+
+def get_image_id():
+    '''
+    Return the ID of the image this instance was launched from, or None
+    when not on EC2.
+    '''
+    get_instance_info()
+    return _instance_info['image_id']
+
+
+def first_message_uptime():
+    '''
+    Seconds since the machine booted, for the first message received by
+    this process. None is returned for later messages, or if the uptime
+    can't be read.
+    '''
+    with _boot_lock:
+        if _boot_reported:
+            return None
+        _boot_reported.append(True)
+    try:
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0])
+    except (IOError, OSError, ValueError):
+        return None
+
+
+_boot_reported = []
+_boot_lock = threading.Lock()
+
+
+def run_command(cmd, stdout=None, stderr=None, cwd=None, env=None):
+    '''
+    Run a command to completion and return its resource usage: the exit
+    code, wall time, peak resident memory (in bytes), user and system CPU
+    time, and the I/O counters of the process from /proc/<pid>/io (when
+    available).
+    '''
+
+    t0 = monotonic()
+    proc = Popen(cmd, stdout=stdout, stderr=stderr, cwd=cwd, env=env)
+
+    io = {}
+    if hasattr(os, "waitid"):
+        # Wait for the process to exit without reaping it, so its final
+        # I/O counters can still be read.
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(proc.pid)
+
+    _, status, usage = os.wait4(proc.pid, 0)
+
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    return {'command': " ".join(cmd),
+            'returncode': proc.returncode,
+            'duration': monotonic() - t0,
+            # ru_maxrss is in kilobytes on Linux.
+            'max_rss': usage.ru_maxrss * 1024,
+            'user_time': usage.ru_utime,
+            'sys_time': usage.ru_stime,
+            'block_reads': usage.ru_inblock,
+            'block_writes': usage.ru_oublock,
+            'io': io}
+
+
+def read_proc_io(pid):
+    '''
+    Return the I/O counters of a process from /proc/<pid>/io, or an empty
+    dictionary if they can't be read.
+    '''
+    counters = {}
+    try:
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                name, value = line.split(":")
+                counters[name.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def free_disk_space(path):
+    '''
+    Return the free space, in bytes, on the disk holding the given path.
+    '''
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize